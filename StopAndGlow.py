@@ -13,7 +13,6 @@ import logging as log
 
 # Stop Lighting imports
 from stopandglow.commands import *
-import stopandglow.server as server
 
 
 ## Type-defs
@@ -41,6 +40,7 @@ class ArgParser:
                     is_arg = True
                 except:
                     if arg == '--server':
+                        import stopandglow.server as server
                         server.run()
                     else:
                         if arg != '--help' and arg != '-h':
@@ -76,11 +76,15 @@ class ArgParser:
         else:
             log.info(f"Launching {self.name}...")
             from stopandglow.processing_queue import ProcessingQueue
+            from stopandglow.utils.jobs import Job
             
+            # The command chain is one job to keep its order
             queue = ProcessingQueue()
+            job = Job(self.name)
             for command in self.commands:
                 # Add to queue
-                queue.putCommand(command.command, command.arg, command.settings)
+                job.putCommand(command.command, command.arg, command.settings)
+            queue.putJob(job)
             
             # Execute commands
             queue.execute()
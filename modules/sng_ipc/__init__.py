@@ -1,2 +1,3 @@
 from .ipc import *
 from .message import *
+from .ring import *
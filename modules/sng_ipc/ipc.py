@@ -1,33 +1,216 @@
-import pickle
+import json
+import zlib
+from enum import Enum
 import numpy
 import zmq
 from typing import Any
 from numpy.typing import ArrayLike
 
-def send(socket: zmq.Socket, obj, flags=0, protocol=pickle.HIGHEST_PROTOCOL):
-    """send pickled object, throws exception on failure"""
-    socket.send(pickle.dumps(obj, protocol), flags=flags)
+from .message import *
 
-def receive(socket: zmq.Socket, flags=0) -> Any:
-    """receive pickled object, throws exception on failure"""
-    return pickle.loads(socket.recv(flags))
+# Optional compression codecs, zlib is always available
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
 
 
-def send_array(socket, id, A, flags=0, copy=True, track=False):
-    """send a numpy array with metadata, throws exception on failure"""
-    md = dict(
-        dtype=str(A.dtype),
-        shape=A.shape,
-        id=id,
-    )
-    socket.send_json(md, flags | zmq.SNDMORE)
-    socket.send(A, flags, copy=copy, track=track)
+# Messages: JSON header with command and data, arrays in the data are sent as raw frames after the header
+def send(socket: zmq.Socket, message: Message, flags=0):
+    """send message, throws exception on failure"""
+    buffers = []
+    header = {'command': message.command.value, 'data': _pack(message.data, buffers)}
+    socket.send_multipart([json.dumps(header).encode()] + buffers, flags=flags, copy=False)
+
+def receive(socket: zmq.Socket, flags=0) -> Message:
+    """receive message, throws exception on failure"""
+    return parse(socket.recv_multipart(flags, copy=False))
+
+
+class Route:
+    """reply path of a ROUTER socket to one peer, can be used in place of a socket for send()"""
+    def __init__(self, socket: zmq.Socket, envelope: list):
+        self.socket = socket
+        self.envelope = envelope
+        self.identity = envelope[0]
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        self.socket.send_multipart(self.envelope + frames, flags=flags, copy=copy)
+
+def receive_routed(socket: zmq.Socket, flags=0) -> (Route, Message):
+    """receive message on a ROUTER socket with the route to the sender, throws exception on failure"""
+    route, frames = receive_envelope(socket, flags)
+    return (route, parse(frames))
+
+def receive_envelope(socket: zmq.Socket, flags=0) -> (Route, list):
+    """receive on a ROUTER socket, returns the route to the sender and the unparsed message frames, throws exception on failure"""
+    frames = socket.recv_multipart(flags, copy=False)
+    # Identity and empty delimiter of REQ peers, DEALER peers may send the message right after their identity
+    delimiter = next((i for i, frame in enumerate(frames) if len(frame) == 0), 0)
+    return (Route(socket, [frame.bytes for frame in frames[0:delimiter+1]]), frames[delimiter+1:])
 
 
-def receive_array(socket, flags=0, copy=True, track=False) -> (int, ArrayLike):
-    """receive a numpy array, throws exception on failure"""
+def parse(frames) -> Message:
+    """message of received frames, throws exception on failure"""
+    header = json.loads(bytes(frames[0].buffer if isinstance(frames[0], zmq.Frame) else frames[0]))
+    buffers = [frame.buffer if isinstance(frame, zmq.Frame) else memoryview(frame) for frame in frames[1:]]
+    return Message(Command(header['command']), _unpack(header['data'], buffers))
+
+def _pack(obj, buffers: list):
+    """replaces arrays with buffer references, enums with their names; the result can be dumped as JSON"""
+    if isinstance(obj, numpy.ndarray):
+        buffers.append(numpy.ascontiguousarray(obj))
+        return {'__buffer__': len(buffers)-1, 'dtype': str(obj.dtype), 'shape': obj.shape}
+    if isinstance(obj, dict):
+        return {key: _pack(val, buffers) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_pack(val, buffers) for val in obj]
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    return obj
+
+def _unpack(obj, buffers: list):
+    if isinstance(obj, dict):
+        if '__buffer__' in obj:
+            return numpy.frombuffer(buffers[obj['__buffer__']], dtype=obj['dtype']).reshape(obj['shape'])
+        return {key: _unpack(val, buffers) for key, val in obj.items()}
+    if isinstance(obj, list):
+        return [_unpack(val, buffers) for val in obj]
+    return obj
+
+
+# Image frames: JSON metadata and a single payload frame
+def send_array(socket, id, A, flags=0, copy=False, track=False, encoder=None, ring=None, version=None) -> int:
+    """send a numpy array with metadata, returns the payload size, throws exception on failure
+    arrays are written to a slot of the optional FrameRing or encoded by the optional FrameEncoder
+    the version lets receivers drop frames that are older than the one they show"""
+    slot = ring.write(numpy.ascontiguousarray(A)) if ring is not None else None
+    if slot is not None:
+        # Only the slot index is sent
+        socket.send_json(dict(dtype=str(A.dtype), shape=A.shape, slot=slot, id=id, version=version), flags | zmq.SNDMORE)
+        socket.send(b'', flags)
+        return 0
+    if encoder is not None:
+        md, payload = encoder.encode(id, A)
+    else:
+        payload = numpy.ascontiguousarray(A)
+        md = dict(dtype=str(payload.dtype), shape=payload.shape)
+    md['id'] = id
+    md['version'] = version
+    socket.send_json(md, flags | zmq.SNDMORE)
+    socket.send(payload, flags, copy=copy, track=track)
+    return memoryview(payload).nbytes
+
+def receive_array(socket, flags=0, copy=False, track=False, decoder=None, ring=None, meta=None) -> (int, ArrayLike):
+    """receive a numpy array, encoded frames need a FrameDecoder and frames in slots the FrameRing, throws exception on failure
+    arrays of ring slots are only valid until the slot is written again, the optional meta dict receives the header"""
     md = socket.recv_json(flags=flags)
+    if meta is not None:
+        meta.update(md)
     msg = socket.recv(flags=flags, copy=copy, track=track)
-    buf = memoryview(msg)
+    if 'slot' in md:
+        if ring is None:
+            raise Exception("Received shared memory frame without ring")
+        return (md['id'], ring.view(md['slot'], md['dtype'], md['shape']))
+    buf = msg.buffer if isinstance(msg, zmq.Frame) else memoryview(msg)
+    if 'codec' in md:
+        if decoder is None:
+            raise Exception("Received encoded frame without decoder")
+        return (md['id'], decoder.decode(md, buf))
     A = numpy.frombuffer(buf, dtype=md['dtype'])
     return (md['id'], A.reshape(md['shape']))
+
+
+def codecs() -> list:
+    """available compression codecs"""
+    return ['zlib'] + (['lz4'] if lz4 is not None else []) + (['zstd'] if zstd is not None else [])
+
+def compress(data, codec: str, level=None) -> bytes:
+    match codec:
+        case 'lz4':
+            return lz4.compress(data, compression_level=level if level is not None else 0)
+        case 'zstd':
+            return zstd.ZstdCompressor(level=level if level is not None else 1).compress(data)
+        case 'zlib':
+            return zlib.compress(data, level if level is not None else 1)
+    return data
+
+def decompress(data, codec: str):
+    match codec:
+        case 'lz4':
+            return lz4.decompress(data)
+        case 'zstd':
+            return zstd.ZstdDecompressor().decompress(data)
+        case 'zlib':
+            return zlib.decompress(data)
+    return data
+
+
+def xor(a: ArrayLike, b: ArrayLike) -> ArrayLike:
+    """bytewise XOR of two uint8 arrays, on 64 bit words when the size allows"""
+    if a.size % 8 == 0:
+        return numpy.bitwise_xor(a.view(numpy.uint64), b.view(numpy.uint64)).view(numpy.uint8)
+    return numpy.bitwise_xor(a, b)
+
+
+class FrameEncoder:
+    """encodes image frames: optional dtype conversion (e.g. float16), XOR delta against the previous frame of the same id and compression"""
+    def __init__(self, dtype=None, codec=None, delta=False, level=None):
+        self.dtype = numpy.dtype(dtype) if dtype is not None else None
+        self.codec = codec if codec in codecs() else None
+        self.delta = delta
+        self.level = level
+        self._previous = {}
+        self._seq = 0
+
+    def encode(self, id, A) -> (dict, Any):
+        data = numpy.ascontiguousarray(A, dtype=self.dtype if self.dtype is not None else A.dtype)
+        raw = data.reshape(-1).view(numpy.uint8)
+        self._seq += 1
+        md = dict(dtype=str(data.dtype), shape=data.shape, codec=self.codec, seq=self._seq)
+
+        payload = raw
+        if self.delta:
+            # Unchanged bytes turn into zeros that compress well, lossless for the sent dtype
+            ref_seq, ref = self._previous.get(id, (None, None))
+            if ref is not None and ref.shape == raw.shape:
+                payload = xor(raw, ref)
+                md['ref'] = ref_seq
+            self._previous[id] = (self._seq, raw.copy())
+        if self.codec is not None:
+            payload = compress(payload, self.codec, self.level)
+        return md, payload
+
+    def reset(self, id=None):
+        """next frames are sent without delta, e.g. after the receiver lost a frame"""
+        if id is None:
+            self._previous.clear()
+        elif id in self._previous:
+            del self._previous[id]
+
+class FrameDecoder:
+    """decodes frames of a FrameEncoder, keeps the last frame of each id for deltas"""
+    def __init__(self):
+        self._previous = {}
+
+    def decode(self, md: dict, buf) -> ArrayLike:
+        raw = numpy.frombuffer(decompress(buf, md['codec']), dtype=numpy.uint8)
+        if 'ref' in md:
+            ref_seq, ref = self._previous.get(md['id'], (None, None))
+            if ref_seq != md['ref']:
+                raise Exception(f"Missing reference frame {md['ref']} for delta of id {md['id']}")
+            raw = xor(raw, ref)
+        self._previous[md['id']] = (md['seq'], raw)
+        return raw.view(md['dtype']).reshape(md['shape'])
+
+
+def negotiate(request: dict) -> dict:
+    """picks the frame encoding for a client request with 'dtype', preferred 'codecs' and 'delta' from the local codecs"""
+    codec = next((codec for codec in request.get('codecs', []) if codec in codecs()), None)
+    return {'dtype': request.get('dtype'), 'codec': codec, 'delta': bool(request.get('delta', False))}
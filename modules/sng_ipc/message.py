@@ -47,7 +47,9 @@ class Command(Enum):
     RequestSequence = 61 # TODO: Split in RequestData/RequestImage and RequestRender?
     RequestCamera = 62 # TODO: Rename to RequestLive
     RequestRender = 63 # UNUSED!
+    RequestStatus = 64
     RequestStop = 65
+    RenderBatch = 66
     
     # Render Algorithmns
     GetRenderAlgorithms = 81
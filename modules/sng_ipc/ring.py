@@ -0,0 +1,66 @@
+import math
+import numpy
+from multiprocessing import shared_memory, resource_tracker
+from numpy.typing import ArrayLike
+
+# Frames in flight before a slot is overwritten
+RING_SLOTS = 3
+# Names of rings created by this process
+_owned = set()
+
+
+class FrameRing:
+    """preallocated frame slots in shared memory for clients on the same host, only slot indices are sent over zmq"""
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, slot_size: int, owner: bool):
+        self._shm = shm
+        self._slots = slots
+        self._slot_size = slot_size
+        self._owner = owner
+        self._next = 0
+
+    def Create(slot_size: int, slots: int = RING_SLOTS) -> 'FrameRing':
+        # Slots are aligned to 64 bytes
+        slot_size = math.ceil(slot_size / 64) * 64
+        shm = shared_memory.SharedMemory(create=True, size=slot_size * slots)
+        _owned.add(shm._name)
+        return FrameRing(shm, slots, slot_size, True)
+
+    def Attach(info: dict) -> 'FrameRing':
+        """attaches to the ring of another process, info is the dict of describe()"""
+        shm = shared_memory.SharedMemory(name=info['name'])
+        # Only the owner may unlink the memory, the resource tracker would remove it when another process exits
+        if not shm._name in _owned:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return FrameRing(shm, info['slots'], info['slot_size'], False)
+
+    def describe(self) -> dict:
+        return {'name': self._shm.name, 'slots': self._slots, 'slot_size': self._slot_size}
+
+    def fits(self, nbytes: int) -> bool:
+        return nbytes <= self._slot_size
+
+    def write(self, A: ArrayLike) -> int | None:
+        """copies the array into the next slot and returns its index, None if the array is too large"""
+        if not self.fits(A.nbytes):
+            return None
+        slot = self._next
+        self._next = (self._next + 1) % self._slots
+        numpy.copyto(self.view(slot, A.dtype, A.shape), A)
+        return slot
+
+    def view(self, slot: int, dtype, shape) -> ArrayLike:
+        """array on the slot memory, valid until the slot is written again"""
+        count = math.prod(shape)
+        return numpy.ndarray((count,), dtype=dtype, buffer=self._shm.buf, offset=slot * self._slot_size).reshape(shape)
+
+    def close(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # Views on the memory are still alive, the mapping is released with them
+                pass
+            if self._owner:
+                self._shm.unlink()
+                _owned.discard(self._shm._name)
+            self._shm = None
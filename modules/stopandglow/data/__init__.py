@@ -3,5 +3,7 @@ from .calibration import *
 from .pixbuf import *
 from .imgbuffer import *
 from .sequence import *
+from .sequencecache import *
 from .lightpos import *
 from .lpsequence import *
+from .framewriter import *
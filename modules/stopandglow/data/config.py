@@ -29,6 +29,10 @@ class Config:
             'capture_max_addr': 310,
             # Processing settings
             'hdri_rotation': 0.0,
+            # Memory budget in MiB for recently used sequences kept in memory
+            'sequence_cache': 4096,
+            # Render settings: Time budget in milliseconds for progressive rendering steps
+            'render_budget': 50,
         }
 
     def __init__(self, path=None):
@@ -67,6 +71,10 @@ class Config:
     
     def __getitem__(self, key):
         return self._config[key]
+    
+    def __setitem__(self, key, value):
+        self._config[key] = value
+        self._changed = True
 
     def __len__(self):
         return len(self._config)
@@ -0,0 +1,63 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import logging as log
+
+import numpy as np
+from numpy.typing import ArrayLike
+import cv2 as cv
+
+from .pixbuf import *
+from .imgbuffer import *
+
+# Maximum number of frames waiting for encoding before write() blocks
+FRAME_QUEUE_SIZE = 16
+VIDEO_FORMATS = {'mp4': 'mp4v', 'avi': 'MJPG', 'mov': 'mp4v'}
+
+
+class FrameWriter:
+    """Writes linear frames to an image sequence or a video file, encoding runs in worker threads while the next frames are rendered"""
+    def __init__(self, path, format='exr', fps=25, workers=4):
+        self._path = path
+        self._format = format.lower()
+        self._fps = fps
+        self._video = None
+        self._count = 0
+        self._pending = []
+        # Video frames have to be encoded in order
+        self._executor = ThreadPoolExecutor(max_workers=1 if self.isVideo() else workers)
+        Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+
+    def isVideo(self) -> bool:
+        return self._format in VIDEO_FORMATS
+
+    def write(self, frame: ArrayLike):
+        """Queues a linear float frame for encoding, errors of earlier frames are raised here"""
+        while len(self._pending) >= FRAME_QUEUE_SIZE or (len(self._pending) > 0 and self._pending[0].done()):
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(self.writeFrame, self._count, frame))
+        self._count += 1
+
+    def close(self):
+        """Waits for all frames and finishes the video file"""
+        for future in self._pending:
+            future.result()
+        self._pending.clear()
+        self._executor.shutdown()
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+        log.debug(f"Wrote {self._count} frames to {self._path}")
+
+    def writeFrame(self, index, frame: ArrayLike):
+        if self.isVideo():
+            if self._video is None:
+                self._video = cv.VideoWriter(f"{self._path}.{self._format}", cv.VideoWriter_fourcc(*VIDEO_FORMATS[self._format]), self._fps, (frame.shape[1], frame.shape[0]))
+            srgb = ImgBuffer(img=frame[..., 0:3], domain=ImgDomain.Lin).asDomain(ImgDomain.sRGB, no_taich=True).get()
+            self._video.write(cv.cvtColor(np.round(np.clip(srgb, 0, 1) * 255).astype(np.uint8), cv.COLOR_RGB2BGR))
+        else:
+            img_format = {'png': ImgFormat.PNG, 'jpg': ImgFormat.JPG}.get(self._format, ImgFormat.EXR)
+            img = ImgBuffer(img=frame, domain=ImgDomain.Lin)
+            if img_format != ImgFormat.EXR:
+                img = img.asDomain(ImgDomain.sRGB, no_taich=True)
+            ImgBuffer(path=f"{self._path}_{index:04d}", img=img.get(), domain=img.domain()).save(img_format)
@@ -10,17 +10,32 @@ from numpy.typing import ArrayLike
 import numpy as np
 import cv2 as cv
 import imageio
-import colour
-import colour.models as models
 import taichi as ti
-from ..utils.utils import logging_disabled
+from ..utils.utils import logging_disabled, LazyImport
 from ..utils import ti_base as tib
 from .pixbuf import *
-imageio.plugins.freeimage.download()
+
+colour = LazyImport('colour')
 
 IMAGE_DTYPE_FLOAT='float32'
 IMAGE_DTYPE_INT='uint8'
 
+# FreeImage library for EXR writing, fetched on first use
+_freeimage_available = None
+
+def FreeImageAvailable() -> bool:
+    """Makes sure the FreeImage library is available, downloads it if needed. Returns False when offline."""
+    global _freeimage_available
+    if _freeimage_available is None:
+        try:
+            # Only downloads when no local copy exists
+            imageio.plugins.freeimage.download()
+            _freeimage_available = True
+        except Exception as e:
+            log.warning(f"FreeImage library not available, writing EXR files with OpenCV ({str(e)})")
+            _freeimage_available = False
+    return _freeimage_available
+
 class ImgFormat(Enum):
     PNG = 0
     JPG = 1
@@ -168,12 +183,19 @@ class ImgBuffer:
             # Create folder
             Path(os.path.dirname(self._path)).mkdir(parents=True, exist_ok=True)
             self._from_file = True
+            use_freeimage = self._format == ImgFormat.EXR and FreeImageAvailable()
             
             with logging_disabled():
                 match self._format:
                     case ImgFormat.EXR:
                         img = self.asFloat().get()
-                        colour.write_image(img, self._path, bit_depth=IMAGE_DTYPE_FLOAT, method='Imageio')
+                        if use_freeimage:
+                            colour.write_image(img, self._path, bit_depth=IMAGE_DTYPE_FLOAT, method='Imageio')
+                        else:
+                            # OpenCV fallback, EXR support is enabled in the package init
+                            if img.ndim == 3:
+                                img = cv.cvtColor(img, cv.COLOR_RGBA2BGRA if img.shape[2] == 4 else cv.COLOR_RGB2BGR)
+                            cv.imwrite(self._path, img)
                     case _: # PNG and JPG
                         colour.write_image(self.asDomain(ImgDomain.sRGB).asInt().get(), self._path, bit_depth=IMAGE_DTYPE_INT, method='Imageio')
             log.debug(f"Saved image {self._path}")
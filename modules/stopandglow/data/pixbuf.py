@@ -4,8 +4,9 @@ from enum import Enum
 from numpy.typing import ArrayLike
 import numpy as np
 import cv2 as cv
-import colour
-import colour.models as models
+from ..utils.utils import LazyImport
+
+colour = LazyImport('colour') # Slow import, only needed for image I/O and conversions
 
 IMAGE_DTYPE_FLOAT='float32'
 IMAGE_DTYPE_INT='uint8'
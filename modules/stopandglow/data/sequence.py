@@ -27,6 +27,8 @@ class Sequence():
         # Frame list, additional frames and sequences
         self._frames = dict()
         self._preview = ImgBuffer()
+        # Mip levels of the preview and the image they were made from
+        self._pyramid = None
         self._data = {}
         
         # Metadata
@@ -108,6 +110,8 @@ class Sequence():
             else:
                 # Load folder as data sequence
                 data_seq = Sequence()
+                data_seq._metafile_name = os.path.join(p, 'meta.json')
+                data_seq.loadMeta()
                 data_seq.loadFolder(p)
                 self.setDataSequence(f, data_seq)
         
@@ -216,6 +220,16 @@ class Sequence():
 
     def getPreview(self) -> ImgBuffer:
         return self._preview
+    
+    def getPreviewLevel(self, level: int) -> ImgBuffer:
+        """Preview scaled down by 2^level, levels are kept until the preview changes"""
+        img = self._preview.get()
+        if self._pyramid is None or self._pyramid[0] is not img:
+            self._pyramid = (img, [img])
+        levels = self._pyramid[1]
+        while len(levels) <= level:
+            levels.append(imgutils.HalfSize(levels[-1]))
+        return ImgBuffer(img=levels[level], domain=self._preview.domain())
         
     def getKeyBounds(self):
         return [self._min, self._max]
@@ -284,6 +298,12 @@ class Sequence():
             
         return self
     
+    def nbytes(self) -> int:
+        """Memory of loaded frames, preview and data sequences"""
+        buffers = [img for img in list(self._frames.values()) + [self._preview] if img.hasImg()]
+        levels = sum(img.nbytes for img in self._pyramid[1][1:]) if self._pyramid is not None else 0
+        return sum(img.get().nbytes for img in buffers) + levels + sum(seq.nbytes() for seq in self._data.values())
+    
     
     ### Additional sequences and frames ###
     
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+import logging as log
+import json
+
+from .sequence import *
+
+
+class SequenceCache:
+    """Recently used sequences with their frames and data sequences (fitted coefficients, normals, ...)
+    The least recently used sequences are dropped when the loaded memory exceeds the budget"""
+    def __init__(self, budget: int = 0):
+        self._sequences = OrderedDict()
+        self._budget = budget
+
+    def Key(path: str, recipe: dict = {}, resolution=None) -> tuple:
+        """Cache key of footage path, the settings it was loaded and processed with and the resolution it is scaled to"""
+        return (path, json.dumps(recipe, sort_keys=True, default=str), tuple(resolution) if resolution is not None else None)
+
+    def Rescaled(key: tuple, resolution) -> tuple:
+        """Key of the same sequence after it was scaled to another resolution"""
+        return (key[0], key[1], tuple(resolution))
+
+    def setBudget(self, budget: int):
+        """Budget in bytes, the most recent sequence is always kept"""
+        self._budget = budget
+        self.trim()
+
+    def get(self, key) -> Sequence | None:
+        if not key in self._sequences:
+            return None
+        self._sequences.move_to_end(key)
+        return self._sequences[key]
+
+    def put(self, key, sequence: Sequence):
+        self._sequences[key] = sequence
+        self._sequences.move_to_end(key)
+        self.trim()
+
+    def move(self, key, new_key):
+        """Store a sequence under a new key, e.g. after it was converted in place"""
+        if key in self._sequences:
+            self._sequences[new_key] = self._sequences.pop(key)
+            self._sequences.move_to_end(new_key)
+
+    def remove(self, key):
+        if key in self._sequences:
+            del self._sequences[key]
+
+    def clear(self):
+        self._sequences.clear()
+
+    def nbytes(self) -> int:
+        return sum(sequence.nbytes() for sequence in self._sequences.values())
+
+    def trim(self):
+        # Sequences grow when frames are loaded lazily or data is added, sizes are taken on each trim
+        sizes = {key: sequence.nbytes() for key, sequence in self._sequences.items()}
+        total = sum(sizes.values())
+        while total > self._budget and len(self._sequences) > 1:
+            key, _ = self._sequences.popitem(last=False)
+            total -= sizes[key]
+            log.debug(f"Evicted sequence '{key[0]}' from cache, {total / 2**20:.0f} MiB in use")
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def __contains__(self, key):
+        return key in self._sequences
@@ -111,9 +111,12 @@ class Capture:
 
     def downloadSequence(self, name, keep=False):
         """Downloads sequence from camera"""
+        return self.mergeSequences(self.downloadSequences(name, keep))
+
+    def downloadSequences(self, name, keep=False) -> list:
+        """Downloads the sequences from camera, one per exposure for HDR video captures"""
         log.debug(f"Downloading sequence '{name}' to {self._config['seq_folder']}")
 
-        sequence = Sequence()
         if self._cam.isVideoMode():
             # For HDR, download single sequence and convert those to separate sequences to perform exposure bracketing
             if self._hdr_capture:
@@ -125,20 +128,19 @@ class Capture:
                 for i in range(1, self._config['hdr_bracket_num']):
                     sequences.append(Sequence.ContinueVideoSequence(sequences[i-1], os.path.join(self._config['seq_folder'], name+f"_{i}"), self._id_list, i)\
                         .convertSequence({'resolution': (1920, 1080)}))
-
-                # Get exposure times and merge
-                exposure_times = [1/float(expo.split("/")[1]) for expo in sequences[0].getMeta('exposures')]
-                blender = ExpoBlender()
-                blender.process(sequences, self._cal, {'exposure': exposure_times})
-                sequence = blender.get()
-
                 # Delete video file maybe? TODO
+                return sequences
                 
             # For SDR sequence, download video file
-            else:
-                sequence = self._cam.getVideoSequence(self._config['seq_folder'], name, self._id_list, config=self._config, keep=keep)
-        else:
-            sequence = self._cam.getSequence(self._config['seq_folder'], name, keep=keep)
-        
-        return sequence
-
+            return [self._cam.getVideoSequence(self._config['seq_folder'], name, self._id_list, config=self._config, keep=keep)]
+        return [self._cam.getSequence(self._config['seq_folder'], name, keep=keep)]
+
+    def mergeSequences(self, sequences: list) -> Sequence:
+        """Blends exposure brackets of downloadSequences(), runs kernels unlike the download itself"""
+        if not (self._cam.isVideoMode() and self._hdr_capture):
+            return sequences[0]
+        # Get exposure times and merge
+        exposure_times = [1/float(expo.split("/")[1]) for expo in sequences[0].getMeta('exposures')]
+        blender = ExpoBlender()
+        blender.process(sequences, self._cal, {'exposure': exposure_times})
+        return blender.get()
@@ -1,10 +1,13 @@
 from .rti import *
-from .neural import *
 
 from .exposureblend import *
 from .rgbstack import *
 from .lightstack import *
-from .depthestim import *
+from .photometric import *
+
+# Processors depending on torch are only imported when used
+NeuralRti = LazyProcessor('.neural', 'NeuralRti', 'nrti')
+DepthEstimator = LazyProcessor('.depthestim', 'DepthEstimator', 'depthestim')
 
 
 # PTM: Polynominal Texture Mapping
@@ -34,11 +37,15 @@ algorithms = {
     'nrti':    ('Neural RTI',                       NeuralRti,      {'bsdf': 'nrti'}),
     'nrti3d':  ('Neural RTI 3D',                    NeuralRti,      {'bsdf': 'nrti'}),
     'blend':   ('Light Blending',                   None,           {'bsdf': 'blend'}),
+    # Previews from the normal generator output
+    'normal':  ('Normal Preview Lambert',           None,           {'bsdf': 'normal'}),
+    'normalspec': ('Normal Preview Blinn-Phong',    None,           {'bsdf': 'normalspec'}),
 }
 
 generators = {
     # Generators without BSDF
-    'normal':       ('Normal generator',            RtiProcessor,           {'fitter': NormalFitter.__name__}),
+    'normal':       ('Normal generator',            PhotometricStereo,      {'output': 'normal'}),
+    'height':       ('Height from Normals',         PhotometricStereo,      {'output': 'height'}),
     'alpha':        ('Alpha Mask Generator',        LightstackProcessor,    {'mode': 'alpha'}),
     'alphadepth':   ('Alpha from Depth Generator',  DepthEstimator,         {'threshold': 0.3}),#TODO
     'depth':        ('Depth Estimator',             DepthEstimator,         {}),
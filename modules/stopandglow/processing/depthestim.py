@@ -2,6 +2,8 @@ import numpy as np
 from numpy.typing import ArrayLike
 import cv2 as cv
 import logging as log
+import hashlib
+from collections import OrderedDict
 from enum import StrEnum
 
 import torch
@@ -15,6 +17,10 @@ from .depth_anything.util.transform import Resize, NormalizeImage, PrepareForNet
 from ..data import *
 from ..utils import ti_base as tib
 from ..utils.utils import logging_disabled
+from ..utils.jobs import JobStep
+
+# Maximum number of depth maps kept in the result cache
+DEPTH_CACHE_SIZE = 32
 
 
 class DepthAnythingModels(StrEnum):
@@ -25,68 +31,166 @@ class DepthAnythingModels(StrEnum):
 class DepthEstimator(Processor):
     """Wrapper of the Depth-Anything framework"""
     name = "depthestim"
-    
+
+    # Models and results shared between all instances, processors are created for each command
+    _models = dict()
+    _cache = OrderedDict()
+
     def __init__(self):
         self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         if self.device.type == 'cuda':
             log.debug("CUDA acceleration for MiDaS enabled")
 
-        self.transform = Compose([
-            Resize(
-                width=518,
-                height=518,
-                resize_target=False,
-                keep_aspect_ratio=True,
-                ensure_multiple_of=14,
-                resize_method='lower_bound',
-                image_interpolation_method=cv.INTER_CUBIC,
-            ),
-            NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            PrepareForNet(),
-        ])
-        
         self.model = None
         self.model_type = ""
         self.sequence = Sequence()
-        
+
 
     def getDefaultSettings() -> dict:
-        return {'model': DepthAnythingModels.large, 'rgb': True}
-    
+        return {'model': DepthAnythingModels.large, 'rgb': True, 'batch_size': 4, 'input_size': 518, 'tiles': 1, 'precision': 'full'}
+
     def process(self, img_seq: Sequence, calibration: Calibration, settings: dict):
         self.sequence = Sequence()
-        
-        # Load model if not loaded already
-        new_model_type = GetSetting(settings, 'model', DepthAnythingModels.large)
-        if self.model is None or self.model_type != new_model_type:
-            self.model_type = new_model_type
-            with logging_disabled():
-                self.model = DepthAnything.from_pretrained(f'LiheYoung/depth_anything_{self.model_type}14').to(self.device).eval()
-        
+
+        # Settings
+        self.model_type = GetSetting(settings, 'model', DepthAnythingModels.large)
+        batch_size = max(1, GetSetting(settings, 'batch_size', 4, dtype=int))
+        input_size = GetSetting(settings, 'input_size', 518, dtype=int)
+        tiles = max(1, GetSetting(settings, 'tiles', 1, dtype=int))
+        half = GetSetting(settings, 'precision', 'full') == 'half'
+        channels = 3 if GetSetting(settings, 'rgb', True, dtype=bool) else 1
+
+        # Look up cached results first, only frames with unknown content are estimated
+        # Results of this call are kept locally, the cache can evict them before they are read
+        keys = dict()
+        depths = dict()
+        pending = []
         for id, frame in img_seq:
-            # Apply transform
-            w, h = frame.resolution()
-            frame = self.transform({'image': frame.get()[...,0:3]})['image']
-            frame = torch.from_numpy(frame).unsqueeze(0).to(self.device)
-            
-            # Run model
-            with torch.no_grad():
-                depth = self.model(frame)
-            
-            # Scale back and normalize
-            depth = F.interpolate(depth[None], (h, w), mode='bilinear', align_corners=False)[0, 0]
-            depth = (depth - depth.min()) / (depth.max() - depth.min())
-            # To numpy, add other channels
-            depth = depth.cpu().numpy()
-            if GetSetting(settings, 'rgb', True, dtype=bool):
-                depth = np.repeat(depth[..., np.newaxis], 3, axis=-1)
+            keys[id] = self.cacheKey(frame, input_size, tiles, half)
+            if keys[id] in DepthEstimator._cache:
+                DepthEstimator._cache.move_to_end(keys[id])
+                depths[id] = DepthEstimator._cache[keys[id]]
             else:
-                depth = np.repeat(depth[..., np.newaxis], 1, axis=-1)
-            
-            # Add to sequence
-            self.sequence.append(ImgBuffer(img=depth), id)
-        
+                pending.append((id, frame.get()[...,0:3]))
+        log.debug(f"Estimating depth for {len(pending)} of {len(keys)} frames")
+
+        if len(pending) > 0:
+            self.model = self.getModel(self.model_type)
+            transform = self.getTransform(input_size)
+            for i in range(0, len(pending), batch_size):
+                JobStep(i, len(pending))
+                batch = pending[i:i+batch_size]
+                for (id, _), depth in zip(batch, self.estimate([img for _, img in batch], transform, tiles, half)):
+                    depths[id] = depth
+                    self.cacheStore(keys[id], depth)
+
+        for id, _ in img_seq:
+            depth = depths[id]
+            # Add to sequence with requested amount of channels
+            self.sequence.append(ImgBuffer(img=np.repeat(depth[..., np.newaxis], channels, axis=-1)), id)
+
     def get(self) -> Sequence:
         return self.sequence
-        
-    
\ No newline at end of file
+
+
+    ## Model and inference
+    def getModel(self, model_type):
+        """Returns the model for the type, loading it only once per process"""
+        key = (model_type, self.device.type)
+        if not key in DepthEstimator._models:
+            log.info(f"Loading Depth-Anything model '{model_type}'")
+            with logging_disabled():
+                DepthEstimator._models[key] = DepthAnything.from_pretrained(f'LiheYoung/depth_anything_{model_type}14').to(self.device).eval()
+        return DepthEstimator._models[key]
+
+    def getTransform(self, input_size):
+        return Compose([
+            Resize(
+                width=input_size,
+                height=input_size,
+                resize_target=False,
+                keep_aspect_ratio=True,
+                ensure_multiple_of=14,
+                resize_method='lower_bound',
+                image_interpolation_method=cv.INTER_CUBIC,
+            ),
+            NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            PrepareForNet(),
+        ])
+
+    def estimate(self, images: list, transform, tiles=1, half=False) -> list:
+        """Estimates normalized depth for a list of images, tiles are aligned to the full frame estimation"""
+        depths = self.run(images, transform, half)
+        if tiles > 1:
+            depths = [self.refineTiled(img, depth, transform, tiles, half) for img, depth in zip(images, depths)]
+
+        # Normalize each frame to 0-1
+        return [((depth - depth.min()) / max(depth.max() - depth.min(), 1e-12)).astype(np.float32) for depth in depths]
+
+    def run(self, images: list, transform, half=False) -> list:
+        """Runs the model batched for images with matching resolutions"""
+        results = [None] * len(images)
+        # Group by resolution since the transform keeps the aspect ratio
+        groups = dict()
+        for i, img in enumerate(images):
+            groups.setdefault(img.shape[0:2], []).append(i)
+
+        for (h, w), indices in groups.items():
+            batch = np.stack([transform({'image': images[i]})['image'] for i in indices])
+            batch = torch.from_numpy(batch).to(self.device)
+
+            # Run model, reduced precision is float16 on GPUs and bfloat16 on CPUs
+            with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=torch.float16 if self.device.type == 'cuda' else torch.bfloat16, enabled=half):
+                depth = self.model(batch)
+
+            # Scale back
+            depth = F.interpolate(depth[:, None].float(), (h, w), mode='bilinear', align_corners=False)[:, 0]
+            for i, frame_depth in zip(indices, depth.cpu().numpy()):
+                results[i] = frame_depth
+        return results
+
+    def refineTiled(self, img: ArrayLike, depth: ArrayLike, transform, tiles, half=False) -> ArrayLike:
+        """Runs overlapping tiles in one batch and blends them after fitting scale and shift to the full frame depth"""
+        h, w = depth.shape
+        tile_h, tile_w = h // tiles, w // tiles
+        overlap_y, overlap_x = tile_h // 4, tile_w // 4
+
+        # Tile bounds with overlap
+        bounds = []
+        for ty in range(tiles):
+            for tx in range(tiles):
+                y0, x0 = max(0, ty*tile_h - overlap_y), max(0, tx*tile_w - overlap_x)
+                y1 = h if ty == tiles-1 else min(h, (ty+1)*tile_h + overlap_y)
+                x1 = w if tx == tiles-1 else min(w, (tx+1)*tile_w + overlap_x)
+                bounds.append((y0, y1, x0, x1))
+        tile_depths = self.run([img[y0:y1, x0:x1] for y0, y1, x0, x1 in bounds], transform, half)
+
+        accumulated = np.zeros_like(depth)
+        weights = np.zeros_like(depth)
+        for (y0, y1, x0, x1), tile in zip(bounds, tile_depths):
+            # Least squares scale and shift against the global estimation
+            reference = depth[y0:y1, x0:x1]
+            A = np.stack([tile.ravel(), np.ones(tile.size, dtype=tile.dtype)], axis=-1)
+            scale, shift = np.linalg.lstsq(A, reference.ravel(), rcond=None)[0]
+            # Linear ramp weights to blend overlapping areas
+            ramp_y = np.minimum(np.arange(1, y1-y0+1), np.arange(y1-y0, 0, -1))
+            ramp_x = np.minimum(np.arange(1, x1-x0+1), np.arange(x1-x0, 0, -1))
+            weight = np.outer(ramp_y, ramp_x).astype(depth.dtype)
+            accumulated[y0:y1, x0:x1] += (tile*scale + shift) * weight
+            weights[y0:y1, x0:x1] += weight
+
+        return accumulated / np.maximum(weights, 1e-12)
+
+
+    ## Result cache
+    def cacheKey(self, frame: ImgBuffer, input_size, tiles, half) -> str:
+        img = np.ascontiguousarray(frame.get()[...,0:3])
+        content = hashlib.blake2b(img.tobytes(), digest_size=16)
+        content.update(str(img.shape).encode())
+        return f"{self.model_type}_{input_size}_{tiles}_{'half' if half else 'full'}_{content.hexdigest()}"
+
+    def cacheStore(self, key, depth):
+        DepthEstimator._cache[key] = depth
+        while len(DepthEstimator._cache) > DEPTH_CACHE_SIZE:
+            DepthEstimator._cache.popitem(last=False)
+
@@ -9,6 +9,7 @@ import taichi.math as tm
 import taichi.types as tt
 from ...utils import *
 from ...utils import ti_base as tib
+from ...utils.jobs import JobStep
 
 from ...data.calibration import *
 from ...data.sequence import *
@@ -33,7 +34,8 @@ class PseudoinverseFitter(ABC):
         
         # Init coefficient field and copy data
         res_x, res_y = coefficient_seq.get(0).resolution()
-        self._coefficients = ti.Vector.field(n=3 if self._is_rgb else 1, dtype=ti.f32, shape=(len(coefficient_seq), res_y, res_x))
+        self.releaseCoefficients()
+        self._coefficients = tib.FieldPool.alloc(self.pixelType(), (len(coefficient_seq), res_y, res_x), zero=False)
         arr = np.stack([frame[1].get() for frame in coefficient_seq], axis=0)
         self._coefficients.from_numpy(arr)
         
@@ -81,17 +83,19 @@ class PseudoinverseFitter(ABC):
         
         coefficient_count = self.getCoefficientCount()
         res_x, res_y = img_seq.get(0).resolution()
-        self._coefficients = ti.Vector.field(n=3 if self._is_rgb else 1, dtype=ti.f32, shape=(coefficient_count, res_y, res_x))
+        self.releaseCoefficients()
+        self._coefficients = tib.FieldPool.alloc(self.pixelType(), (coefficient_count, res_y, res_x))
         
         # Image slices for memory reduction
         slice_length = res_y // slices
-        sequence_buf = ti.Vector.field(n=3 if self._is_rgb else 1, dtype=ti.f32, shape=(len(img_seq), slice_length, res_x))
+        sequence_buf = tib.FieldPool.alloc(self.pixelType(), (len(img_seq), slice_length, res_x), zero=False)
         for slice_count in range(res_y // slice_length):
             start = slice_count * slice_length
             end = min((slice_count+1) * slice_length, res_y)
             
             # Copy frames to buffer
             for i, id in enumerate(img_seq.getKeys()):
+                JobStep(slice_count * len(img_seq) + i, slices * len(img_seq))
                 if self._is_rgb:
                     tib.copyRgbToSequence(sequence_buf, i, img_seq[id].asDomain(self._domain, True).get()[start:end])
                 else:
@@ -100,7 +104,15 @@ class PseudoinverseFitter(ABC):
            
             # Compute coefficient slice
             computeCoefficientSlice(sequence_buf, self._coefficients, self._inverse, start) 
-        del sequence_buf
+        tib.FieldPool.release(sequence_buf)
+    
+    def pixelType(self):
+        return ti.types.vector(3 if self._is_rgb else 1, ti.f32)
+    
+    def releaseCoefficients(self):
+        """Returns the coefficient field to the pool for the next fitter, must be called on the Taichi thread"""
+        tib.FieldPool.release(self._coefficients)
+        self._coefficients = None
         
 
     def computeInverse(self, lights: dict):
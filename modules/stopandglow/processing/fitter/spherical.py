@@ -4,7 +4,6 @@ from ...utils import ti_base as tib
 
 from .pseudoinverse import PseudoinverseFitter
 
-import scipy
 import numpy as np
 
 import taichi as ti
@@ -28,31 +27,14 @@ class SHFitter(PseudoinverseFitter):
         return (self._degree + 1)**2
             
     def fillLightMatrix(self, line, lightpos: LightPosition):
-        #u, v = lightpos.getLL()
-        x, y, z = lightpos.getXYZ()
         lat, long = lightpos.getLL()
-        
-        for coeff_num in range(len(line)):
-            l = math.floor(math.sqrt(coeff_num))
-            m = coeff_num - l * (l + 1)
-            # l & m are parameters of the degree of the harmonics in the shape of:
-            # (0,0), (1,-1), (1,0), (1,1), (2,-2), (2,-1), ...
-            # scipy spherical harmonics are not rotated by 90° so doing this manually for m < 0
-            if self._clamp:
-                line[coeff_num] = max(0, scipy.special.sph_harm(m, l, long + (pi_by_2 if m < 0 else 0), pi_by_2-lat).real)
-            else:
-                line[coeff_num] = scipy.special.sph_harm(m, l, long + (pi_by_2 if m < 0 else 0), pi_by_2-lat).real
-        
+        # Real harmonics in the order (0,0), (1,-1), (1,0), (1,1), (2,-2), ..., same basis as the ShmBsdf
+        line[:] = ShBasis(pi_by_2-lat, long, len(line))
+        if self._clamp:
+            line[:] = np.maximum(line, 0)
 
     def calc(self, latlong, coefficients):
         lat, long = latlong[:,0],latlong[:,1]
-        val = coefficients[0]
-        for i in range(1, len(coefficients)):
-            l = math.floor(math.sqrt(i))
-            m = i - l * (l + 1)
-            # l & m are parameters of the degree of the harmonics in the shape of:
-            # (0,0), (1,-1), (1,0), (1,1), (2,-2), (2,-1), ...
-            # scipy spherical harmonics are not rotated by 90° so doing this manually for m < 0
-            val += scipy.special.sph_harm(m, l, long*np.pi + (pi_by_2 if m < 0 else 0), pi_by_2 - lat*pi_by_2).real * coefficients[i]
-            
-        return np.fmax(val, np.zeros(val.shape))
\ No newline at end of file
+        basis = ShBasis(pi_by_2 - lat*pi_by_2, long*np.pi, len(coefficients))
+        val = np.tensordot(coefficients, basis, axes=([0], [0]))
+        return np.fmax(val, np.zeros(val.shape))
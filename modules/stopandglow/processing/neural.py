@@ -1,3 +1,6 @@
+import os
+import math
+import tempfile
 import numpy as np
 from numpy.typing import ArrayLike
 import logging as log
@@ -16,64 +19,83 @@ from ..utils.utils import logging_disabled
 
 
 class NeuralRti(Processor):
-    """Wrapper of the Depth-Anything framework"""
-    name = "depth"
+    """Neural RTI autoencoder, trained on (pixel, light) samples streamed from the light stack"""
+    name = "nrti"
     
     def __init__(self):
         self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         if self.device.type == 'cuda':
-            log.debug("CUDA acceleration for MiDaS enabled")
+            log.debug("CUDA acceleration for Neural RTI enabled")
         
         self.model = None
         self.sequence = Sequence()
         
 
     def getDefaultSettings() -> dict:
-        return {}
+        return {'epochs': 30, 'batch_size': 256, 'batches': 4000, 'workers': 4, 'latent_dim': 9, 'decoder_width': 50}
     
     def process(self, img_seq: Sequence, calibration: Calibration, settings: dict):
         self.sequence = Sequence()
         
+        # Settings
+        epochs = GetSetting(settings, 'epochs', 30, dtype=int)
+        batch_size = GetSetting(settings, 'batch_size', 256, dtype=int)
+        batches = GetSetting(settings, 'batches', 4000, dtype=int)
+        workers = GetSetting(settings, 'workers', 4, dtype=int)
+        latent_dim = GetSetting(settings, 'latent_dim', 9, dtype=int)
+        decoder_width = GetSetting(settings, 'decoder_width', 50, dtype=int)
+        
+        # Write light stack to disk, it is memory-mapped by the data loader workers
+        log.debug("Preparing light stack")
+        stack_path = os.path.join(tempfile.gettempdir(), f"sng_lightstack_{os.getpid()}.npy")
+        directions = self.prepareData(img_seq, calibration, stack_path)
+        
         # Init model
-        num_lights = 50 #len(img_seq)
-        model = RtiAutoencoder(num_lights)
+        model = RtiAutoencoder(len(directions), latent_dim, decoder_width)
         with utils.logging_disabled():
             L.seed_everything(42)
 
-        # Loading the training dataset. We need to split it into a training and validation part
-        log.debug("Loading data")
-        dataset = self.prepareData(img_seq, calibration)
-        log.debug("Splitting data")
-        train_set, val_set = self.splitData(dataset)
-
-        # We define a set of data loaders that we can use for various purposes later.
-        train_loader = torch.utils.data.DataLoader(train_set, batch_size=256, shuffle=True, drop_last=True, pin_memory=True, num_workers=4)
-        val_loader = torch.utils.data.DataLoader(val_set, batch_size=256, shuffle=False, drop_last=False, num_workers=4)
+        # Training and validation samples are drawn from the same stack with different seeds
+        train_set = RtiStreamDataset(stack_path, directions, batch_size, batches, seed=42)
+        val_set = RtiStreamDataset(stack_path, directions, batch_size, max(1, batches // 10), seed=43)
+        # Datasets return full batches
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=None, pin_memory=True, num_workers=workers)
+        val_loader = torch.utils.data.DataLoader(val_set, batch_size=None, num_workers=workers)
         
         # Start training
         log.debug("Starting training")
         trainer = L.Trainer(
             accelerator="auto",
             devices=1,
-            max_epochs=30,
+            max_epochs=epochs,
             callbacks=[
                 #ModelCheckpoint(save_weights_only=True),
-                #GenerateCallback(self.getImages(dataset, 8), every_n_epochs=10),
                 #LearningRateMonitor("epoch"),
             ],
         )
         trainer.logger._default_hp_metric = None  # Optional logging argument that we don't need
-        trainer.fit(model, train_loader, val_loader)
-        # Test best model on validation set
-        val_result = trainer.test(model, dataloaders=val_loader, verbose=False)
-        log.info(f"Validation result {val_result}")
-
-        # Store data in image sequence and metadata
-        #self.sequence.append(ImgBuffer(img=depth), id)
+        try:
+            trainer.fit(model, train_loader, val_loader)
+            # Test best model on validation set
+            val_result = trainer.test(model, dataloaders=val_loader, verbose=False)
+            log.info(f"Validation result {val_result}")
+            
+            # Latent codes of all pixels for the decoder BSDF
+            log.debug("Encoding latent maps")
+            latents = self.encodeLatents(model, stack_path, img_seq.get(0).resolution())
+        finally:
+            os.remove(stack_path)
+        self.model = model
         
-        ## Run model
-        #with torch.no_grad():
-        #    depth = self.model(frame)
+        # Store latent maps with three channels per frame and the decoder weights as metadata
+        res_y, res_x = latents.shape[0:2]
+        for i in range(math.ceil(latent_dim/3)):
+            frame = np.zeros((res_y, res_x, 3), np.float32)
+            channels = latents[..., i*3:(i+1)*3]
+            frame[..., 0:channels.shape[-1]] = channels
+            self.sequence.append(ImgBuffer(img=frame, domain=ImgDomain.Lin), i)
+        self.sequence.setMeta('latent_dim', latent_dim)
+        self.sequence.setMeta('decoder', ExportDecoder(model.decoder))
 
         
     def get(self) -> Sequence:
@@ -81,71 +103,81 @@ class NeuralRti(Processor):
     
     
     ## Data methods
-    def prepareData(self, img_seq: Sequence, calibration: Calibration):
-        num_lights = 50 #len(img_seq)
+    def prepareData(self, img_seq: Sequence, calibration: Calibration, path) -> ArrayLike:
+        """Writes the linear light stack with shape (lights, pixels, 3) to path and returns the normalized light directions"""
+        lpseq = LpSequence(img_seq, calibration)
         res_x, res_y = img_seq.get(0).resolution()
-        datalen = num_lights * res_y*res_x
-
-        # Read all images into single buffer        
-        #allimgdata = np.zeros((num_lights, res_y*res_x * 3),np.float32)
-        #for i, id in enumerate(img_seq.getKeys()):
-        #    img = img_seq[id].asDomain(ImgDomain.Lin).get(trunk_alpha=True)
-        #    allimgdata[i, :] = np.ravel(img)
         
-        ## Build input and target tensors
-        # TODO: Unable to allocate 1.59 TiB for an array with shape (549504000, 795) and data type float32 WTF
-        #inputdata  = np.zeros((datalen, num_lights * 3), np.float32) # Pixel and direction data for encoder
-        lightdata  = np.zeros((datalen, 2), np.float32)  # Directions for all lights for decoder
-        targetdata = np.zeros((datalen, 3), np.float32)  # RGB pixel values of all lights
+        # Frames are written one after another, memory usage is independent of the light count
+        stack = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(lpseq), res_y*res_x, 3))
+        directions = np.zeros((len(lpseq), 2), np.float32)
+        for i, (id, img, lp) in enumerate(lpseq):
+            stack[i] = np.reshape(img.asDomain(ImgDomain.Lin).get(trunk_alpha=True), (res_y*res_x, 3))
+            directions[i] = lp.getZVecNorm()
+        stack.flush()
+        del stack
         
-        for i, id in enumerate(img_seq.getKeys()):
-            if i >= 50:
-                break
-            
-            # Fill target data
-            target_tmp = img_seq[id].asDomain(ImgDomain.Lin).get(trunk_alpha=True)
-            #target_tmp = np.reshape(allimgdata[i], (res_y*res_x, 3))
-            target_tmp = np.reshape(target_tmp, (res_y*res_x, 3))
-            targetdata[(res_y*res_x * i):(res_y*res_x * (i+1)),:] = target_tmp
-            
-            # Fill input data
-            #input_tmp = np.reshape(allimgdata, (num_lights, res_y*res_x, 3))
-            #input_tmp = np.transpose(input_tmp, (1, 0, 2))
-            #input_tmp = np.reshape(input_tmp, (res_y*res_x, num_lights * 3))
-            #inputdata[(res_y*res_x * i):(res_y*res_x*(i+1)), :] = input_tmp
-            
-            # Fill light data
-            ld = np.transpose(calibration[id].getZVecNorm())
-            lt = np.tile(ld, (res_y*res_x, 1))
-            lt = np.reshape(lt, (res_y*res_x, 2))
-            lightdata[(res_y*res_x * i):(res_y*res_x*(i+1)),:] = lt
-            
-            # Delete temp vars to free up memory
-            del target_tmp, ld, lt # input_tmp
-                    
-        # Converting numpy array to Tensor
-        #inputdata  = torch.from_numpy(intputdata).float()
-        lightdata  = torch.from_numpy(lightdata).float()
-        targetdata = torch.from_numpy(targetdata).float()
+        return directions
+    
+    def encodeLatents(self, model, stack_path, resolution, batch_size=65536) -> ArrayLike:
+        """Runs the encoder over all pixels of the light stack in batches"""
+        stack = np.load(stack_path, mmap_mode='r')
+        res_x, res_y = resolution
+        latents = np.zeros((res_y*res_x, model.hparams.latent_dim), np.float32)
+        encoder = model.encoder.to(self.device).eval()
         
-        ## Transformations applied to input image data
-        transform = transforms.Compose([transforms.Normalize((0.5,), (0.5,))])
-        #input_transformed = transform(intputdata) # transform(torch.from_numpy(intputdata).float())
-        #inputdata = torch.stack([transform(targetdata), lightdata]) # tensor size ..., C, H, W expected
-
+        with torch.no_grad():
+            for start in range(0, stack.shape[1], batch_size):
+                pixels = np.ascontiguousarray(np.transpose(stack[:, start:start+batch_size], (1, 0, 2)))
+                pixels = torch.from_numpy(pixels.reshape(len(pixels), -1)).to(self.device)
+                latents[start:start+len(pixels)] = encoder(pixels).cpu().numpy()
         
-        return torch.utils.data.TensorDataset(lightdata, targetdata) # TODO single dataset? what order of tensors?
+        return latents.reshape(res_y, res_x, -1)
 
-    def splitData(self, datasets):
-        # Split and return
-        train_set, val_set = torch.utils.data.random_split(datasets, [0.9, 0.1])
-        return train_set, val_set
-    
-    def getImages(self, dataset, num):
-        return torch.stack([dataset[i][0] for i in range(num)], dim=0)
 
+def ExportDecoder(decoder) -> list:
+    """Returns the weights and biases of all linear decoder layers as nested lists"""
+    layers = [module for module in decoder.modules() if isinstance(module, nn.Linear)]
+    return [{'weight': layer.weight.detach().cpu().tolist(), 'bias': layer.bias.detach().cpu().tolist()} for layer in layers]
+
+
+class RtiStreamDataset(torch.utils.data.IterableDataset):
+    """Samples batches of (pixel, light) pairs lazily from a memory-mapped light stack"""
+    def __init__(self, stack_path, directions: ArrayLike, batch_size=256, batches=1000, seed=0, blocks=8):
+        super().__init__()
+        self._stack_path = stack_path
+        self._directions = directions
+        self._batch_size = batch_size
+        self._batches = batches
+        self._seed = seed
+        # Pixels are read in contiguous blocks to keep file access sequential
+        self._blocks = max(1, min(blocks, batch_size))
+    
+    def __len__(self):
+        return self._batches
+    
+    def __iter__(self):
+        # Shard batches over data loader workers, each with its own random stream
+        worker = torch.utils.data.get_worker_info()
+        worker_id, worker_count = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        rng = np.random.default_rng([self._seed, worker_id])
+        
+        stack = np.load(self._stack_path, mmap_mode='r')
+        light_count, pixel_count, _ = stack.shape
+        block_length = min(self._batch_size // self._blocks, pixel_count)
         
+        for _ in range(worker_id, self._batches, worker_count):
+            # Values of all lights for the sampled pixels, shape (pixels, lights, 3)
+            starts = rng.integers(0, pixel_count - block_length + 1, self._blocks)
+            pixels = np.concatenate([stack[:, start:start+block_length] for start in starts], axis=1)
+            pixels = np.ascontiguousarray(np.transpose(pixels, (1, 0, 2)))
+            # One random light per pixel as reconstruction target
+            lights = rng.integers(0, light_count, len(pixels))
+            targets = pixels[np.arange(len(pixels)), lights]
+            
+            yield torch.from_numpy(pixels.reshape(len(pixels), -1)), torch.from_numpy(self._directions[lights]), torch.from_numpy(targets)
 
+        
 class RtiEncoder(nn.Module):
     def __init__(self, input_channels, latent_dim, act_fn: object):
         super().__init__()
@@ -178,8 +210,7 @@ class RtiDecoder(nn.Module):
         )
     
     def forward(self, x, light_direction):
-        x = self.linear(torch.concat((x, light_direction), -1)) # TODO -1?
-        x = x.reshape(x.shape[0], -1, 4, 4) # TODO
+        x = self.linear(torch.concat((x, light_direction), -1))
         x = self.net(x)
         return x
 
@@ -188,6 +219,7 @@ class RtiAutoencoder(L.LightningModule):
         self,
         light_count: int,
         latent_dim: int = 9,
+        decoder_width: int = 50,
         encoder_class: object = RtiEncoder,
         decoder_class: object = RtiDecoder,
         act_fn: object = nn.ELU,
@@ -199,22 +231,22 @@ class RtiAutoencoder(L.LightningModule):
         self.save_hyperparameters()
         # Creating encoder and decoder
         self.encoder = encoder_class(light_count*3, latent_dim, act_fn)
-        self.decoder = decoder_class(light_count*3, latent_dim, act_fn)
+        self.decoder = decoder_class(decoder_width, latent_dim, act_fn)
         # Example input array needed for visualizing the graph of the network
         #self.example_input_array = torch.zeros(2, light_count*3, width, height)
 
     def forward(self, lights_rgb, light_direction):
         """The forward function takes in an image and returns the reconstructed image."""
         z = self.encoder(lights_rgb)
-        x_hat = self.decoder(torch.concat((z, light_direction)))
+        x_hat = self.decoder(z, light_direction)
         return x_hat
 
     def _get_reconstruction_loss(self, batch):
-        """Given a batch of images, this function returns the reconstruction loss (MSE in our case)."""
-        x, y = batch  # We do not need the labels
-        x_hat = self.forward(y, x)
-        loss = F.mse_loss(x, x_hat, reduction="none")
-        loss = loss.sum(dim=[1, 2, 3]).mean(dim=[0])
+        """Given a batch of pixels, this function returns the reconstruction loss (MSE in our case)."""
+        lights_rgb, light_direction, target = batch
+        x_hat = self.forward(lights_rgb, light_direction)
+        loss = F.mse_loss(x_hat, target, reduction="none")
+        loss = loss.sum(dim=[1]).mean(dim=[0])
         return loss
 
     def configure_optimizers(self):
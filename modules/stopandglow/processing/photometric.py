@@ -0,0 +1,108 @@
+import logging as log
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+from .processor import *
+from ..data import *
+from ..utils.jobs import JobStep
+
+# Rec. 709 luminance weights, used to merge the per channel solutions into a single normal
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+class PhotometricStereo(Processor):
+    """Closed-form Lambertian photometric stereo with optional height integration"""
+    name = "photometric"
+
+    def __init__(self):
+        self._result = Sequence()
+        self._output = 'normal'
+
+    def getDefaultSettings() -> dict:
+        return {'output': 'normal', 'threshold': 0.00015, 'rgb': True}
+
+    def process(self, img_seq: Sequence, calibration: Calibration, settings={}):
+        self._result = Sequence()
+
+        # Settings
+        self._output = GetSetting(settings, 'output', 'normal')
+        threshold = GetSetting(settings, 'threshold', 0.00015, dtype=float)
+
+        # Only use lights in front of the object, same as the normal fitter
+        lpseq = LpSequence(img_seq, calibration)
+        lpseq.filter(lambda id, lp: lp.getXYZ()[1] > 0)
+        if len(lpseq) < 3:
+            log.error(f"Photometric stereo needs at least three lights, got {len(lpseq)}")
+            return
+        log.info(f"Solving photometric stereo with {len(lpseq)} lights")
+
+        # Light matrix in normal map space and its pseudoinverse (3 x light count)
+        lights = np.array([LightToNormalSpace(lp.getXYZ()) for _, _, lp in lpseq], dtype=np.float32)
+        inverse = np.linalg.pinv(lights).astype(np.float32)
+
+        # Accumulate scaled normals per color channel in a single pass over the frames: g = L^+ * I
+        res_x, res_y = img_seq.get(0).resolution()
+        scaled_normals = np.zeros((res_y, res_x, 3, 3), dtype=np.float32)
+        for i, (_, img, _) in enumerate(lpseq):
+            JobStep(i, len(lpseq))
+            pix = img.asDomain(ImgDomain.Lin).get(trunk_alpha=True)
+            scaled_normals += pix[..., np.newaxis] * inverse[:, i]
+
+        # Albedo is the length of the scaled normal, direction from the luminance solution
+        albedo = np.linalg.norm(scaled_normals, axis=-1)
+        scaled_lum = np.tensordot(LUMINANCE_WEIGHTS, scaled_normals, axes=([0], [2]))
+        length = np.linalg.norm(scaled_lum, axis=-1)
+        val_max = max(float(albedo.max()), 1e-12)
+        mask = length > val_max * threshold
+        normals = np.where(mask[..., np.newaxis], scaled_lum / np.maximum(length, 1e-12)[..., np.newaxis], np.array([0, 0, 1], dtype=np.float32))
+        del scaled_normals, scaled_lum
+
+        match self._output:
+            case 'normal':
+                alpha = np.repeat(mask[..., np.newaxis], 3, axis=-1).astype(np.float32)
+                self._result.append(ImgBuffer(img=(normals/2 + 0.5).astype(np.float32), domain=ImgDomain.Lin), 0)
+                self._result.append(ImgBuffer(img=(albedo/val_max).astype(np.float32), domain=ImgDomain.Lin), 1)
+                self._result.append(ImgBuffer(img=alpha, domain=ImgDomain.Lin), 2)
+                # Absolute albedo for shading with the normal BSDF
+                self._result.setMeta('albedo_scale', val_max)
+            case 'height':
+                log.debug("Integrating normals to height map")
+                height = FrankotChellappa(normals, mask)
+                # Normalize masked range to 0-1, closer is brighter like the depth estimator output
+                h_min, h_max = (height[mask].min(), height[mask].max()) if mask.any() else (0.0, 1.0)
+                height = np.where(mask, (height - h_min) / max(h_max - h_min, 1e-12), 0.0).astype(np.float32)
+                channels = 3 if GetSetting(settings, 'rgb', True, dtype=bool) else 1
+                self._result.append(ImgBuffer(img=np.repeat(height[..., np.newaxis], channels, axis=-1), domain=ImgDomain.Lin), 0)
+            case _:
+                log.error(f"Unknown output '{self._output}', use normal/height")
+
+    def get(self) -> Sequence:
+        # Metadata
+        self._result.setMeta('photometric_output', self._output)
+        return self._result
+
+
+def LightToNormalSpace(xyz) -> ArrayLike:
+    """Converts dome coordinates to normal map space: X to the right, Y up and Z towards the camera"""
+    return [xyz[0], xyz[2], -xyz[1]]
+
+def FrankotChellappa(normals: ArrayLike, mask: ArrayLike = None) -> ArrayLike:
+    """Integrates a normal map to a height map by projecting its gradients on the Fourier basis"""
+    nz = np.maximum(normals[..., 2], 1e-3)
+    # Surface gradients, rows are pointing downwards while the normal Y axis is pointing up
+    p = -normals[..., 0] / nz
+    q = normals[..., 1] / nz
+    if mask is not None:
+        p = np.where(mask, p, 0.0)
+        q = np.where(mask, q, 0.0)
+
+    # Least squares solution in the frequency domain
+    res_y, res_x = p.shape
+    wx, wy = np.meshgrid(np.fft.rfftfreq(res_x) * 2*np.pi, np.fft.fftfreq(res_y) * 2*np.pi)
+    denominator = wx**2 + wy**2
+    denominator[0, 0] = 1.0
+    z = (-1j*wx*np.fft.rfft2(p) - 1j*wy*np.fft.rfft2(q)) / denominator
+    z[0, 0] = 0.0 # Unknown height offset
+
+    return np.fft.irfft2(z, s=(res_y, res_x)).astype(np.float32)
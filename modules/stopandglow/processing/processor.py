@@ -1,4 +1,5 @@
 from enum import Enum
+import importlib
 import numpy as np
 
 from ..data import Sequence
@@ -14,3 +15,27 @@ class Processor:
         pass
     def get(self) -> Sequence:
         return Sequence()
+    def release(self):
+        """Frees fields and buffers after the result was taken"""
+        pass
+
+
+class LazyProcessor:
+    """Stand-in for processor classes with heavy dependencies, the module is imported on first use"""
+    def __init__(self, module: str, class_name: str, name: str):
+        self._module = module
+        self._class_name = class_name
+        self._class = None
+        # Processor name is available without importing the module
+        self.name = name
+    
+    def resolve(self):
+        if self._class is None:
+            self._class = getattr(importlib.import_module(self._module, __package__), self._class_name)
+        return self._class
+    
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+    
+    def __getattr__(self, key):
+        return getattr(self.resolve(), key)
@@ -25,6 +25,7 @@ class RtiProcessor(Processor):
     
     def initFitter(self, fitter, settings):
         """Initializes requested fitter instance"""
+        self.release()
         match fitter:
             case PolyFitter.__name__:
                 self._fitter = PolyFitter(settings)
@@ -91,3 +92,6 @@ class RtiProcessor(Processor):
         
         return Sequence()
     
+    def release(self):
+        if self._fitter:
+            self._fitter.releaseCoefficients()
@@ -1,8 +1,11 @@
-import multiprocessing
 import queue as Q
-from threading import Thread
+from threading import Thread, Condition, Lock
+from concurrent.futures import Future
+from collections import deque
+from enum import IntEnum
 import logging as log
 import time
+import json
 import zmq
 
 from sng_ipc import *
@@ -16,15 +19,129 @@ from .render import *
 from .viewer import *
 from .utils import ti_base as tib
 from .utils.utils import GetDatetimeNow
+from .utils.imgutils import LodLevel
+from .utils.jobs import *
+
+
+class Priority(IntEnum):
+    Interactive = 0
+    Batch = 1
+
+# Long running commands, interactive requests are served ahead of them
+BATCH_COMMANDS = [Commands.Process, Commands.Save, Commands.Capture, Commands.Calibrate, Commands.Quit]
+# Commands driving camera and lights, run on the hardware thread when they start a job
+HARDWARE_COMMANDS = [Commands.Capture, Commands.Preview, Commands.Lights]
+# Commands changing config, calibration or HDRI that hardware commands read, those queued earlier have to run first
+STATE_COMMANDS = [Commands.Config, Commands.Calibration, Commands.Calibrate, Commands.LoadHdri]
+# Commands that only set a state, only the latest of consecutive ones has to run (None for any argument)
+COALESCE_COMMANDS = {Commands.Lights: None, Commands.Preview: ['live'], Commands.Render: ['clear', 'reset', 'render', 'init', 'resize']}
+
+def CommandPriority(command: Commands, arg) -> Priority:
+    if command in BATCH_COMMANDS or (command == Commands.Render and arg == 'batch'):
+        return Priority.Batch
+    return Priority.Interactive
+
+def Redundant(queued, entry) -> bool:
+    """True if the queued command has no effect when the entry runs right after it"""
+    if queued[0] != entry[0] or queued[3] != entry[3] or not entry[0] in COALESCE_COMMANDS or isinstance(queued[2], Future):
+        return False
+    args = COALESCE_COMMANDS[entry[0]]
+    return args is None or (queued[1] == entry[1] and entry[1] in args)
+
+
+class CommandQueue:
+    """Blocking queue of (command, arg, settings, job_id) entries in priority lanes
+    The remaining commands of a started job come first, then the lanes by priority in order of arrival
+    Hardware commands can be taken ahead by a second thread, they stay queued with a Future in place of their settings"""
+    def __init__(self):
+        self._lanes = [deque() for _ in Priority]
+        self._running = None
+        self._condition = Condition()
+
+    def put(self, entries: list, priority: Priority) -> list:
+        """Appends the entries to the lane, returns queued entries that got merged into them"""
+        merged = []
+        with self._condition:
+            lane = self._lanes[priority]
+            for entry in entries:
+                if len(lane) > 0 and Redundant(lane[-1], entry):
+                    merged.append(lane.pop())
+                lane.append(entry)
+            self._condition.notify_all()
+        return merged
+
+    def get(self, block=True, timeout=None):
+        """Next entry, raises queue.Empty when none arrives in time"""
+        with self._condition:
+            if not self._condition.wait_for(self._size, timeout if block else 0):
+                raise Q.Empty
+            lanes = [lane for lane in self._lanes if len(lane) > 0]
+            lane = next((lane for lane in lanes if self._running is not None and lane[0][3] == self._running), lanes[0])
+            entry = lane.popleft()
+            self._running = entry[3]
+            return entry
+
+    def takeHardware(self, accept, timeout=None) -> (tuple, Future):
+        """First entry accepted by the callback that starts its job or has none, raises queue.Empty when none arrives in time
+        The entry is replaced by a Future for its result, the worker gets it in the original order"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._findHardware(accept) is not None, timeout):
+                raise Q.Empty
+            lane, index = self._findHardware(accept)
+            command, arg, settings, job_id = lane[index]
+            future = Future()
+            lane[index] = (command, arg, future, job_id)
+            return ((command, arg, settings, job_id), future)
+
+    def _findHardware(self, accept):
+        # Remaining commands of the started job run first
+        running = [entry for lane in self._lanes for entry in lane if self._running is not None and entry[3] == self._running]
+        if any(not isinstance(entry[2], Future) and entry[0] in STATE_COMMANDS for entry in running):
+            return None
+        for lane in self._lanes:
+            for index, entry in enumerate(lane):
+                command, arg, settings, job_id = entry
+                if isinstance(settings, Future) or (job_id is not None and job_id == self._running):
+                    continue
+                if accept(entry):
+                    return (lane, index)
+                # Earlier state changes and jobs that did not start yet keep their place before hardware commands
+                if job_id is not None or command in STATE_COMMANDS:
+                    return None
+        return None
+
+    def empty(self) -> bool:
+        with self._condition:
+            return self._size() == 0
+
+    def _size(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
 
 
 class ProcessingQueue:
     def __init__(self, context=None):
-        self._worker = Worker(context)
-        self._queue = multiprocessing.Queue(255)
+        self.jobs = JobTable()
+        self._worker = Worker(context, self.jobs)
+        self._queue = CommandQueue()
             
-    def putCommand(self, command: Commands, arg, settings={}):
-        self._queue.put((command, arg, settings))
+    def putCommand(self, command: Commands, arg, settings={}, job_id=None):
+        self._put([(command, arg, settings, job_id)], CommandPriority(command, arg))
+    
+    def putJob(self, job: Job) -> int:
+        """Registers the job and queues its commands, returns the job ID
+        Jobs with any batch command are queued as batch work"""
+        self.jobs.add(job)
+        entries = [(command, arg, settings, job.id) for command, arg, settings in job.commands]
+        self._put(entries, max([CommandPriority(command, arg) for command, arg, _, _ in entries], default=Priority.Interactive))
+        return job.id
+    
+    def _put(self, entries: list, priority: Priority):
+        for command, arg, _, job_id in self._queue.put(entries, priority):
+            log.debug(f"Merged redundant command '{command} {arg}'")
+            # Merged commands count as done for their job
+            job = self.jobs.get(job_id) if job_id is not None else None
+            if job is not None:
+                job.commandDone()
         
     def getConfig(self):
         return self._worker.getConfig()
@@ -38,17 +155,27 @@ class ProcessingQueue:
         self._worker.work(self._queue, False)
         
     def quit(self):
-        self._queue.put((Commands.Quit, ""))
+        self.putCommand(Commands.Quit, "")
         self._process.join()
         
         
 
 class Worker:
-    def __init__(self, context=None):
+    def __init__(self, context=None, jobs=None):
         # Setup processing queue
         self.config = None
-        self._consumer = None
+        self._consumer = self._encoder = self._ring = None
+        self._consumers = {}
+        self._encoders = {}
+        self._rings = {}
+        self._transports = {}
+        self._jobs = jobs if jobs is not None else JobTable()
         self._context = context if context is not None else zmq.Context()
+        # Camera and lights are used by one thread at a time
+        self._hw_lock = Lock()
+        self._hw_thread = None
+        # Renders sent at a coarse level by (address, id), full resolution follows when converged
+        self._upgrades = {}
                 
     def getConfig(self):
         return self.config
@@ -69,6 +196,9 @@ class Worker:
         self.hdri = ImgBuffer(path=os.path.join(self.config['hdri_folder'], self.config['hdri_name'])) # TODO: Default HDRI?
         self.img_buf = ImgBuffer.CreateEmpty(self.config['resolution'], True)
         self.path = ""
+        # Recently loaded sequences by path and load settings, the loaded key is None for captured sequences
+        self.sequences = SequenceCache(int(self.config['sequence_cache']) * 2**20)
+        self.loaded = None
         
         # Setup hardware
         self.cal = Calibration(path=os.path.join(self.config['cal_folder'], self.config['cal_name']))
@@ -77,28 +207,80 @@ class Worker:
                 
         # Rendering
         self.renderer = Renderer(BSDF(), self.config['resolution'])
+        
+        # Captures of queued jobs run while this thread processes
+        if self._keep_running:
+            self._hw_thread = Thread(target=Worker.hardwareLoop, args=(self, queue,))
+            self._hw_thread.start()
 
         while self._keep_running or not queue.empty():
             try:
-                command, arg, settings = queue.get_nowait()
-                if len(self.if_stack) > 0 and command == Commands.EndIf:
-                    self.if_stack.pop()
-                elif len(self.if_stack) == 0 or self.if_stack[-1]:
-                    self.processCommand(command, arg, settings)
+                # Wait for the next command, only poll while a progressive render is refining or frames wait for full resolution
+                command, arg, settings, job_id = queue.get(timeout=0 if self.renderer.refining() or len(self._upgrades) > 0 else None)
+                self.runCommand(command, arg, settings, self._jobs.get(job_id) if job_id is not None else None)
             except Q.Empty:
-                time.sleep(0.1)
+                # Keep refining progressive renders while idle
+                if self.renderer.refining():
+                    try:
+                        self.renderer.render(self.config['render_budget'])
+                    except Exception as e:
+                        log.error(f" Progressive rendering: {str(e)}")
+                        self.renderer.reset()
+                elif len(self._upgrades) > 0:
+                    try:
+                        self.sendUpgrades()
+                    except Exception as e:
+                        log.error(f" Sending full resolution frames: {str(e)}")
             except Exception as e:
                 log.error(f" Command '{command} {arg}': {str(e)}")
                 if not self._keep_running:
                     return False
         
+        if self._hw_thread is not None:
+            self._hw_thread.join()
+        
         # Delete important buffers explicitly to allow them to save all data
         # Otherwise, open() can be deleted before destructors can make use of the function (python bug)
+        self.sequences.clear()
         del self.sequence
         del self.hw
         del self.config
         
         return True
+    
+    def runCommand(self, command, arg, settings, job: Job = None):
+        if job is not None and job.cancelled():
+            # Skip remaining commands of cancelled jobs, the if stack stays balanced
+            if command == Commands.If:
+                self.if_stack.append(False)
+            elif command == Commands.EndIf and len(self.if_stack) > 0:
+                self.if_stack.pop()
+            job.commandDone()
+            return
+        
+        if job is not None and job.state == JobState.Queued:
+            job.state = JobState.Running
+        SetCurrentJob(job)
+        try:
+            if len(self.if_stack) > 0 and command == Commands.EndIf:
+                self.if_stack.pop()
+            elif len(self.if_stack) == 0 or self.if_stack[-1]:
+                if isinstance(settings, Future):
+                    # Hardware part ran on the hardware thread, wait for it
+                    self.finishHardware(command, arg, settings.result())
+                else:
+                    self.processCommand(command, arg, settings)
+        except JobCancelled as e:
+            log.info(str(e))
+        except Exception as e:
+            if job is not None:
+                job.cancel()
+                job.finish(JobState.Failed, str(e))
+            raise
+        finally:
+            SetCurrentJob(None)
+            if job is not None:
+                job.commandDone()
             
             
     def processCommand(self, command, arg, settings):
@@ -150,52 +332,23 @@ class Worker:
                         raise Exception(f"Unknown argument '{arg}' for --calibration command, use load/save")
 
             
-            case Commands.Preview:
-                # --preview live/baked
-                log.info(f"Capturing preview '{arg}'")
-                
-                settings = self.config.get() | settings
-                if arg == 'live':
-                    self.img_buf = self.hw.cam.capturePreview()
-                elif arg == 'baked': # TODO: Capture with camera preview
-                    capture = Capture(self.hw, self.cal, settings)
-                    capture.captureSequence(self.cal, self.hdri)
-                    baked_seq = capture.downloadSequence(name, keep=False)
-                    self.img_buf = self.process(baked_seq, 'rgbstack', {})[0]
-                else:
-                    raise Exception(f"Unknown argument '{arg}' for --preview command, use live/baked")
-
-
-            case Commands.Capture:
-                # --capture lights
-                log.info(f"Capturing sequence '{arg}'")
-                
-                if not arg in ['lights', 'all', 'baked']:
-                    raise Exception(f"Unknown argument '{arg}' for --capture command, use lights/all/baked")
-                
-                # Name and settings
-                name = GetSetting(settings, 'name', GetDatetimeNow()+f"_{arg}", default_for_empty=True)
-                settings = self.config.get() | settings
-                settings['seq_type'] = arg
-                
-                # Create capture object and capture
-                capture = Capture(self.hw, self.cal, settings)
-                capture.captureSequence(self.cal, self.hdri)
-                # Download
-                if arg != 'baked':
-                    self.sequence = capture.downloadSequence(name, keep=False)
-                else:
-                    # TODO!
-                    baked_seq = capture.downloadSequence(name, keep=False)
-                    stacked = self.process(baked_seq, 'rgbstack', {})
-                    self.sequence.setDataSequence('baked', stacked)
+            case Commands.Preview | Commands.Capture | Commands.Lights:
+                self.finishHardware(command, arg, self.hardwareCommand(command, arg, settings))
             
             
             case Commands.Load:
                 # --load <path> seq_type=<lights,baked,all>
-                # Check if sequence is already loaded
-                # TODO: keep n sequences in memory (?)
-                if not self.path == arg:
+                # Check if sequence is already loaded or still in the cache with its data
+                # Sequences are scaled on resize, only those at the configured resolution can be reused
+                key = SequenceCache.Key(arg, settings, [int(val) for val in self.config['resolution']])
+                self.sequences.setBudget(int(self.config['sequence_cache']) * 2**20)
+                if key != self.loaded and key in self.sequences:
+                    log.info(f"Using cached sequence '{arg}'")
+                    self.sequence = self.sequences.get(key)
+                    self.loaded = key
+                    # Renders of the previous sequence are outdated
+                    self.renderer.invalidate()
+                elif key != self.loaded:
                     self.path = arg
                     
                     log.info(f"Loading sequence '{arg}'")
@@ -240,6 +393,11 @@ class Worker:
                         blender = ExpoBlender()
                         blender.process(sequences, self.cal, {'exposure': exposure_times})
                         self.sequence = blender.get()
+                    
+                    self.sequences.put(key, self.sequence)
+                    self.loaded = key
+                    # Renders of the previous sequence are outdated
+                    self.renderer.invalidate()
 
             case Commands.LoadHdri:
                 # --loadHdri <path> folder=<path> rotation=0
@@ -307,6 +465,8 @@ class Worker:
                                 bsdf_class, bsdf_settings = bsdfs[algo_settings['bsdf']]
                                 bsdf = bsdf_class()
                                 bsdf.configure(self.cal, algo_key, bsdf_settings)
+                                # Free buffers and data of the previous renderer for reuse
+                                self.renderer.release()
                                 self.renderer = Renderer(bsdf, self.config['resolution'])
                                 # Set HDRI
                                 if self.hdri.get() is not None:
@@ -320,6 +480,22 @@ class Worker:
                                 log.error(f"Render configuration with bsdf '{algo_key}'")
                     case 'init':
                         self.renderer.initRender(hdri_samples=50, hdri_sample_steps=128) # TODO: Data
+                    case 'resize':
+                        # Apply the configured resolution, the loaded sequence and its data are scaled to match
+                        resolution = [int(val) for val in self.config['resolution']]
+                        if self.renderer.getResolution() != resolution:
+                            log.info(f"Changing render resolution to {resolution[0]}x{resolution[1]}")
+                            self.sequence.convertSequence({'resolution': resolution})
+                            for key in self.sequence.getDataKeys():
+                                self.sequence.getDataSequence(key).convertSequence({'resolution': resolution})
+                            if self.loaded is not None:
+                                # The cached entry now holds the scaled sequence
+                                rescaled = SequenceCache.Rescaled(self.loaded, resolution)
+                                self.sequences.move(self.loaded, rescaled)
+                                self.loaded = rescaled
+                            self.renderer.resize(resolution)
+                            if not self.renderer.loadSequence(self.sequence):
+                                log.error("Can't load BSDF data!")
                     case 'update': # TODO Implement in server
                         if not self.renderer.loadSequence(self.sequence):
                             log.error("Can't load BSDF data!")
@@ -339,7 +515,30 @@ class Worker:
                     case 'reset':
                         self.renderer.reset()
                     case 'render':
-                        self.renderer.sample() # TODO
+                        # Coarse result within the time budget, refined in idle time
+                        # Stops early when the level for the client resolution is done
+                        level = LodLevel(self.renderer.getResolution(), GetSetting(settings, 'resolution'))
+                        self.renderer.render(GetSetting(settings, 'budget', self.config['render_budget'], dtype=float), level)
+                    case 'batch':
+                        # --render batch rotations=36 name=turntable format=mp4|exr|png fps=25
+                        # Scenes as list of light lists or HDRI rotations starting at the current rotation
+                        if 'scenes' in settings:
+                            scenes = settings['scenes'] if not isinstance(settings['scenes'], str) else json.loads(settings['scenes'])
+                            frames = [{'lights': lights} for lights in scenes]
+                        else:
+                            count = GetSetting(settings, 'rotations', 36, dtype=int)
+                            rotation = self.renderer.getScene().getHdri().rotation
+                            frames = [{'rotation': (rotation + i / count) % 1.0} for i in range(count)]
+
+                        path = os.path.join(GetSetting(settings, 'folder', self.config['seq_folder']), GetSetting(settings, 'name', GetDatetimeNow()))
+                        log.info(f"Batch rendering {len(frames)} frames to '{path}'")
+                        writer = FrameWriter(path, GetSetting(settings, 'format', 'exr'), GetSetting(settings, 'fps', self.config['capture_fps'], dtype=int))
+                        try:
+                            for i, frame in enumerate(self.renderer.renderBatch(frames, GetSetting(settings, 'block_size', BATCH_BLOCK_SIZE, dtype=int))):
+                                JobStep(i, len(frames))
+                                writer.write(frame)
+                        finally:
+                            writer.close()
             
             case Commands.View:
                 # --view sequence/render/preview/live
@@ -389,54 +588,37 @@ class Worker:
                 
             case Commands.Send:
                 # --send address:port id=1 mode=render|baked|preview|live
-                if self._consumer is None:
-                    self.setConsumer(arg)
+                # Frames are sent at the coarsest mip level that covers the client resolution
+                self.selectConsumer(arg, settings)
                 
                 id = GetSetting(settings, 'id', 0)
                 mode = GetSetting(settings, 'mode', 'preview')
                 resolution = self.config['resolution']
-                try:
-                    depth = self.sequence.getDataSequence('depth')[0].r().get()
-                except:
-                    depth = None
+                level = LodLevel(resolution, GetSetting(settings, 'resolution'))
+                depth = self.getDepth()
                 
                 if mode == 'preview':
                     preview = self.sequence.getPreview()
                     if preview.resolution() != resolution:
                         # Scale to current resolution
                         preview.set(preview.rescale(resolution, crop=True).asDomain(ImgDomain.Lin).withAlpha(depth).get())
-                    self.sendImg(id, preview.get())
+                    self.sendImg(id, self.sequence.getPreviewLevel(level).get())
                 elif mode == 'baked':
                     self.sendImg(id, self.baked.withAlpha().get())
                 elif mode == 'render':
-                    rendered = ImgBuffer(img=self.renderer.get())
-                    self.sendImg(id, rendered.withAlpha(depth).get())
+                    level = LodLevel(self.renderer.getResolution(), GetSetting(settings, 'resolution'))
+                    rendered = ImgBuffer(img=self.renderer.get(level))
+                    self.sendImg(id, rendered.withAlpha(depth[::2**level, ::2**level] if depth is not None else None).get())
+                    if level > 0:
+                        self._upgrades[(arg, id)] = (self.renderer.cacheKey(), CurrentJob().id if CurrentJob() is not None else None, settings)
+                    else:
+                        self._upgrades.pop((arg, id), None)
                 elif mode == 'live':
-                    preview = self.hw.cam.capturePreview()
-                    self.sendImg(id, preview.rescale(resolution, crop=True).asFloat().withAlpha().get())
+                    with self._hw_lock:
+                        preview = self.hw.cam.capturePreview()
+                    self.sendImg(id, preview.rescale([resolution[0] >> level, resolution[1] >> level], crop=True).asFloat().withAlpha().get())
             
             
-            case Commands.Lights:
-                # --lights on power=0.5 range=0.2
-                log.info(f"Set Lights to '{arg}'")
-                
-                power = min(float(GetSetting(settings, 'power', 1/3)), 1.0)
-                amount = min(float(GetSetting(settings, 'amount', 1/3)), 1.0)
-                width = min(float(GetSetting(settings, 'width', 1/5)), 1.0)
-
-                match arg:
-                    case 'on'|'rand':
-                        if amount != 0:
-                            self.lightctl.setNth(round(1/amount), int(power*255))
-                        else:
-                            self.hw.lights.off()
-                    case 'top':
-                        self.lightctl.setTop(90-90*amount, int(power*255))
-                    case 'ring':
-                        self.lightctl.setRing(90-90*amount, 135*width, int(power*255))
-                    case 'off':
-                        self.hw.lights.off()
-            
             case Commands.Camera:
                 pass
                 
@@ -537,11 +719,125 @@ class Worker:
                 log.error(f"Unknown command '{command}'")
     
     
-    def setConsumer(self, address_string):
+    def hardwareLoop(self, queue):
+        """Takes hardware commands off the queue that start a job, the worker finishes them when it gets there"""
+        while self._keep_running:
+            try:
+                (command, arg, settings, job_id), future = queue.takeHardware(self.isHardware, timeout=0.5)
+            except Q.Empty:
+                continue
+            job = self._jobs.get(job_id) if job_id is not None else None
+            if job is not None and job.state == JobState.Queued:
+                job.state = JobState.Running
+            SetCurrentJob(job)
+            try:
+                future.set_result(self.hardwareCommand(command, arg, settings))
+            except Exception as e:
+                # Raised on the worker thread with the job
+                future.set_exception(e)
+            finally:
+                SetCurrentJob(None)
+    
+    def isHardware(self, entry) -> bool:
+        command, arg, settings, job_id = entry
+        job = self._jobs.get(job_id) if job_id is not None else None
+        return command in HARDWARE_COMMANDS and (job is None or not job.cancelled())
+    
+    def hardwareCommand(self, command, arg, settings):
+        """Drives camera and lights, returns the captured data for finishHardware()
+        Kernels and worker state are left to the worker thread"""
+        with self._hw_lock:
+            match command:
+                case Commands.Preview:
+                    # --preview live/baked
+                    log.info(f"Capturing preview '{arg}'")
+                    
+                    settings = self.config.get() | settings
+                    if arg == 'live':
+                        return self.hw.cam.capturePreview()
+                    elif arg == 'baked': # TODO: Capture with camera preview
+                        capture = Capture(self.hw, self.cal, settings)
+                        capture.captureSequence(self.cal, self.hdri)
+                        return (capture, capture.downloadSequences(GetDatetimeNow()+"_preview", keep=False))
+                    else:
+                        raise Exception(f"Unknown argument '{arg}' for --preview command, use live/baked")
+
+                case Commands.Capture:
+                    # --capture lights
+                    log.info(f"Capturing sequence '{arg}'")
+                    
+                    if not arg in ['lights', 'all', 'baked']:
+                        raise Exception(f"Unknown argument '{arg}' for --capture command, use lights/all/baked")
+                    
+                    # Name and settings
+                    name = GetSetting(settings, 'name', GetDatetimeNow()+f"_{arg}", default_for_empty=True)
+                    settings = self.config.get() | settings
+                    settings['seq_type'] = arg
+                    
+                    # Create capture object, capture and download
+                    capture = Capture(self.hw, self.cal, settings)
+                    capture.captureSequence(self.cal, self.hdri)
+                    return (capture, capture.downloadSequences(name, keep=False))
+                
+                case Commands.Lights:
+                    # --lights on power=0.5 range=0.2
+                    log.info(f"Set Lights to '{arg}'")
+                    
+                    power = min(float(GetSetting(settings, 'power', 1/3)), 1.0)
+                    amount = min(float(GetSetting(settings, 'amount', 1/3)), 1.0)
+                    width = min(float(GetSetting(settings, 'width', 1/5)), 1.0)
+
+                    match arg:
+                        case 'on'|'rand':
+                            if amount != 0:
+                                self.lightctl.setNth(round(1/amount), int(power*255))
+                            else:
+                                self.hw.lights.off()
+                        case 'top':
+                            self.lightctl.setTop(90-90*amount, int(power*255))
+                        case 'ring':
+                            self.lightctl.setRing(90-90*amount, 135*width, int(power*255))
+                        case 'off':
+                            self.hw.lights.off()
+        return None
+    
+    def finishHardware(self, command, arg, data):
+        """Applies the data of hardwareCommand() on the worker thread"""
+        match command:
+            case Commands.Preview:
+                if arg == 'live':
+                    self.img_buf = data
+                else:
+                    capture, sequences = data
+                    self.img_buf = self.process(capture.mergeSequences(sequences), 'rgbstack', {})[0]
+            case Commands.Capture:
+                capture, sequences = data
+                if arg != 'baked':
+                    self.sequence = capture.mergeSequences(sequences)
+                    self.loaded = None
+                else:
+                    # TODO!
+                    stacked = self.process(capture.mergeSequences(sequences), 'rgbstack', {})
+                    self.sequence.setDataSequence('baked', stacked)
+    
+    def setConsumer(self, address_string, transport={}):
+        # Close previous connection
+        if address_string in self._consumers:
+            self._consumers[address_string].close()
+            if address_string in self._rings:
+                self._rings.pop(address_string).close()
+        self._transports[address_string] = transport
+        
         # Open new socket to consumer
         address_str = f"tcp://{address_string}"
-        self._consumer = self._context.socket(zmq.REQ)
-        self._consumer.connect(address_str)
+        self._consumers[address_string] = self._context.socket(zmq.REQ)
+        self._consumers[address_string].connect(address_str)
+        # Frame encoding negotiated at init, raw frames by default
+        encoded = transport.get('dtype') is not None or transport.get('codec') is not None or transport.get('delta', False)
+        self._encoders[address_string] = FrameEncoder(transport.get('dtype'), transport.get('codec'), transport.get('delta', False)) if encoded else None
+        # Frames are written to shared memory for clients on the same host, larger frames are still sent
+        if 'shm' in transport:
+            self._rings[address_string] = FrameRing.Attach(transport['shm'])
         
     def process(self, img_seq, arg, settings):
         processor = None
@@ -571,8 +867,16 @@ class Worker:
                 processor = RtiProcessor()
             case LightstackProcessor.name:
                 processor = LightstackProcessor()
+            case PhotometricStereo.name:
+                processor = PhotometricStereo()
             case _:
-                log.error(f"Unknown processor type '{arg}'")
+                # Generator keys can be used directly, e.g. '--process depth'
+                if arg in generators:
+                    _, generator, generator_settings = generators[arg]
+                    processor = generator()
+                    settings = settings | generator_settings
+                else:
+                    log.error(f"Unknown processor type '{arg}'")
         
         # Processing
         if processor is not None:
@@ -595,18 +899,50 @@ class Worker:
                 case _:
                     log.warning(f"Processing target '{target}' not implemented")
                     
-            # Set data
+            # Set data, fields of the processor are released here on the worker thread
             data_seq = processor.get()
+            processor.release()
             if GetSetting(settings, 'destination', 'data') == 'data':
                 if len(data_seq) > 0:
                     img_seq.setDataSequence(seq_name, data_seq)
         return img_seq
 
     
-    def sendImg(self, id, img):
-        send_array(self._consumer, id, img)
+    def selectConsumer(self, address_string, settings):
+        # Reconnect when the client initialized again with another transport
+        transport = GetSetting(settings, 'transport', {})
+        if not address_string in self._consumers or self._transports[address_string] != transport:
+            self.setConsumer(address_string, transport)
+        self._consumer = self._consumers[address_string]
+        self._encoder = self._encoders[address_string]
+        self._ring = self._rings.get(address_string)
+    
+    def getDepth(self):
+        try:
+            return self.sequence.getDataSequence('depth')[0].r().get()
+        except:
+            return None
+    
+    def sendUpgrades(self):
+        """Sends renders that went out at a coarse level again in full resolution once the render of their scene converged"""
+        upgrades, self._upgrades = self._upgrades, {}
+        for (address_string, id), (key, version, settings) in upgrades.items():
+            # Scene changed in the meantime, a newer request follows
+            if key != self.renderer.cacheKey():
+                continue
+            self.selectConsumer(address_string, settings)
+            self.sendImg(id, ImgBuffer(img=self.renderer.get()).withAlpha(self.getDepth()).get(), version)
+    
+    def sendImg(self, id, img, version=None):
+        # Frames are versioned by the job that requested them
+        if version is None and CurrentJob() is not None:
+            version = CurrentJob().id
+        send_array(self._consumer, id, img, encoder=self._encoder, ring=self._ring, version=version)
         answer = receive(self._consumer)
         if answer.command != Command.RecvOkay:
+            # Frame was not applied, the next one can't be a delta
+            if self._encoder is not None:
+                self._encoder.reset(id)
             if answer.command == Command.RecvError:
                 log.error(f"Received error while sending image data: {answer.data['message']}")
 
@@ -4,6 +4,7 @@ from .lightblend import *
 from .ptm import *
 from .shm import *
 from .neural import *
+from .normal import *
 
 # key to bsdf class
 bsdfs = {
@@ -11,5 +12,7 @@ bsdfs = {
     'ptmz':    (PtmBsdf, {'coordinate_system': CoordSys.ZVec}),
     'shm':     (ShmBsdf, {}),
     'nrti':    (NeuralRtiBsdf, {}),
-    'blend':   (LightblendBsdf, {}),
+    'blend':   (LightblendBsdf, {'coordinate_system': CoordSys.LatLong}),
+    'normal':  (NormalBsdf, {'shading': 'lambert'}),
+    'normalspec': (NormalBsdf, {'shading': 'blinn-phong', 'specular': 0.2, 'shininess': 32}),
 }
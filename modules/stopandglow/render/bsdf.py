@@ -1,4 +1,5 @@
 import numpy as np
+from numpy.typing import ArrayLike
 
 import taichi as ti
 import taichi.math as tm
@@ -9,6 +10,9 @@ from ..data import *
 
 @ti.data_oriented
 class BSDF:
+    # Linear BSDFs are a weighted sum of basis functions with per pixel coefficients
+    linear = False
+    
     def __init__(self):
         self.coord_sys = CoordSys.LatLong
     
@@ -20,6 +24,54 @@ class BSDF:
     def load(self, sequence: Sequence) -> bool:
         return True
     
+    def allocField(self, dtype, shape):
+        """Field for BSDF data that is returned to the pool on release"""
+        if not hasattr(self, '_fields'):
+            self._fields = []
+        field = tib.FieldPool.alloc(dtype, shape, zero=False)
+        self._fields.append(field)
+        return field
+    
+    def release(self, reuse=True):
+        """Frees the loaded data, the BSDF has to be loaded again before rendering.
+        Fields are returned to the pool for reuse or destroyed when this instance loads new data."""
+        for field in getattr(self, '_fields', []):
+            if reuse:
+                tib.FieldPool.release(field)
+            else:
+                tib.FieldPool.free(field)
+        self._fields = []
+    
     @ti.func
     def sample(self, x: ti.i32, y: ti.i32, n1: ti.f32, n2: ti.f32) -> tib.pixvec:
         return [0, 0, 0]
+
+
+class LinearBSDF(BSDF):
+    """BSDF with coefficient planes in '_coeff', lights with the same direction for all pixels can be summed up in its basis"""
+    linear = True
+    
+    def basis(self, u: float, v: float) -> ArrayLike:
+        """Evaluates the basis functions for a light direction on the host, returns an array with one value per coefficient"""
+        return np.zeros(self._coeff.shape[0], dtype=np.float32)
+    
+    def getCoefficients(self) -> ArrayLike:
+        """Coefficient planes as array with shape (coefficients, height, width, 3)"""
+        return self._coeff.to_numpy()
+    
+    @ti.func
+    def sampleWeighted(self, x: ti.i32, y: ti.i32, weights: ti.template()) -> tib.pixvec:
+        # Dot product of coefficients and the weighted basis sum
+        rgb = tib.pixvec(0.0)
+        for i in range(self._coeff.shape[0]):
+            rgb += self._coeff[i, y, x] * weights[i]
+        return tm.max(rgb, 0.0)
+    
+    @ti.func
+    def sampleWeightedBatch(self, x: ti.i32, y: ti.i32, weights: ti.template(), frames: ti.template(), count: ti.i32):
+        # Weights of multiple frames, the coefficients of the pixel stay cached for all frames
+        for f in range(count):
+            rgb = tib.pixvec(0.0)
+            for i in range(self._coeff.shape[0]):
+                rgb += self._coeff[i, y, x] * weights[f, i]
+            frames[f, y, x] = tm.max(rgb, 0.0)
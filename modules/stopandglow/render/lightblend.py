@@ -3,7 +3,6 @@ import logging as log
 import numpy as np
 from numpy.typing import ArrayLike
 import math
-import cv2 as cv
 
 import taichi as ti
 import taichi.math as tm
@@ -15,184 +14,125 @@ from ..data import *
 from .bsdf import *
 
 
-@ti.dataclass
-class LightblendBsdf:
-    def __init__(self):
-        pass
-    
+class LightblendBsdf(BSDF):
+    """Image based relighting: Blends the captured frames of the closest calibrated lights"""
+
     def load(self, sequence: Sequence) -> bool:
+        lpseq = LpSequence(sequence, self._cal)
+        if len(lpseq) == 0:
+            log.error("Light blending needs a light sequence with matching calibration")
+            return False
+
+        # Settings
+        self.coord_sys = GetSetting(self._settings, 'coordinate_system', CoordSys.LatLong)
+        count = min(GetSetting(self._settings, 'closest_light_count', 4, dtype=int), len(lpseq))
+        grid_x, grid_y = GetSetting(self._settings, 'grid_resolution', (256, 128))
+        # 8 bit sRGB frames are kept as bytes to fit hundreds of lights in memory, float and linear frames as half to keep HDR values
+        first = next(iter(lpseq))[1]
+        byte_input = first.get().dtype == np.uint8 and first.domain() == ImgDomain.sRGB
+        self._storage = GetSetting(self._settings, 'storage', 'byte' if byte_input else 'half')
+        dtype = ti.u8 if self._storage == 'byte' else ti.f16
+        if self._storage == 'byte' and not byte_input:
+            log.warning("Storing float or linear frames as 8 bit sRGB for light blending, highlights above 1.0 are clipped")
+
+        # Frames
+        res_x, res_y = first.resolution()
+        log.info(f"Loading {len(lpseq)} frames for light blending ({len(lpseq)*res_x*res_y*3*(1 if dtype == ti.u8 else 2) / 2**30:.2f} GiB)")
+        self._frames = self.allocField(dtype, (len(lpseq), res_y, res_x, 3))
+        light_xyz = []
+        for i, (_, img, lp) in enumerate(lpseq):
+            frame = img.get()[..., 0:3]
+            if self._storage == 'byte':
+                if frame.dtype != np.uint8 or img.domain() != ImgDomain.sRGB:
+                    frame = np.round(np.clip(LinearToSrgb(FrameToLinear(img)), 0, 1) * 255).astype(np.uint8)
+                self.copyFrame(i, np.ascontiguousarray(frame))
+            else:
+                self.copyFrame(i, np.ascontiguousarray(FrameToLinear(img)))
+            light_xyz.append(lp.getXYZ())
+
+        # Lookup table for sRGB decoding
+        self._srgb_lut = self.allocField(ti.f32, (256,))
+        self._srgb_lut.from_numpy(SrgbToLinear(np.arange(256, dtype=np.float32) / 255))
+
+        # Direction grid with closest lights and weights
+        ids, weights = ClosestLightGrid(np.array(light_xyz, dtype=np.float32), self.coord_sys, (grid_y, grid_x), count)
+        self._grid_ids = self.allocField(ti.i32, ids.shape)
+        self._grid_weights = self.allocField(ti.f32, weights.shape)
+        self._grid_ids.from_numpy(ids)
+        self._grid_weights.from_numpy(weights)
         return True
-    
+
+    @ti.kernel
+    def copyFrame(self, index: ti.i32, frame: tt.ndarray(ndim=3)):
+        for y, x, c in ti.ndrange(self._frames.shape[1], self._frames.shape[2], 3):
+            self._frames[index, y, x, c] = ti.cast(frame[y, x, c], self._frames.dtype)
+
+    @ti.func
+    def sample(self, x: ti.i32, y: ti.i32, u: ti.f32, v: ti.f32) -> tib.pixvec:
+        # Grid cell of the light direction
+        grid_y, grid_x = self._grid_ids.shape[0], self._grid_ids.shape[1]
+        cell_y, cell_x = 0, 0
+        if self.coord_sys.value == CoordSys.LatLong.value:
+            cell_y, cell_x = ti.cast((1-u) / 2 * grid_y, ti.i32), ti.cast((v+1) / 2 * grid_x, ti.i32)
+        else: # self.coord_sys.value == CoordSys.ZVec.value
+            cell_y, cell_x = ti.cast((v+1) / 2 * grid_y, ti.i32), ti.cast((u+1) / 2 * grid_x, ti.i32)
+        cell_y, cell_x = tm.clamp(cell_y, 0, grid_y-1), tm.clamp(cell_x, 0, grid_x-1)
+
+        # Weighted sum of the closest lights
+        rgb = tib.pixvec(0.0)
+        for i in range(self._grid_ids.shape[2]):
+            rgb += self.fetch(self._grid_ids[cell_y, cell_x, i], y, x) * self._grid_weights[cell_y, cell_x, i]
+        return rgb
+
     @ti.func
-    def sample(self, x: ti.i32, y: ti.i32, n1: ti.f32, n2: ti.f32) -> tib.pixvec:
-        return [0, 1, 0]
-    
-#    # Loading, processing etc.
-#    def load(self, sequence: Sequence, calibration: Calibration, settings={}):
-#        # Init Taichi fields
-#        res_x, res_y = (1024, 512)
-#        self._data_id = ti.field(dtype=ti.i16, shape=(res_y, res_x, count))
-#        self._data_dist = ti.field(dtype=ti.f32, shape=(res_y, res_x, count))
-#
-#        # Load metadata
-#        self._latlong_min = rti_seq.getMeta('latlong_min', (0, 0))
-#        self._latlong_max = rti_seq.getMeta('latlong_max', (1, 1))
-#    
-#    def sample(self) -> Sequence:
-#        seq = Sequence()
-#        
-#        # Metadata
-#        seq.setMeta('latlong_min', self._latlong_min)
-#        seq.setMeta('latlong_max', self._latlong_max)
-#        
-#        return seq
-#    
-#    def process(self, img_seq: Sequence, calibration: Calibration, settings={'resolution': (1024, 512), 'closest_light_count': 6}):
-#        # Create fields and arrays
-#        res_x, res_y = settings['resolution'] if 'resolution' in settings else (1024, 512)
-#        count = settings['closest_light_count'] if 'closest_light_count' in settings else 6
-#        self._data_idx = ti.field(dtype=ti.i32, shape=(res_y, res_x, count))
-#        self._data_dist = ti.field(dtype=ti.f32, shape=(res_y, res_x, count))
-#        
-#        # Light calibration values
-#        light_coords = ti.ndarray(dtype=tt.vector(2, ti.f32), shape=(len(calibration)))
-#        light_coords.from_numpy(np.array([utils.LatlongRadians(latlong) for latlong in calibration.getPositions()], dtype=np.float32))
-#        self._light_ids = calibration.getIds()
-#        
-#        # Calculate
-#        FindClosestLights(self._data_idx, self._data_dist, light_coords)
-#        
-#        # Get coordinate bounds
-#        self._latlong_min, self._latlong_max = calibration.getCoordBounds()
-#        self._latlong_min = utils.NormalizeLatlong(self._latlong_min)
-#        self._latlong_max = utils.NormalizeLatlong(self._latlong_max)
-#        
-#        self.setSequence(img_seq)
-#    
-#    def setSequence(self, img_seq: Sequence):
-#        slices = 1
-#        self._img_seq = img_seq
-#        self._res_x, self._res_y = img_seq.get(0).resolution()
-#        
-#        # Convert to linear float
-#        for id, img in self._img_seq:
-#            self._img_seq[id] = img.asDomain(ImgDomain.Lin, as_float=True)
-#            
-#        # Calculate values for image slicing
-#        self._slice_length = self._res_y // slices # TODO
-#        self._seq_slice = ti.Vector.field(n=3, dtype=ti.f32, shape=(len(self._img_seq), self._slice_length, self._res_x))
-#
-#        for i, id in enumerate(self._light_ids): # TODO
-#            #if id in self._img_seq:
-#            tib.copyFrameToSequence(self._seq_slice, i, self._img_seq[id].get())        
-#
-#        
-#    # Render settings
-#    def getRenderModes(self) -> list:
-#        return ("SingleLight", "HDRI")
-#    
-#    def getRenderSettings(self, render_mode) -> RenderSettings:
-#        match render_mode:
-#            case 0: # SingleLight
-#                return RenderSettings(is_linear=True, needs_coords=True)
-#            case 1: # HDRI
-#                return RenderSettings(is_linear=True, needs_coords=True)
-#    
-#    def setCoords(self, u, v):
-#        self._u = self._latlong_min[0] + (self._latlong_max[0]-self._latlong_min[0]) * u
-#        self._v = self._latlong_min[1] + (self._latlong_max[1]-self._latlong_min[1]) * v
-#        self._rot = v
-#
-#    
-#    def render(self, render_mode, buffer, hdri=None):
-#        # Image slices for memory reduction
-#        for slice_count in range(self._res_y // self._slice_length):
-#            start = slice_count*self._slice_length
-#            end = min((slice_count+1)*self._slice_length, self._res_y)    
-#            
-#            # Copy frames to buffer
-#            #for i, id in enumerate(self._light_ids):
-#            #    #if id in self._img_seq:
-#            #    tib.copyFrameToSequence(self._seq_slice, i, self._img_seq[id].get()[start:end])        
-#
-#            match render_mode:
-#                case 0: # SingleLight
-#                    #trti.sampleLight(buffer, self._rti_factors, self._u, self._v)
-#                    sampleLight(buffer, self._seq_slice, start, self._u, self._v, self._data_idx) # self._data_distance, 0.5
-#                    pass
-#                case 1: # HDRI
-#                    #self.renderHdri(hdri, self._rot)
-#                    pass
-#        
-#
-#    def renderLight(self, light_pos) -> ImgBuffer:
-#        # Init Taichi field
-#        pixels = ti.ndarray(tib.pixarr, (self._res_y, self._res_x))
-#        
-#        u, v = utils.NormalizeLatlong(light_pos)
-#        #trti.sampleLight(pixels, self._rti_factors, u, v)
-#        
-#        return ImgBuffer(img=pixels.to_numpy(), domain=ImgDomain.Lin)
-#    
-#    def renderHdri(self, hdri, rotation) -> ImgBuffer:
-#        # Init Taichi field
-#        pixels = ti.ndarray(tib.pixarr, (self._res_y, self._res_x))
-#
-#        #trti.sampleHdri(pixels, self._rti_factors, hdri, rotation)
-#        
-#        return ImgBuffer(img=pixels.to_numpy(), domain=ImgDomain.Lin)
-#
-#
-#@ti.kernel
-#def sampleLight(pix: tib.pixarr, seq_slice: ti.template(), start: ti.i32, u: ti.f32, v: ti.f32, data_idx: ti.template()):#, data_dist: ti.template(), radius: ti.f32):
-#    u_coord = ti.int32(data_idx.shape[0] * u)
-#    v_coord = ti.int32(data_idx.shape[1] * v)
-#    i = data_idx[u_coord, v_coord, 0]
-#    print(u, v, i)
-#    for y, x in ti.ndrange(seq_slice.shape[1], seq_slice.shape[2]):
-#        # Single light code
-#        pix[start+y, x] = seq_slice[i, y, x]
-#    
-#@ti.kernel
-#def FindClosestLights(data_idx: ti.template(), data_dist: ti.template(), light_coords: ti.types.ndarray(dtype=tt.vector(2, ti.f32), ndim=1)):
-#    data_count = data_idx.shape[2]
-#    light_count = light_coords.shape[0]
-#    res_y, res_x = (data_idx.shape[0], data_idx.shape[1])
-#    # Reset data
-#    for y, x, l in data_idx:
-#        data_idx[y,x,l] = ti.i16(-1)
-#        data_dist[y,x,l] = tm.pi # Maximum distance possible
-#    
-#    # Iterate over environment map pixels and calculate latlong coordinates of position
-#    for y, x in ti.ndrange(res_y, res_x):
-#        latlong = tt.vector(2, ti.f32)([(y/res_y-0.5)*tm.pi, x/res_x*tm.pi*2])
-#        
-#        # Iterate over lights and calculate distance
-#        for i in range(light_count):
-#            distance = CalcDistance(latlong, light_coords[i])
-#            # Iterate over light seats (?) backwards
-#            for l in range(1, data_count+1):
-#                idx = data_count-l
-#                if data_dist[y, x, idx] > distance:
-#                    # Move value to right if current element is not at the end
-#                    if l != 1:
-#                        data_dist[y, x, idx+1] = data_dist[y, x, idx]
-#                        data_idx[y, x, idx+1] = data_idx[y, x, idx]
-#                    # Set current value
-#                    data_dist[y, x, idx] = distance
-#                    data_idx[y, x, idx] = ti.i16(i)
-#                else:
-#                    # No more bigger distances
-#                    break
-#            
-#    
-#    
-#@ti.func
-#def CalcDistance(latlong1: tt.vector(2, ti.f32), latlong2: tt.vector(2, ti.f32)):
-#    dlat = latlong2[0] - latlong1[0]
-#    dlon = latlong2[1] - latlong1[1]
-#    a = (tm.sin(dlat/2))**2 + tm.cos(latlong1[0]) * tm.cos(latlong2[0]) * (tm.sin(dlon/2))**2
-#    return 2 * tm.atan2(tm.sqrt(a), tm.sqrt(1-a)) # c
-#    # distance = R * c
-#
-#
\ No newline at end of file
+    def fetch(self, index: ti.i32, y: ti.i32, x: ti.i32) -> tib.pixvec:
+        rgb = tib.pixvec(0.0)
+        for c in ti.static(range(3)):
+            if ti.static(self._storage == 'byte'):
+                rgb[c] = self._srgb_lut[ti.cast(self._frames[index, y, x, c], ti.i32)]
+            else:
+                rgb[c] = ti.cast(self._frames[index, y, x, c], ti.f32)
+        return rgb
+
+
+def SrgbToLinear(val: ArrayLike) -> ArrayLike:
+    return np.where(val > 0.04045, ((val+0.055) / 1.055)**2.4, val / 12.92).astype(np.float32)
+
+def LinearToSrgb(val: ArrayLike) -> ArrayLike:
+    return np.where(val > 0.0031308, 1.055 * np.maximum(val, 0)**(1/2.4) - 0.055, val * 12.92).astype(np.float32)
+
+def FrameToLinear(img: ImgBuffer) -> ArrayLike:
+    frame = img.asFloat().get()[..., 0:3]
+    return SrgbToLinear(frame) if img.domain() == ImgDomain.sRGB else frame
+
+def GridDirections(coord_sys: CoordSys, resolution) -> ArrayLike:
+    """Unit vectors of the grid cell centers for normalized LatLong or ZVec coordinates"""
+    res_y, res_x = resolution
+    rows = (np.arange(res_y, dtype=np.float32)+0.5) / res_y * 2 - 1
+    cols = (np.arange(res_x, dtype=np.float32)+0.5) / res_x * 2 - 1
+    b, a = np.meshgrid(rows, cols, indexing='ij')
+    if coord_sys == CoordSys.LatLong:
+        # Rows from top to bottom
+        lat, long = -b * pi_by_2, a * math.pi
+    else:
+        # Zenith vector: Length is the angle from the zenith, direction the longitude
+        lat = pi_by_2 - np.minimum(np.sqrt(a**2 + b**2), 1) * math.pi
+        long = np.arctan2(a, -b)
+    return np.stack([np.cos(lat) * np.sin(long), -np.cos(lat) * np.cos(long), np.sin(lat)], axis=-1)
+
+def ClosestLightGrid(light_xyz: ArrayLike, coord_sys: CoordSys, resolution, count, power=2):
+    """Returns indices (H x W x count) and inverse distance weights of the closest lights for every grid cell"""
+    lights = light_xyz / np.linalg.norm(light_xyz, axis=-1, keepdims=True)
+    directions = GridDirections(coord_sys, resolution).reshape(-1, 3)
+
+    ids = np.zeros((len(directions), count), dtype=np.int32)
+    weights = np.zeros((len(directions), count), dtype=np.float32)
+    # Angular distances in chunks of grid cells
+    for start in range(0, len(directions), 4096):
+        angles = np.arccos(np.clip(directions[start:start+4096] @ lights.T, -1, 1))
+        closest = np.argpartition(angles, count-1, axis=1)[:, 0:count]
+        inverse = 1 / (np.take_along_axis(angles, closest, axis=1) + 1e-3)**power
+        ids[start:start+4096] = closest
+        weights[start:start+4096] = inverse / inverse.sum(axis=1, keepdims=True)
+
+    return ids.reshape(*resolution, count), weights.reshape(*resolution, count)
@@ -7,16 +7,74 @@ import taichi.types as tt
 
 from ..utils import ti_base as tib
 from ..data import *
+from .bsdf import BSDF
 
 
-@ti.dataclass
-class NeuralRtiBsdf:
+class NeuralRtiBsdf(BSDF):
     def load(self, sequence: Sequence) -> bool:
+        nrti_seq = sequence.getDataSequence(self._data_key)
+        layers = nrti_seq.getMeta('decoder')
+        if len(nrti_seq) == 0 or layers is None:
+            log.error("Neural RTI data sequence needs latent maps and decoder weights")
+            return False
+
+        # Latent maps, three channels are packed in each frame
+        self._latent_dim = nrti_seq.getMeta('latent_dim', 9)
+        res_x, res_y = nrti_seq.get(0).resolution()
+        latents = np.concatenate([frame.get() for _, frame in nrti_seq], axis=-1)[..., 0:self._latent_dim]
+        self._latent = self.allocField(ti.f32, (self._latent_dim, res_y, res_x))
+        self._latent.from_numpy(np.ascontiguousarray(np.moveaxis(latents, -1, 0), dtype=np.float32))
+
+        # Decoder MLP: Input layer (latent + light direction), hidden layers with same width and RGB output layer
+        self._width = len(layers[0]['bias'])
+        self._hidden_count = len(layers) - 2
+        self._w_in = self.allocField(ti.f32, (self._width, self._latent_dim+2))
+        self._b_in = self.allocField(ti.f32, (self._width,))
+        self._w_hidden = self.allocField(ti.f32, (self._hidden_count, self._width, self._width))
+        self._b_hidden = self.allocField(ti.f32, (self._hidden_count, self._width))
+        self._w_out = self.allocField(ti.f32, (3, self._width))
+        self._b_out = self.allocField(ti.f32, (3,))
+
+        self._w_in.from_numpy(np.array(layers[0]['weight'], dtype=np.float32))
+        self._b_in.from_numpy(np.array(layers[0]['bias'], dtype=np.float32))
+        self._w_hidden.from_numpy(np.array([layer['weight'] for layer in layers[1:-1]], dtype=np.float32))
+        self._b_hidden.from_numpy(np.array([layer['bias'] for layer in layers[1:-1]], dtype=np.float32))
+        self._w_out.from_numpy(np.array(layers[-1]['weight'], dtype=np.float32))
+        self._b_out.from_numpy(np.array(layers[-1]['bias'], dtype=np.float32))
+
+        # Network is trained with normalized ZVec light directions
+        self.coord_sys = CoordSys.ZVec
         return True
-    
+
     @ti.func
     def sample(self, x: ti.i32, y: ti.i32, u: ti.f32, v: ti.f32) -> tib.pixvec:
-        rgb = [0, y, x]
-            
-        return rgb
+        # Input layer
+        hidden = ti.Vector.zero(ti.f32, self._width)
+        for j in range(self._width):
+            val = self._b_in[j] + self._w_in[j, self._latent_dim] * u + self._w_in[j, self._latent_dim+1] * v
+            for i in range(self._latent_dim):
+                val += self._w_in[j, i] * self._latent[i, y, x]
+            hidden[j] = elu(val)
+
+        # Hidden layers
+        for l in range(self._hidden_count):
+            result = ti.Vector.zero(ti.f32, self._width)
+            for j in range(self._width):
+                val = self._b_hidden[l, j]
+                for i in range(self._width):
+                    val += self._w_hidden[l, j, i] * hidden[i]
+                result[j] = elu(val)
+            hidden = result
+
+        # Output layer without activation
+        rgb = ti.Vector([self._b_out[0], self._b_out[1], self._b_out[2]], dt=ti.f32)
+        for c in ti.static(range(3)):
+            for i in range(self._width):
+                rgb[c] += self._w_out[c, i] * hidden[i]
+
+        return tm.max(rgb, 0.0)
+
 
+@ti.func
+def elu(val: ti.f32) -> ti.f32:
+    return val if val > 0 else tm.exp(val) - 1
@@ -0,0 +1,57 @@
+import logging as log
+import numpy as np
+
+import taichi as ti
+import taichi.math as tm
+import taichi.types as tt
+
+from ..utils import ti_base as tib
+from ..data import *
+from .bsdf import BSDF
+
+
+class NormalBsdf(BSDF):
+    """Preview shading from the normal and albedo maps of the normal generator, Lambert with optional Blinn-Phong highlights"""
+
+    def load(self, sequence: Sequence) -> bool:
+        # Normal data is shared by all shading modes
+        normal_seq = sequence.getDataSequence(GetSetting(self._settings, 'data', 'normal'))
+        if len(normal_seq) < 2:
+            log.error("Normal shading needs normal and albedo maps, run the normal generator first")
+            return False
+
+        # Normals are stored in the range of 0 to 1, albedo relative to its maximum
+        normals = normal_seq.get(0).asFloat().get()[..., 0:3] * 2 - 1
+        normals /= np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-6)
+        albedo = normal_seq.get(1).asFloat().get()[..., 0:3] * normal_seq.getMeta('albedo_scale', 1.0)
+
+        res_y, res_x = normals.shape[0:2]
+        self._normal = self.allocField(tib.pixvec, (res_y, res_x))
+        self._albedo = self.allocField(tib.pixvec, (res_y, res_x))
+        self._normal.from_numpy(np.ascontiguousarray(normals, dtype=np.float32))
+        self._albedo.from_numpy(np.ascontiguousarray(albedo, dtype=np.float32))
+
+        # Shading settings
+        self._shading = GetSetting(self._settings, 'shading', 'lambert')
+        self._specular = GetSetting(self._settings, 'specular', 0.0, dtype=float)
+        self._shininess = GetSetting(self._settings, 'shininess', 32.0, dtype=float)
+        self._specular_scale = float(albedo.max()) * self._specular
+        self.coord_sys = CoordSys.LatLong
+        return True
+
+    @ti.func
+    def sample(self, x: ti.i32, y: ti.i32, u: ti.f32, v: ti.f32) -> tib.pixvec:
+        # Normalized LatLong to light direction in normal map space: X to the right, Y up and Z towards the camera
+        lat, long = u * pi_by_2, v * tm.pi
+        light = ti.Vector([tm.cos(lat) * tm.sin(long), tm.sin(lat), tm.cos(lat) * tm.cos(long)], dt=ti.f32)
+        normal = self._normal[y, x]
+        n_dot_l = tm.dot(normal, light)
+
+        rgb = tib.pixvec(0.0)
+        if n_dot_l > 0:
+            rgb = self._albedo[y, x] * n_dot_l
+            if ti.static(self._shading == 'blinn-phong'):
+                # Orthographic view along the Z axis
+                half = tm.normalize(light + ti.Vector([0.0, 0.0, 1.0]))
+                rgb += self._specular_scale * tm.pow(tm.max(tm.dot(normal, half), 0.0), self._shininess)
+        return rgb
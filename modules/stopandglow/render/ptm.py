@@ -1,5 +1,6 @@
 import logging as log
 import numpy as np
+from numpy.typing import ArrayLike
 
 import taichi as ti
 import taichi.math as tm
@@ -7,17 +8,16 @@ import taichi.types as tt
 
 from ..utils import ti_base as tib
 from ..data import *
-from .bsdf import BSDF
+from .bsdf import LinearBSDF
 
 
-class PtmBsdf(BSDF):
+class PtmBsdf(LinearBSDF):
     def load(self, sequence: Sequence) -> bool:
         rti_seq = sequence.getDataSequence(self._data_key)
         if len(rti_seq) > 0:
             # Load data into fields
             res_x, res_y = rti_seq.get(0).resolution()
-            self._coeff = ti.field(tib.pixvec)
-            ti.root.dense(ti.ijk, (len(rti_seq), res_y, res_x)).place(self._coeff) # TODO ijk ? Pack pixels of all images together
+            self._coeff = self.allocField(tib.pixvec, (len(rti_seq), res_y, res_x)) # TODO ijk ? Pack pixels of all images together
             # Copy
             arr = np.stack([frame.get() for _, frame in rti_seq], axis=0)
             self._coeff.from_numpy(arr)
@@ -39,6 +39,9 @@ class PtmBsdf(BSDF):
         ## Load data
         #self._fitter.loadCoefficients(rti_seq)
     
+    def basis(self, u: float, v: float) -> ArrayLike:
+        return PtmBasis(u, v, self._coeff.shape[0])
+    
     @ti.func
     def sample(self, x: ti.i32, y: ti.i32, u: ti.f32, v: ti.f32) -> tib.pixvec:
         rgb = self._coeff[0, y, x]
@@ -66,3 +69,14 @@ class PtmBsdf(BSDF):
         for i in range(1, a+1):
             rgb += self._coeff[offset+i, y, x] * u**(a-i) * v**i
         return rgb
+
+
+def PtmBasis(u, v, count) -> ArrayLike:
+    """Polynomial terms in the order of the coefficients: 1, u, v, u^2, uv, v^2, u^3, ...; u and v can be arrays"""
+    u, v = np.asarray(u, dtype=np.float32), np.asarray(v, dtype=np.float32)
+    basis = []
+    degree = 0
+    while len(basis) < count:
+        basis += [u**(degree-i) * v**i for i in range(degree+1)]
+        degree += 1
+    return np.stack(basis[0:count])
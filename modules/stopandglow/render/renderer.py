@@ -1,5 +1,9 @@
-from enum import Enum
+from enum import Enum, IntEnum
+from collections import OrderedDict
+import itertools
+import time
 import numpy as np
+from numpy.typing import ArrayLike
 
 import taichi as ti
 import taichi.math as tm
@@ -15,25 +19,97 @@ from .bsdf import *
 
 # Coordinate debugging
 coord_debug = False
+# Lights rendered per kernel launch, larger scenes are rendered in chunks
+MAX_LIGHTS = 64
+# Maximum coefficient count of linear BSDFs for summed up directional lights
+MAX_BASIS = 64
+# Number of HDRI rotations with cached basis projections
+HDRI_PROJECTION_CACHE = 64
+# Progressive rendering: Pixel offsets inside 4x4 blocks in ordered dither order, the first subset is used as coarse preview
+PROGRESSIVE_STRIDE = 4
+PROGRESSIVE_ORDER = [(0, 0), (2, 2), (0, 2), (2, 0), (1, 1), (3, 3), (1, 3), (3, 1), (0, 1), (2, 3), (0, 3), (2, 1), (1, 0), (3, 2), (1, 2), (3, 0)]
+
+# Number of converged renders kept for identical scenes
+RENDER_CACHE_SIZE = 8
+# Frames of batch renders evaluated per kernel launch
+BATCH_BLOCK_SIZE = 8
+# Cached light contributions of linear BSDFs, scene edits only render the lights that changed
+LIGHT_CACHE_SIZE = 8
+
+class LightType(IntEnum):
+    Sun = 0
+    Point = 1
+    Spot = 2
+    Area = 3
+
+Light = ti.types.struct(type=ti.i32, position=tib.pixvec, direction=tib.pixvec, uv=tt.vector(2, ti.f32), angle=ti.f32, blend=ti.f32, factor=tib.pixvec)
 
 @ti.data_oriented
 class Renderer:
-    def __init__(self, bsdf=BSDF(), resolution=[1920, 1080]):
+    def __init__(self, bsdf=BSDF(), resolution=[1920, 1080], light_cache=LIGHT_CACHE_SIZE):
         self._bsdf = bsdf
         self._scene = Scene()
-        self._buffer = ti.field(tib.pixvec)
-        self._sample_buffer = ti.field(tib.pixvec)
+        self._buffer = tib.FieldPool.alloc(tib.pixvec, (resolution[1], resolution[0]))
+        self._sample_buffer = tib.FieldPool.alloc(tib.pixvec, (resolution[1], resolution[0]))
         self._hdri_samples = 0
         self._hdri_sample_steps = 64
         self._sample_count = 0
-        ti.root.dense(ti.ij, (resolution[1], resolution[0])).place(self._buffer)
-        ti.root.dense(ti.ij, (resolution[1], resolution[0])).place(self._sample_buffer)
+        self._lights = tib.FieldPool.alloc(Light, (MAX_LIGHTS,))
+        self._basis_weights = tib.FieldPool.alloc(tib.pixvec, (MAX_BASIS,))
+        # Progressive rendering state, restarts when the scene version changes
+        self._progress = 0
+        self._progress_version = None
+        self._progress_lights = None
+        self._progress_key = None
+        # Converged renders by cache key and version of the loaded BSDF data
+        self._cache = OrderedDict()
+        self._data_version = 0
+        # Contributions of the directional lights and single lights in layers, the render buffer holds the sum of the composed layers
+        self._layer_count = light_cache if bsdf.linear else 0
+        self._layers = tib.FieldPool.alloc(tib.pixvec, (self._layer_count, resolution[1], resolution[0]) if self._layer_count > 0 else (1, 1, 1))
+        self._layer_slots = OrderedDict() # component key -> layer
+        self._layer_version = None
+        self._composed = None
+        self._pending_layers = []
         
+    def release(self):
+        """Returns the buffers and BSDF data to the field pool, the renderer can't be used afterwards"""
+        self._bsdf.release()
+        for field in [self._buffer, self._sample_buffer, self._lights, self._basis_weights, self._layers]:
+            tib.FieldPool.release(field)
+        self._buffer = self._sample_buffer = self._lights = self._basis_weights = self._layers = None
+        self._cache.clear()
+    
+    def resize(self, resolution):
+        """Changes the render resolution, the BSDF data has to be loaded again with the same resolution"""
+        previous = tuple(self._buffer.shape)
+        if previous == (resolution[1], resolution[0]):
+            return
+        # Replaced fields are destroyed so the kernels are compiled again
+        self._bsdf.release(reuse=False)
+        for field in [self._buffer, self._sample_buffer, self._layers]:
+            tib.FieldPool.free(field)
+        # Pooled fields of the previous resolution won't be used again
+        tib.FieldPool.clearResolution(previous)
+        self._buffer = tib.FieldPool.alloc(tib.pixvec, (resolution[1], resolution[0]))
+        self._sample_buffer = tib.FieldPool.alloc(tib.pixvec, (resolution[1], resolution[0]))
+        self._layers = tib.FieldPool.alloc(tib.pixvec, (self._layer_count, resolution[1], resolution[0]) if self._layer_count > 0 else (1, 1, 1))
+        self._layer_slots.clear()
+        self._composed = None
+        self._data_version += 1
+        self.invalidate()
         
     def getScene(self):
         return self._scene
     
+    def getResolution(self):
+        return [self._buffer.shape[1], self._buffer.shape[0]]
+    
     def loadSequence(self, sequence) -> bool:
+        self._progress_version = None
+        self._progress_key = None
+        self._data_version += 1
+        self._bsdf.release(reuse=False)
         return self._bsdf.load(sequence)
     
     def getBsdfCoordSys(self) -> CoordSys:
@@ -46,161 +122,460 @@ class Renderer:
         self._hdri_samples = hdri_samples
         self._hdri_sample_steps = hdri_sample_steps
         self._sample_count = 0
+        self._progress_version = None
+        self._progress_key = None
     
     def reset(self):
         self._sample_count = 0
         self._sample_buffer.fill(0.0)
+        self._progress_version = None
+        self._progress_key = None
+    
+    def invalidate(self):
+        """Clears cached renders, needed when the data of the BSDF doesn't match the loaded sequence anymore"""
+        self._cache.clear()
+        self.reset()
 
     def clear(self):
         self._scene.clear()
     
     def sample(self) -> bool:
-        # Reset normal buffer every time (doesn't take long to render this but we could also keep render data for lights separately)
-        self._buffer.fill(0.0)
-        for lgt in self._scene.getSunLights():
-            u, v = 0.0, 0.0
-            if len(lgt.direction) == 3:
-                lp = LightPosition(lgt.direction)
-                u,v = lp.getLLNorm()
-            else:
-                u, v = lgt.direction
-            self.sampleSun(u, v, lgt.angle, lgt.power, lgt.color)
-        
-        for lgt in self._scene.getPointLights():
-            self.samplePoint(lgt.position, lgt.size, lgt.power, lgt.color)
-        
-        for lgt in self._scene.getSpotLights():
-            self.sampleSpot(lgt.position, lgt.direction, lgt.angle/2, lgt.blend, lgt.size, lgt.power, lgt.color)
-        
-        for lgt in self._scene.getAreaLights():
-            self.sampleArea(lgt.position, lgt.direction, lgt.angle, lgt.size, lgt.power, lgt.color)
+        # Render all lights and one HDRI pass of the full frame
+        lights, directional, analytic_hdri, sample_hdri = self.prepareLights()
+        self._composed = None
+        self.renderLights(lights, directional)
         
-        env_data = self._scene.getHdri()
-        if self._sample_count < self._hdri_samples and env_data.power != 0 and env_data.hdri is not None:
+        if sample_hdri and self._sample_count < self._hdri_samples:
             # Sample0
-            self.sampleHdri(env_data.hdri, env_data.rotation, env_data.power, self._hdri_sample_steps)
+            self.sampleHdri(self._scene.getHdri(), self._hdri_sample_steps)
             self._sample_count += 1
         if self._sample_count != 0:
             # Add scaled down to render buffer
             tib.addScaled(self._buffer, self._sample_buffer, 1.0/self._sample_count)
             
         
-        return self._hdri_samples == 0 # True if done
+        return self._hdri_samples == 0 or analytic_hdri # True if done
+    
+    def render(self, budget_ms=0.0, level=0) -> bool:
+        """Progressive rendering for the time budget in milliseconds, continues where the last call stopped and returns True when converged.
+        Lights are rendered in interleaved pixel subsets with a coarse first result, HDRI samples are accumulated afterwards.
+        Stops early when the pixels of the mip level are done, see get()."""
+        start = time.perf_counter()
+        if self._progress_version != self._scene.getVersion():
+            self._progress_version = self._scene.getVersion()
+            key = self.cacheKey()
+            if key != self._progress_key:
+                # Scene content changed, restart
+                self._progress_key = key
+                self._progress = 0
+                self._sample_count = 0
+                self._sample_buffer.fill(0.0)
+                if key in self._cache:
+                    # Same render as before
+                    self._cache.move_to_end(key)
+                    self._buffer.from_numpy(self._cache[key])
+                    self._progress = len(PROGRESSIVE_ORDER)
+                    self._progress_lights = ([], False, False, False)
+                    self._composed = None
+                    self._pending_layers = []
+                    return True
+                self._progress_lights = self.prepareLights()
+                if self.updateLayers(*self._progress_lights):
+                    # Only changed lights are rendered, no progressive passes needed
+                    self._progress = len(PROGRESSIVE_ORDER)
+                else:
+                    self._composed = None
+                    self._pending_layers = []
+        lights, directional, _, sample_hdri = self._progress_lights
+        
+        while not self.levelReady(level):
+            if len(self._pending_layers) > 0:
+                self.renderLayer(*self._pending_layers.pop(0))
+            elif self._progress < len(PROGRESSIVE_ORDER):
+                offset_y, offset_x = PROGRESSIVE_ORDER[self._progress]
+                self.renderLights(lights, directional, PROGRESSIVE_STRIDE, offset_y, offset_x)
+                if self._progress == 0:
+                    fillBlocks(self._buffer, PROGRESSIVE_STRIDE)
+            elif sample_hdri:
+                # Replace average of HDRI samples in render buffer
+                if self._sample_count > 0:
+                    tib.addScaled(self._buffer, self._sample_buffer, -1.0/self._sample_count)
+                self.sampleHdri(self._scene.getHdri(), self._hdri_sample_steps)
+                self._sample_count += 1
+                tib.addScaled(self._buffer, self._sample_buffer, 1.0/self._sample_count)
+            self._progress += 1
+            
+            ti.sync()
+            if (time.perf_counter() - start) * 1000 >= budget_ms:
+                break
+        
+        if self.converged() and not self._progress_key in self._cache:
+            self._cache[self._progress_key] = self._buffer.to_numpy()
+            while len(self._cache) > RENDER_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return self.converged()
+    
+    def cacheKey(self) -> str:
+        """Key of the render result for the scene, BSDF data and render settings"""
+        bsdf = f"{type(self._bsdf).__name__}_{self._bsdf.coord_sys}_{self._data_version}"
+        return f"{bsdf}_{self._hdri_samples}_{self._hdri_sample_steps}_{self._scene.getHash()}"
+    
+    def converged(self) -> bool:
+        """True if the progressive render is complete for the current scene"""
+        if self._progress_version != self._scene.getVersion() or self._progress < len(PROGRESSIVE_ORDER) or len(self._pending_layers) > 0:
+            return False
+        return not self._progress_lights[3] or self._sample_count >= self._hdri_samples
+    
+    def levelReady(self, level: int) -> bool:
+        """True if every 2^level-th pixel of the current scene is rendered, coarse levels are ready before the render converged"""
+        if level == 0:
+            return self.converged()
+        if self._progress_version != self._scene.getVersion() or len(self._pending_layers) > 0:
+            return False
+        # HDRI samples are taken for the whole frame
+        if self._progress_lights[3] and self._sample_count == 0:
+            return False
+        step = min(2**level, PROGRESSIVE_STRIDE)
+        offsets = itertools.product(range(0, PROGRESSIVE_STRIDE, step), repeat=2)
+        return all(offset in PROGRESSIVE_ORDER[0:self._progress] for offset in offsets)
+    
+    def refining(self) -> bool:
+        """True if a progressive render of the current scene was started and is not converged yet"""
+        return self._progress_version == self._scene.getVersion() and not self.converged()
+    
+    def renderBatch(self, frames: list, block_size=BATCH_BLOCK_SIZE):
+        """Renders a list of frames and yields the results in order. Frames are dicts with 'lights' in the format of Scene.addLight
+        and/or HDRI 'rotation' and 'power', the scene is left at the last frame. Frames of linear BSDFs with only directional lights
+        are rendered in blocks as one product of the frame weights and the coefficient planes, others are rendered until converged."""
+        block = []
+        buffers = dict()
+        for frame in frames:
+            self.applyFrame(frame)
+            lights = self.collectLights()
+            weights = self.directionalWeights(lights) if all(lgt[0] == LightType.Sun for lgt in lights) else None
+            if weights is not None:
+                block.append(weights)
+                if len(block) == block_size:
+                    yield from self.renderBlock(block, buffers)
+                    block = []
+            else:
+                yield from self.renderBlock(block, buffers)
+                block = []
+                while not self.render(1000.0):
+                    pass
+                yield self.get()
+        yield from self.renderBlock(block, buffers)
+    
+    def applyFrame(self, frame: dict):
+        if 'lights' in frame:
+            self._scene.clear()
+            for light in frame['lights']:
+                self._scene.addLight(light)
+        if 'rotation' in frame or 'power' in frame:
+            self._scene.setHdriData(rotation=GetSetting(frame, 'rotation', dtype=float), power=GetSetting(frame, 'power', dtype=float))
+    
+    def renderBlock(self, block: list, buffers: dict):
+        """Renders the frames of a list of basis weights at once, as matrix product with BLAS on CPUs or in a kernel on GPUs"""
+        if len(block) == 0:
+            return
+        res_y, res_x = self._buffer.shape
+        weights = np.array(block, dtype=np.float32)
+        if ti.lang.impl.current_cfg().arch in [ti.x64, ti.arm64]:
+            if not 'coeff' in buffers:
+                # Coefficient planes per channel (3 x coefficients x pixels)
+                coeff = self._bsdf.getCoefficients()
+                buffers['coeff'] = np.ascontiguousarray(np.moveaxis(coeff, -1, 0).reshape(3, len(coeff), -1))
+            result = np.matmul(np.moveaxis(weights, -1, 0), buffers['coeff'])
+            result = np.maximum(result, 0).transpose(1, 2, 0).reshape(len(block), res_y, res_x, 3)
+        else:
+            if not 'frames' in buffers or buffers['frames'].shape[0] < len(block):
+                buffers['frames'] = ti.ndarray(tib.pixvec, (len(block), res_y, res_x))
+                buffers['weights'] = ti.ndarray(tib.pixvec, (len(block), weights.shape[1]))
+            padded = np.zeros(buffers['weights'].shape + (3,), dtype=np.float32)
+            padded[0:len(block)] = weights
+            buffers['weights'].from_numpy(padded)
+            self.sampleBatch(buffers['frames'], buffers['weights'], len(block))
+            result = buffers['frames'].to_numpy()
+        for i in range(len(block)):
+            yield result[i]
+    
+    def prepareLights(self):
+        """Uploads summed up basis weights and returns the remaining lights and flags for directional, analytic and sampled HDRI rendering"""
+        lights = self.collectLights()
+        render_hdri = self.renderHdri()
+        directional = analytic_hdri = False
+        self._directional_key = None
+        weights = self.directionalWeights(lights)
+        if weights is not None:
+            analytic_hdri = render_hdri
+            directional = analytic_hdri or any(lgt[0] == LightType.Sun for lgt in lights)
+            if directional:
+                self._basis_weights.from_numpy(np.pad(weights, ((0, MAX_BASIS-len(weights)), (0, 0))))
+                self._directional_key = weights.tobytes()
+                lights = [lgt for lgt in lights if lgt[0] != LightType.Sun]
+        return lights, directional, analytic_hdri, render_hdri and not analytic_hdri
+    
+    def renderHdri(self) -> bool:
+        env_data = self._scene.getHdri()
+        return self._hdri_samples > 0 and env_data.power != 0 and env_data.hdri is not None
+    
+    def directionalWeights(self, lights: list) -> ArrayLike | None:
+        """Basis weights of the suns and the environment for linear BSDFs, returns None if they can't be summed up"""
+        if not self._bsdf.linear or coord_debug:
+            return None
+        # Directional lights and the environment of linear BSDFs are summed up in the basis and evaluated with one dot product per pixel
+        weights = self.basisWeights([lgt for lgt in lights if lgt[0] == LightType.Sun])
+        if weights is not None and self.renderHdri():
+            env_data = self._scene.getHdri()
+            weights += self.projectHdri(env_data) * env_data.power
+        return weights
+    
+    def renderLights(self, lights, directional, stride=1, offset_y=0, offset_x=0):
+        """Renders lights for every stride-th pixel starting at the offsets, the buffer is overwritten by the first chunk"""
+        if len(lights) == 0 and not directional:
+            self._buffer.fill(0.0)
+        for offset in range(0, max(len(lights), 1 if directional else 0), MAX_LIGHTS):
+            count = self.uploadLights(lights[offset:offset+MAX_LIGHTS])
+            self.sampleLights(count, offset > 0, directional and offset == 0, stride, offset_y, offset_x, -1)
+    
+    def updateLayers(self, lights, directional, analytic_hdri, sample_hdri) -> bool:
+        """Replaces the contributions of changed lights in the composed render buffer, unchanged lights are kept.
+        Returns False if the scene can't be rendered in layers."""
+        if self._layer_version != self._data_version:
+            self._layer_version = self._data_version
+            self._layer_slots.clear()
+            self._composed = None
+        # Identical lights are counted to get unique keys
+        reprs = [repr(lgt) for lgt in lights]
+        components = [(f"{reprs[i]}_{reprs[0:i].count(reprs[i])}", lgt) for i, lgt in enumerate(lights)]
+        if directional:
+            components.append((self._directional_key, None))
+        if sample_hdri or coord_debug or len(components) > self._layer_count:
+            return False
+        
+        keys = [key for key, _ in components]
+        if self._composed is None:
+            self._buffer.fill(0.0)
+            self._composed = []
+        # Remove contributions of lights that changed or were deleted, pending layers of the previous scene are dropped
+        for key in [key for key in self._composed if not key in keys]:
+            self.addLayer(self._layer_slots[key], -1.0)
+            self._composed.remove(key)
+        # Cached layers first
+        self._pending_layers = sorted([(key, lgt) for key, lgt in components if not key in self._composed], key=lambda comp: not comp[0] in self._layer_slots)
+        return True
+    
+    def renderLayer(self, key, light):
+        """Renders a single light or the directional lights to a layer if not cached and adds it to the render buffer"""
+        if key in self._layer_slots:
+            self._layer_slots.move_to_end(key)
+        else:
+            if len(self._layer_slots) < self._layer_count:
+                layer = len(self._layer_slots)
+            else:
+                # Reuse the least recently used layer that is not part of the buffer
+                pending = [k for k, _ in self._pending_layers]
+                unused = next(k for k in self._layer_slots if not k in self._composed and not k in pending)
+                layer = self._layer_slots.pop(unused)
+            if light is None:
+                self.sampleLights(0, False, True, 1, 0, 0, layer)
+            else:
+                self.sampleLights(self.uploadLights([light]), False, False, 1, 0, 0, layer)
+            self._layer_slots[key] = layer
+        self.addLayer(self._layer_slots[key], 1.0)
+        self._composed.append(key)
     
-    def get(self):
+    def get(self, level=0):
+        """Render buffer, levels above 0 only take every 2^level-th pixel"""
+        if level > 0:
+            return self._buffer.to_numpy()[::2**level, ::2**level]
         return self._buffer.to_numpy()
     
     def getBuffer(self):
         return self._buffer
 
-    ## Sample kernels
-    @ti.kernel
-    def sampleSun(self, u: ti.f32, v: ti.f32, angle: ti.f32, power: ti.f32, color: tib.pixvec):
-        factor = power * color * 50 # TODO what is this factor?
-        
-        for y, x in self._buffer:
-            if not ti.static(coord_debug):
-                self._buffer[y, x] += self._bsdf.sample(x, y, u, v) * factor
+    def collectLights(self) -> list:
+        """Returns the lights of the scene as tuples of the light struct members"""
+        lights = []
+        for lgt in self._scene.getSunLights():
+            u, v = 0.0, 0.0
+            if len(lgt.direction) == 3:
+                lp = LightPosition(lgt.direction)
+                u,v = lp.getLLNorm()
             else:
-                self._buffer[y, x] = [u, v, 0]
+                u, v = lgt.direction
+            lights.append((LightType.Sun, [0, 0, 0], [0, 0, 0], [u, v], 0.0, 0.0, np.multiply(lgt.color, lgt.power * 50))) # TODO what is this factor?
+        for lgt in self._scene.getPointLights():
+            lights.append((LightType.Point, lgt.position, [0, 0, 0], [0, 0], 0.0, 0.0, np.multiply(lgt.color, lgt.power)))
+        for lgt in self._scene.getSpotLights():
+            lights.append((LightType.Spot, lgt.position, lgt.direction, [0, 0], lgt.angle/2, lgt.blend, np.multiply(lgt.color, lgt.power)))
+        for lgt in self._scene.getAreaLights():
+            lights.append((LightType.Area, lgt.position, lgt.direction, [0, 0], lgt.angle, 0.0, np.multiply(lgt.color, lgt.power)))
+        return lights
+    
+    def uploadLights(self, lights: list) -> int:
+        """Copies up to MAX_LIGHTS lights to the light field, returns the light count"""
+        if len(lights) > 0:
+            # Pad to field size and copy all members at once
+            padding = MAX_LIGHTS - len(lights)
+            members = list(zip(*lights))
+            self._lights.from_numpy({
+                'type':      np.pad(np.array(members[0], dtype=np.int32), (0, padding)),
+                'position':  np.pad(np.array(members[1], dtype=np.float32), ((0, padding), (0, 0))),
+                'direction': np.pad(np.array(members[2], dtype=np.float32), ((0, padding), (0, 0))),
+                'uv':        np.pad(np.array(members[3], dtype=np.float32), ((0, padding), (0, 0))),
+                'angle':     np.pad(np.array(members[4], dtype=np.float32), (0, padding)),
+                'blend':     np.pad(np.array(members[5], dtype=np.float32), (0, padding)),
+                'factor':    np.pad(np.array(members[6], dtype=np.float32), ((0, padding), (0, 0))),
+            })
+        return len(lights)
+
+    def basisWeights(self, suns: list) -> ArrayLike | None:
+        """Sums up the weighted basis of directional lights, returns None if the basis is too large"""
+        weights = np.zeros((len(self._bsdf.basis(0.0, 0.0)), 3), dtype=np.float32)
+        if len(weights) > MAX_BASIS:
+            return None
+        for _, _, _, (u, v), _, _, factor in suns:
+            weights += np.outer(self._bsdf.basis(u, v), factor)
+        return weights
     
+    def projectHdri(self, env_data: EnvironmentData) -> ArrayLike:
+        """Integrates the environment against the basis functions, the result equals the converged HDRI sampling"""
+        # Projections are cached per rounded rotation, the projection has to use the same value
+        rotation = round(env_data.rotation % 1.0, 4)
+        key = (rotation, self._bsdf.coord_sys, len(self._bsdf.basis(0.0, 0.0)))
+        if not key in env_data.projections:
+            # Light directions of the HDRI pixel centers in the same mapping as sampleHdri
+            res_y, res_x = env_data.lowres.shape[0:2]
+            u = 1 - (np.arange(res_y, dtype=np.float32)+0.5) / res_y * 2
+            v = ((1 + rotation - (np.arange(res_x, dtype=np.float32)+0.5) / res_x) % 1.0) * 2 - 1
+            u, v = np.meshgrid(u, v, indexing='ij')
+            if self._bsdf.coord_sys == CoordSys.ZVec:
+                # LatLong to ZVec
+                length = (1 - u) / 2
+                u, v = length * np.sin(v*np.pi), -length * np.cos(v*np.pi)
+            
+            basis = self._bsdf.basis(u, v)
+            env_data.projections[key] = np.einsum('kyx,yxc->kc', basis, env_data.lowres) / (res_y*res_x) * 10
+            while len(env_data.projections) > HDRI_PROJECTION_CACHE:
+                env_data.projections.popitem(last=False)
+        return env_data.projections[key]
+
+    ## Sample kernels
     @ti.kernel
-    def samplePoint(self, pos: tib.pixvec, size: ti.f32, power: ti.f32, color: tib.pixvec):
-        factor = power * color
+    def sampleLights(self, count: ti.i32, accumulate: ti.i32, directional: ti.i32, stride: ti.i32, offset_y: ti.i32, offset_x: ti.i32, layer: ti.i32):
         width, height = self._buffer.shape[1], self._buffer.shape[0]
         height_factor = self._buffer.shape[0]/self._buffer.shape[1]
         
-        for y, x in self._buffer:
-            # Calculate vector to pixel: We assume the canvas is 1m wide and 0,0 is in the center
+        for py, px in ti.ndrange((height - offset_y + stride-1) // stride, (width - offset_x + stride-1) // stride):
+            y, x = py*stride + offset_y, px*stride + offset_x
+            # Position of pixel: We assume the canvas is 1m wide and 0,0 is in the center
             # Canvas is flat for now
-            pix2light = pos - ti.Vector([x/width - 0.5, 0, (0.5 - y/height) * height_factor], dt=ti.f32)
-            squared_length = pix2light[0]**2 + pix2light[1]**2 + pix2light[2]**2
-            # Calculate light direction
-            dir = tm.normalize(pix2light)
-            u, v = 0.0, 0.0
-            if self._bsdf.coord_sys.value == CoordSys.LatLong.value:
-                u, v = LightPosTi(xyz=dir).getLLNorm()
-            else: # self._bsdf.coord_sys.value == CoordSys.ZVec.value
-                u, v = LightPosTi(xyz=dir).getZVecNorm()
+            pix_pos = ti.Vector([x/width - 0.5, 0, (0.5 - y/height) * height_factor], dt=ti.f32)
+            rgb = tib.pixvec(0.0)
+            if ti.static(self._bsdf.linear):
+                if directional:
+                    rgb = self._bsdf.sampleWeighted(x, y, self._basis_weights)
+            for i in range(count):
+                lgt = self._lights[i]
+                u, v = lgt.uv[0], lgt.uv[1]
+                weight = lgt.factor
+                if lgt.type != LightType.Sun.value:
+                    # Vector to pixel and light direction, spot and area lights use their own direction
+                    pix2light = lgt.position - pix_pos
+                    squared_length = pix2light[0]**2 + pix2light[1]**2 + pix2light[2]**2
+                    dir = tm.normalize(pix2light)
+                    weight /= squared_length
+                    if lgt.type != LightType.Point.value:
+                        ray_angle = tm.acos(tm.dot(dir, lgt.direction))
+                        if ray_angle > lgt.angle:
+                            weight = tib.pixvec(0.0)
+                        elif lgt.type == LightType.Spot.value and lgt.blend > 0:
+                            # Falloff/blend
+                            weight *= tm.min(tm.sqrt((lgt.angle - ray_angle)/lgt.angle / lgt.blend), 1)
+                        dir = lgt.direction
+                    
+                    if self._bsdf.coord_sys.value == CoordSys.LatLong.value:
+                        u, v = LightPosTi(xyz=dir).getLLNorm()
+                    else: # self._bsdf.coord_sys.value == CoordSys.ZVec.value
+                        u, v = LightPosTi(xyz=dir).getZVecNorm()
+                
+                if ti.static(coord_debug):
+                    rgb = [u, v, 0]
+                elif weight.any():
+                    rgb += self._bsdf.sample(x, y, u, v) * weight
             
-            if not ti.static(coord_debug):
-                self._buffer[y, x] += self._bsdf.sample(x, y, u, v) * factor * 1/squared_length
+            if layer >= 0:
+                self._layers[layer, y, x] = rgb
+            elif accumulate:
+                self._buffer[y, x] += rgb
             else:
-                self._buffer[y, x] = [u, v, -u]
+                self._buffer[y, x] = rgb
     
     @ti.kernel
-    def sampleSpot(self, pos: tib.pixvec, dir: tib.pixvec, angle: ti.f32, blend: ti.f32, size:ti.f32, power: ti.f32, color: tib.pixvec):
-        factor = power * color
-        width, height = self._buffer.shape[1], self._buffer.shape[0]
-        height_factor = self._buffer.shape[0]/self._buffer.shape[1]
-        
+    def addLayer(self, layer: ti.i32, scale: ti.f32):
         for y, x in self._buffer:
-            # Calculate vector to pixel: We assume the canvas is 1m wide and 0,0 is in the center
-            # Canvas is flat for now
-            pix2light = pos - ti.Vector([x/width - 0.5, 0, (0.5 - y/height) * height_factor], dt=ti.f32)
-            squared_length = pix2light[0]**2 + pix2light[1]**2 + pix2light[2]**2
-            # Calculate angles
-            ray_dir = tm.normalize(pix2light)
-            ray_angle = tm.acos(tm.dot(ray_dir, dir))
-            if ray_angle <= angle:
-                # Calculate light direction
-                u, v = 0.0, 0.0
-                if self._bsdf.coord_sys.value == CoordSys.LatLong.value:
-                    u, v = LightPosTi(xyz=dir).getLLNorm()
-                else: # self._bsdf.coord_sys.value == CoordSys.ZVec.value
-                    u, v = LightPosTi(xyz=dir).getZVecNorm()
-                
-                # Falloff/blend
-                if blend > 0:
-                    falloff = tm.min(tm.sqrt((angle - ray_angle)/angle / blend), 1)
-                    self._buffer[y, x] += self._bsdf.sample(x, y, u, v) * factor * falloff * 1/squared_length
-                else:
-                    self._buffer[y, x] += self._bsdf.sample(x, y, u, v) * factor * 1/squared_length
+            self._buffer[y, x] += self._layers[layer, y, x] * scale
     
     @ti.kernel
-    def sampleArea(self, pos: tib.pixvec, dir: tib.pixvec, angle: ti.f32, size: ti.f32, power: ti.f32, color: tib.pixvec): # Size 2D and rectangle/ellipse shape
-        factor = power * color
-        width, height = self._buffer.shape[1], self._buffer.shape[0]
-        height_factor = self._buffer.shape[0]/self._buffer.shape[1]
-        
+    def sampleBatch(self, frames: tt.ndarray(tib.pixvec, 3), weights: tt.ndarray(tib.pixvec, 2), count: ti.i32):
         for y, x in self._buffer:
-            # Calculate vector to pixel: We assume the canvas is 1m wide and 0,0 is in the center
-            # Canvas is flat for now
-            pix2light = pos - ti.Vector([x/width - 0.5, 0, (0.5 - y/height) * height_factor], dt=ti.f32)
-            squared_length = pix2light[0]**2 + pix2light[1]**2 + pix2light[2]**2
-            # Calculate angles
-            ray_dir = tm.normalize(pix2light)
-            ray_angle = tm.acos(tm.dot(ray_dir, dir))
-            if ray_angle <= angle:
-                # Calculate light direction and sample
-                u, v = 0.0, 0.0
-                if self._bsdf.coord_sys.value == CoordSys.LatLong.value:
-                    u, v = LightPosTi(xyz=dir).getLLNorm()
-                else: # self._bsdf.coord_sys.value == CoordSys.ZVec.value
-                    u, v = LightPosTi(xyz=dir).getZVecNorm()
-                self._buffer[y, x] += self._bsdf.sample(x, y, u, v) * factor * 1/squared_length
+            self._bsdf.sampleWeightedBatch(x, y, weights, frames, count)
+    
+    def sampleHdri(self, env_data: EnvironmentData, samples: int):
+        self.sampleHdriKernel(env_data.hdri, env_data.marginal, env_data.conditional, env_data.pdf, env_data.rotation, env_data.power, samples, self._sample_count)
     
     @ti.kernel
-    def sampleHdri(self, hdri: tib.pixarr, rotation: ti.f32, power: ti.f32, samples: ti.i32):
+    def sampleHdriKernel(self, hdri: tib.pixarr, marginal: tt.ndarray(ti.f32, 2), conditional: tt.ndarray(ti.f32, 2), pdf: tt.ndarray(ti.f32, 2),\
+            rotation: ti.f32, power: ti.f32, samples: ti.i32, pass_index: ti.i32):
+        res_y, res_x = hdri.shape[0], hdri.shape[1]
         for y, x in self._buffer:
+            # Random shift of the low-discrepancy sequence per pixel and pass
+            shift = ti.Vector([ti.random(), ti.random()], dt=ti.f32)
             for i in range(samples):
-                # TODO Multiple Importance Sampling ?
-                # Idea: Sample low count in any direction with blurred HDRI, maybe even with half resolution
-                # Rank values and redo sampling around bright areas (gaussian distribution?) -> sampling bright, important values!
-                # Problem: Bright parts will be exaggerated, need factor of covered area to scale that down again. For non-gaussian distributions it's probably the spherical angle
-                # Far future TODO (especially when we settled on one algorithm): Analytical integration or gradient estimation?
+                xi = (R2Sequence(pass_index*samples + i) + shift) % 1.0
                 
-                #ti.randn(float) # univariate standard normal (Gaussian) distribution of mean 0 and variance 1
-                u = ti.random()#*0.6 # TODO Quick fix to mask out lower part of PTM function that shows only rubbish
-                v = ti.random()
-                hdri_y = ti.cast(u*hdri.shape[0], ti.i32)
-                hdri_x = ti.cast((1-v+rotation)%1.0 * hdri.shape[1], ti.i32)
+                # Importance sample the HDRI: Row from the marginal CDF, column from the conditional CDF of the row
+                hdri_y, frac_y = SampleCdf(marginal, 0, xi[0])
+                hdri_x, frac_x = SampleCdf(conditional, hdri_y, xi[1])
+                u = (hdri_y + frac_y) / res_y
+                v = (1 + rotation - (hdri_x + frac_x) / res_x) % 1.0
                 # Fix range of LatLong coords
-                length = u
                 u, v = 1-u*2, v*2-1
                 
                 if self._bsdf.coord_sys.value == CoordSys.ZVec.value:
                     # Get ZVec from LatLong
                     u, v = LightPosTi().LL2ZVecNorm([u, v], normalized=True)
-                    
-                self._sample_buffer[y, x] += self._bsdf.sample(x, y, u, v) * hdri[hdri_y, hdri_x] * 10 * power / samples
+                
+                # Weight by the PDF, relative to uniform sampling of the HDRI pixels
+                self._sample_buffer[y, x] += self._bsdf.sample(x, y, u, v) * hdri[hdri_y, hdri_x] / pdf[hdri_y, hdri_x] * 10 * power / samples
+
+
+@ti.kernel
+def fillBlocks(pix: ti.template(), stride: ti.i32):
+    """Copies the first pixel of each block to the other block pixels"""
+    for y, x in pix:
+        if y % stride != 0 or x % stride != 0:
+            pix[y, x] = pix[y - y % stride, x - x % stride]
+
+@ti.func
+def R2Sequence(index: ti.i32) -> tm.vec2:
+    """Additive recurrence based on the plastic number, well distributed for any sample count"""
+    return ti.Vector([0.5 + index * 0.7548776662466927, 0.5 + index * 0.5698402909980532], dt=ti.f32) % 1.0
+
+@ti.func
+def SampleCdf(cdf: ti.template(), row: ti.i32, xi: ti.f32):
+    """Binary search for the first CDF entry larger than xi, returns the index and the position inside the entry"""
+    count = cdf.shape[1]
+    lo, hi = 0, count-1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cdf[row, mid] > xi:
+            hi = mid
+        else:
+            lo = mid + 1
+    start = 0.0
+    if lo > 0:
+        start = cdf[row, lo-1]
+    frac = tm.clamp((xi - start) / tm.max(cdf[row, lo] - start, 1e-12), 0.0, 0.9999)
+    return lo, frac
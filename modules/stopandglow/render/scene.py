@@ -1,3 +1,9 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+from numpy.typing import ArrayLike
+import cv2 as cv
+
 from ..data.imgbuffer import *
 from ..utils import *
 
@@ -15,11 +21,23 @@ class LightData:
         self.power=power
         self.color=color
 
+# Resolution of the HDRI copy that is projected onto the basis of linear BSDFs
+HDRI_PROJECTION_RES = (256, 128)
+# Share of uniformly distributed samples for HDRI importance sampling, keeps dark areas with bright BSDF values covered
+HDRI_UNIFORM_SAMPLING = 0.1
+
 class EnvironmentData:
-    def __init__(self, hdri: tib.pixarr, rotation=0.0, power=1.0):
+    def __init__(self, hdri: tib.pixarr, rotation=0.0, power=1.0, lowres=None, distribution=(None, None, None), content=None):
        self.hdri=hdri
+       # Hash of the HDRI pixels
+       self.content=content
        self.rotation=rotation 
        self.power=power
+       # Downscaled HDRI and cached basis projections per rotation
+       self.lowres=lowres
+       self.projections=OrderedDict()
+       # Luminance distribution for importance sampling: Marginal CDF of the rows, conditional CDFs of the columns and pixel PDFs
+       self.marginal, self.conditional, self.pdf = distribution
 
 class Scene:
     def __init__(self):
@@ -28,17 +46,40 @@ class Scene:
         self._spots = []
         self._areas = []
         self._hdri = EnvironmentData(None)
+        # Incremented on every change
+        self._version = 0
+        self._hash = None
+        self._hash_version = None
+        
+    def getVersion(self) -> int:
+        return self._version
+    
+    def getHash(self) -> str:
+        """Hash of all lights and the environment, equal for scenes with the same content"""
+        if self._hash_version != self._version:
+            content = hashlib.blake2b(digest_size=16)
+            for lights in [self._suns, self._points, self._spots, self._areas]:
+                for lgt in lights:
+                    content.update(repr((lgt.position, lgt.direction, lgt.angle, lgt.blend, lgt.size, lgt.power, lgt.color)).encode())
+                content.update(b'|')
+            content.update(repr((self._hdri.content, self._hdri.rotation, self._hdri.power)).encode())
+            self._hash = content.hexdigest()
+            self._hash_version = self._version
+        return self._hash
         
     def clear(self):
+        self._version += 1
         self._suns.clear()
         self._points.clear()
         self._spots.clear()
         self._areas.clear()
     
     def clearHdri(self):
+        self._version += 1
         self._hdri = EnvironmentData(None)
     
     def addLight(self, light_data):
+        self._version += 1
         match light_data['type']:
             case 'sun':
                 self._suns.append(LightData(direction=light_data['dir'], angle=light_data['angle'], power=light_data['power'], color=light_data['color']))
@@ -52,23 +93,38 @@ class Scene:
                 
     
     def addSun(self, light):
+        self._version += 1
         self._suns.append(light)
     
     def addPoint(self, light):
+        self._version += 1
         self._points.append(light)
         
     def addSpot(self, light):
+        self._version += 1
         self._spots.append(light)
     
     def addArea(self, light):
+        self._version += 1
         self._areas.append(light)
     
     def setHdri(self, hdri: ImgBuffer, rotation=0.0, power=1.0):
+        self._version += 1
+        hdri_lin = hdri.asDomain(ImgDomain.Lin).get()
         hdri_buf = ti.ndarray(tib.pixvec, hdri.shape())
-        hdri_buf.from_numpy(hdri.asDomain(ImgDomain.Lin).get())
-        self._hdri = EnvironmentData(hdri_buf, rotation, power)
+        hdri_buf.from_numpy(hdri_lin)
+        lowres = cv.resize(hdri_lin[..., 0:3], HDRI_PROJECTION_RES, interpolation=cv.INTER_AREA)
+        
+        # Sampling distribution
+        marginal, conditional, pdf = HdriDistribution(hdri_lin)
+        distribution = (ti.ndarray(ti.f32, marginal.shape), ti.ndarray(ti.f32, conditional.shape), ti.ndarray(ti.f32, pdf.shape))
+        for buf, arr in zip(distribution, (marginal, conditional, pdf)):
+            buf.from_numpy(arr)
+        content = hashlib.blake2b(np.ascontiguousarray(hdri_lin).tobytes(), digest_size=16).hexdigest()
+        self._hdri = EnvironmentData(hdri_buf, rotation, power, lowres.astype(np.float32), distribution, content)
     
     def setHdriData(self, rotation=None, power=None):
+        self._version += 1
         if rotation is not None:
             self._hdri.rotation = rotation
         if power is not None:
@@ -88,4 +144,20 @@ class Scene:
     
     def getHdri(self):
         return self._hdri
-    
\ No newline at end of file
+
+
+def HdriDistribution(hdri: ArrayLike, uniform=HDRI_UNIFORM_SAMPLING):
+    """Returns the marginal row CDF (1 x H), conditional column CDFs (H x W) and pixel PDFs relative to uniform sampling (H x W)"""
+    lum = np.tensordot(hdri[..., 0:3], [0.2126, 0.7152, 0.0722], axes=([-1], [0])).astype(np.float64)
+    lum = np.maximum(lum, 0)
+    total = lum.sum()
+    # Mix with uniform distribution, also for black HDRIs
+    prob = (1-uniform) * lum / total + uniform / lum.size if total > 0 else np.full(lum.shape, 1 / lum.size)
+    
+    rows = prob.sum(axis=1)
+    marginal = np.cumsum(rows) / rows.sum()
+    conditional = np.cumsum(prob, axis=1) / rows[:, np.newaxis]
+    # Last entries are exactly one so that the search always ends in range
+    marginal[-1] = 1.0
+    conditional[:, -1] = 1.0
+    return marginal[np.newaxis].astype(np.float32), conditional.astype(np.float32), (prob * lum.size).astype(np.float32)
@@ -9,12 +9,13 @@ from .processing_queue import *
 from .commands import *
 from .render import bsdf
 from .utils.utils import GetDatetimeNow
+from .utils.jobs import *
 
 
 def run(port=9271):
-    # Receiver socket
+    # Receiver socket, a ROUTER serves any number of REQ or DEALER clients
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER)
     socket.bind(f"tcp://*:{port}")
     queue = ProcessingQueue(context)
     
@@ -22,221 +23,303 @@ def run(port=9271):
         execute(socket, port, queue)
     except Exception as e:
         log.error(f"Uncaught exception: {str(e)}")
-        send(socket, Message(Command.CommandDisconnect, {'message': f"Error: {str(e)}"}))
     
     # Clean up: Stop process and close socket
     queue.quit()
     context.destroy()
 
 def execute(socket, port, queue):
-    remote_address = ""
-    initalized = False
+    # Remote address and frame transport per client identity, the worker is launched by the first client
+    clients = {}
     
     log.info(f"Server ready and listening on port {port}")
-    while True:
-        #  Wait for next request from client
-        message = receive(socket)
-        if message is None:
-            log.error("Error receiving data")
-            break
-        
-        if (not initalized) and message.command != Command.Init and message.command != Command.Ping:
-            send(socket, Message(Command.CommandError, {'message': "Not initialized"}))
-        
-        # Match command
-        match message.command:
-            case Command.Ping:
-                # Send pong
-                send(socket, Message(Command.Pong, message.data))
-            case Command.Pong:
-                pass
+    try:
+        serve(socket, port, queue, clients)
+    finally:
+        # Shared memory of local clients
+        for info in clients.values():
+            if 'ring' in info:
+                info['ring'].close()
 
-            case Command.Init:
-                remote_address = GetSetting(message.data, 'address', 'localhost')
-                log.info(f"Server: Initializing for {remote_address}")
-                if not initalized:
-                    # Launch queue worker, this will initialize the hardware
-                    queue.launch()
-                    initalized = True
-                send(socket, Message(Command.CommandOkay))
-            
-            ## Config commands for resolution, paths, calibration
-            case Command.ConfResolution:
-                try:
-                    res_x, res_y = message.data['resolution']
-                    # Set resolution
-                    
-                    send(socket, Message(Command.CommandOkay))
-                except:
-                    send(socket, Message(Command.CommandError, {'message': 'Failed to parse resolution value'}))
-            case Command.ConfCapturePath:
-                capture_path = message.data['path']
-                if os.path.isdir(capture_path):
-                    # Set folder
-                    
-                    send(socket, Message(Command.CommandOkay))
-                else:
-                    send(socket, Message(Command.CommandError, {'message': 'Path is not a folder'}))
-            case Command.ConfCalibrationFile:
-                cal_file = message.data['path']
-                if os.path.isfile(cal_file):
-                    # Load cal file
-                    
-                    send(socket, Message(Command.CommandOkay))
-                else:
-                    send(socket, Message(Command.CommandError, {'message': 'Path is not a file'}))
-            
-            ## LightCtl commands
-            case Command.LightCtlTop:
-                queue.putCommand(Commands.Lights, 'top', message.data)
-                send(socket, Message(Command.CommandOkay))
-            case Command.LightCtlRing:
-                queue.putCommand(Commands.Lights, 'ring', message.data)
-                send(socket, Message(Command.CommandOkay))
-            case Command.LightCtlRand:
-                queue.putCommand(Commands.Lights, 'rand', message.data)
-                send(socket, Message(Command.CommandOkay))
-            case Command.LightCtlOff:
-                queue.putCommand(Commands.Lights, 'off')
-                send(socket, Message(Command.CommandOkay))
+def serve(socket, port, queue, clients):
+    launched = False
+    while True:
+        #  Wait for next request from any client, answers are sent on its route
+        try:
+            client, frames = receive_envelope(socket)
+        except Exception as e:
+            log.error(f"Error receiving data: {str(e)}")
+            continue
+        try:
+            message = parse(frames)
+        except Exception as e:
+            # Clients wait for an answer to each request
+            log.error(f"Error parsing request: {str(e)}")
+            send(client, Message(Command.CommandError, {'message': f"Invalid request: {str(e)}"}))
+            continue
+        
+        try:
+            launched = handle(client, message, clients, launched, port, queue)
+        except Exception as e:
+            log.error(f"Command '{message.command.name}' failed: {str(e)}")
+            send(client, Message(Command.CommandError, {'message': f"Error: {str(e)}"}))
 
+def handle(client, message, clients, launched, port, queue) -> bool:
+    """Answers a single request, long operations are queued as jobs. Returns if the worker is launched"""
+    initalized = client.identity in clients
+    remote_address = clients.get(client.identity, {}).get('address', "")
+    transport = clients.get(client.identity, {}).get('transport', {})
+    # Display resolution of the client, frames are sent at the matching level of detail
+    resolution = clients.get(client.identity, {}).get('resolution')
+    if (not initalized) and message.command != Command.Init and message.command != Command.Ping:
+        send(client, Message(Command.CommandError, {'message': "Not initialized"}))
+        return launched
+    
+    # Match command
+    match message.command:
+        case Command.Ping:
+            # Send pong
+            send(client, Message(Command.Pong, message.data))
+        case Command.Pong:
+            pass
 
-            ## Full resoultion footage
-            case Command.CaptureLights | Command.CaptureBaked:
-                # Create folder
-                name = GetSetting(message.data, 'name', GetDatetimeNow(), default_for_empty=True)
-                path = os.path.join(os.path.abspath(queue.getConfig()['seq_folder']), name)
-                pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        case Command.Init:
+            remote_address = GetSetting(message.data, 'address', 'localhost')
+            log.info(f"Server: Initializing for {remote_address}")
+            # Encoding of image frames: dtype, compression and delta
+            transport = negotiate(GetSetting(message.data, 'transport', {}))
+            if client.identity in clients and 'ring' in clients[client.identity]:
+                clients[client.identity]['ring'].close()
+            clients[client.identity] = {'address': remote_address, 'transport': transport, 'resolution': GetSetting(message.data, 'resolution')}
+            if GetSetting(message.data, 'transport', {}).get('shm', False):
+                # Clients on the same host read frames from shared memory, sized for RGBA float frames
+                res_x, res_y = (queue.getConfig() or Config())['resolution']
+                ring = FrameRing.Create(int(res_x) * int(res_y) * 4 * 4)
+                clients[client.identity]['ring'] = ring
+                transport['shm'] = ring.describe()
+            if not launched:
+                # Launch queue worker, this will initialize the hardware
+                queue.launch()
+                launched = True
+            send(client, Message(Command.CommandOkay, {'transport': transport}))
+        
+        ## Config commands for resolution, paths, calibration
+        case Command.ConfResolution:
+            try:
+                res_x, res_y = message.data['resolution']
+                # Set resolution, renderer buffers and data are replaced at runtime
+                queue.putCommand(Commands.Config, 'set', {'resolution': [int(res_x), int(res_y)]})
+                queue.putCommand(Commands.Render, 'resize')
+                send(client, Message(Command.CommandOkay))
+            except:
+                send(client, Message(Command.CommandError, {'message': 'Failed to parse resolution value'}))
+        case Command.ConfCapturePath:
+            capture_path = message.data['path']
+            if os.path.isdir(capture_path):
+                # Set folder
                 
-                send(socket, Message(Command.CommandProcessing, {'path': path}))
-                queue.putCommand(Commands.Capture, 'lights' if Command.CaptureLights else 'baked', {'name': name, 'discard_video': True}) # TODO: Implement discard_video
-                queue.putCommand(Commands.Save, 'all')
-                # Generate depth map
-                queue.putCommand(Commands.Process, 'depth', {'target': 'preview', 'destination': 'data', 'rgb': False})
-                queue.putCommand(Commands.Save, 'data')
-            ## Load from disk
-            case Command.LoadFootage:
-                # Check if path is valid
-                path = message.data['path']
-                if os.path.exists(path):
-                    send(socket, Message(Command.CommandOkay))
-                    
-                    queue.putCommand(Commands.Load, path)
-                    #queue.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data) # TODO
-                    
-                    # If depth map is not available, generate and save
-                    queue.putCommand(Commands.If, 'empty', {'data': 'depth'})
-                    queue.putCommand(Commands.Process, 'depth', {'target': 'preview', 'destination': 'data', 'rgb': False, 'override': False}) # destination: alpha
-                    #queue.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data) # TODO
-                    queue.putCommand(Commands.Save, 'data')
-                    queue.putCommand(Commands.EndIf, 'empty')
-                else:
-                    send(socket, Message(Command.CommandError, {'message': "Path '{path}' doesn not exist"}))
-            
-            
-            ## LightInfo
-            case Command.LightsSet:
-                # Clear light data
-                queue.putCommand(Commands.Render, 'clear')
-                # Add each light separately
-                for light in message.data:
-                    queue.putCommand(Commands.Render, 'light', light)
-                send(socket, Message(Command.CommandOkay))
+                send(client, Message(Command.CommandOkay))
+            else:
+                send(client, Message(Command.CommandError, {'message': 'Path is not a folder'}))
+        case Command.ConfCalibrationFile:
+            cal_file = message.data['path']
+            if os.path.isfile(cal_file):
+                # Load cal file
                 
-            case Command.LightsHdriRotation:
-                queue.putCommand(Commands.Render, 'hdri_data') # TODO data missing
-                queue.putCommand(Commands.Render, 'reset')
-                send(socket, Message(Command.CommandOkay))
+                send(client, Message(Command.CommandOkay))
+            else:
+                send(client, Message(Command.CommandError, {'message': 'Path is not a file'}))
+        
+        ## LightCtl commands
+        case Command.LightCtlTop:
+            queue.putCommand(Commands.Lights, 'top', message.data)
+            send(client, Message(Command.CommandOkay))
+        case Command.LightCtlRing:
+            queue.putCommand(Commands.Lights, 'ring', message.data)
+            send(client, Message(Command.CommandOkay))
+        case Command.LightCtlRand:
+            queue.putCommand(Commands.Lights, 'rand', message.data)
+            send(client, Message(Command.CommandOkay))
+        case Command.LightCtlOff:
+            queue.putCommand(Commands.Lights, 'off')
+            send(client, Message(Command.CommandOkay))
 
-            case Command.LightsHdriTexture:
-                path = message.data['path']
-                if os.path.exists(path):
-                    send(socket, Message(Command.CommandOkay)) 
-                    queue.putCommand(Commands.LoadHdri, path)
-                    queue.putCommand(Commands.Render, 'hdri')
-                    queue.putCommand(Commands.Render, 'reset')
-                    
-                else:
-                    # HDRI Path does not exist
-                    send(socket, Message(Command.CommandError, {'message': "Path '{path}' doesn not exist"}))
-            
-            case Command.CanvasSet:
-                # Hier kommen die transform daten an
-                #message.data
-                send(socket, Message(Command.CommandOkay))
-            
+
+        ## Full resoultion footage
+        case Command.CaptureLights | Command.CaptureBaked:
+            # Create folder
+            name = GetSetting(message.data, 'name', GetDatetimeNow(), default_for_empty=True)
+            path = os.path.join(os.path.abspath(queue.getConfig()['seq_folder']), name)
+            pathlib.Path(path).mkdir(parents=True, exist_ok=True)
             
-            ## Preview
-            case Command.RequestSequence:
-                # id, mode, path in data
-                # Load sequence
-                queue.putCommand(Commands.Load, message.data['path'])
-                
-                if message.data['mode'] == 'render':
-                    # Start rendering
-                    queue.putCommand(Commands.Render, 'render')
+            job = Job(message.command.name, client.identity)
+            job.putCommand(Commands.Capture, 'lights' if message.command == Command.CaptureLights else 'baked', {'name': name, 'discard_video': True}) # TODO: Implement discard_video
+            job.putCommand(Commands.Save, 'all')
+            # Generate depth map
+            job.putCommand(Commands.Process, 'depth', {'target': 'preview', 'destination': 'data', 'rgb': False})
+            job.putCommand(Commands.Save, 'data')
+            job.data['path'] = path
+            send(client, Message(Command.CommandProcessing, {'path': path, 'job': queue.putJob(job)}))
+        ## Load from disk
+        case Command.LoadFootage:
+            # Check if path is valid
+            path = message.data['path']
+            if os.path.exists(path):
+                job = Job(message.command.name, client.identity)
+                job.putCommand(Commands.Load, path)
+                #job.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data) # TODO
                 
-                # Queue sending image and answer
-                queue.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data)                
-                send(socket, Message(Command.CommandProcessing))
-            
-            case Command.RequestCamera:
-                # id, mode in data
-                # Capture and send
-                if message.data['mode'] == 'baked':
-                    queue.putCommand(Commands.Capture, 'baked')
-                else:
-                    queue.putCommand(Commands.Preview, 'live')
-                queue.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data)
-                send(socket, Message(Command.CommandProcessing))
-            
+                # If depth map is not available, generate and save
+                job.putCommand(Commands.If, 'empty', {'data': 'depth'})
+                job.putCommand(Commands.Process, 'depth', {'target': 'preview', 'destination': 'data', 'rgb': False, 'override': False}) # destination: alpha
+                #job.putCommand(Commands.Send, f'{remote_address}:{port+1}', message.data) # TODO
+                job.putCommand(Commands.Save, 'data')
+                job.putCommand(Commands.EndIf, 'empty')
+                send(client, Message(Command.CommandOkay, {'job': queue.putJob(job)}))
+            else:
+                send(client, Message(Command.CommandError, {'message': "Path '{path}' doesn not exist"}))
+        
+        
+        ## LightInfo
+        case Command.LightsSet:
+            # Newer light sets replace queued ones
+            job = Job(message.command.name, client.identity, key='lights')
+            # Clear light data
+            job.putCommand(Commands.Render, 'clear')
+            # Add each light separately
+            for light in message.data:
+                job.putCommand(Commands.Render, 'light', light)
+            send(client, Message(Command.CommandOkay, {'job': queue.putJob(job)}))
             
-            ## Render Algorithmns
-            case Command.GetRenderAlgorithms:
-                answer = {'algorithms': [(name, values[0]) for name, values in algorithms.items() if 'bsdf' in values[2]]}
-                send(socket, Message(Command.CommandAnswer, answer))
+        case Command.LightsHdriRotation:
+            queue.putCommand(Commands.Render, 'hdri_data') # TODO data missing
+            queue.putCommand(Commands.Render, 'reset')
+            send(client, Message(Command.CommandOkay))
+
+        case Command.LightsHdriTexture:
+            path = message.data['path']
+            if os.path.exists(path):
+                send(client, Message(Command.CommandOkay)) 
+                queue.putCommand(Commands.LoadHdri, path)
+                queue.putCommand(Commands.Render, 'hdri')
+                queue.putCommand(Commands.Render, 'reset')
+                
+            else:
+                # HDRI Path does not exist
+                send(client, Message(Command.CommandError, {'message': "Path '{path}' doesn not exist"}))
+        
+        case Command.CanvasSet:
+            # Hier kommen die transform daten an
+            #message.data
+            send(client, Message(Command.CommandOkay))
+        
+        
+        ## Preview
+        case Command.RequestSequence:
+            # id, mode, path in data
+            # Only the latest request of an image is rendered and sent, the job ID is the frame version
+            job = Job(message.command.name, client.identity, key=('image', message.data['id']))
+            # Load sequence
+            job.putCommand(Commands.Load, message.data['path'])
             
-            case Command.GetRenderSettings: # TODO: What settings should be exposed anyway?
-                algo_key = message.data['algorithm']
-                try:
-                    name, algo_class, algo_settings = algorithms[algo_key]
-                    answer = algo_class.getDefaultSettings()
-                    send(socket, Message(Command.CommandAnswer, answer))
-                except:
-                    send(socket, Message(Command.CommandError, {'message': 'No valid algorithm specified'}))
+            if message.data['mode'] == 'render':
+                # Start rendering, requests can override the resolution of Init
+                job.putCommand(Commands.Render, 'render', {'resolution': GetSetting(message.data, 'resolution', resolution)})
             
-            case Command.SetRenderer:
-                algo_key = message.data['algorithm']
-                if algo_key in algorithms:
-                    send(socket, Message(Command.CommandOkay))
-                    
-                    # Generate algorithm data if needed
-                    if algorithms[algo_key][1] is not None: # Processing class for algorithm exists
-                        queue.putCommand(Commands.If, 'empty', {'data': algo_key})
-                        queue.putCommand(Commands.Process, 'fitting', {'fitter': algo_key, 'target': 'sequence', 'destination': 'data'})
-                        queue.putCommand(Commands.Save, 'data')
-                        queue.putCommand(Commands.EndIf, 'empty')
-                    # Also generate normal map
-                    queue.putCommand(Commands.If, 'empty', {'data': 'normal'})
-                    queue.putCommand(Commands.Process, 'generate', {'generator': 'normal', 'target': 'sequence', 'destination': 'data'})
-                    queue.putCommand(Commands.Save, 'data')
-                    queue.putCommand(Commands.EndIf, 'empty')
-                    # Configure renderer
-                    queue.putCommand(Commands.Render, 'config', message.data)
-                    queue.putCommand(Commands.Render, 'init')
+            # Queue sending image and answer
+            job.putCommand(Commands.Send, f'{remote_address}:{port+1}', {'resolution': resolution, **message.data, 'transport': transport})
+            send(client, Message(Command.CommandProcessing, {'job': queue.putJob(job)}))
+        
+        case Command.RequestCamera:
+            # id, mode in data
+            # Capture and send
+            job = Job(message.command.name, client.identity, key=('image', message.data['id']))
+            if message.data['mode'] == 'baked':
+                job.putCommand(Commands.Capture, 'baked')
+            else:
+                job.putCommand(Commands.Preview, 'live')
+            job.putCommand(Commands.Send, f'{remote_address}:{port+1}', {'resolution': resolution, **message.data, 'transport': transport})
+            send(client, Message(Command.CommandProcessing, {'job': queue.putJob(job)}))
+        
+        
+        case Command.RenderBatch:
+            # Turntable with 'rotations' or list of light sets in 'scenes', written to the sequence folder
+            name = GetSetting(message.data, 'name', GetDatetimeNow(), default_for_empty=True)
+            path = os.path.join(os.path.abspath(queue.getConfig()['seq_folder']), name)
+            job = Job(message.command.name, client.identity)
+            job.putCommand(Commands.Render, 'batch', {**message.data, 'name': name})
+            job.data['path'] = path
+            send(client, Message(Command.CommandProcessing, {'path': path, 'job': queue.putJob(job)}))
+        
+        ## Jobs
+        case Command.RequestStatus:
+            # Status of the job with 'job' ID or all jobs of the client
+            if 'job' in message.data:
+                job = queue.jobs.get(message.data['job'])
+                if job is None:
+                    send(client, Message(Command.CommandError, {'message': f"Unknown job {message.data['job']}"}))
+                elif job.state == JobState.Done:
+                    send(client, Message(Command.CommandComplete, job.status()))
+                elif job.state == JobState.Failed:
+                    send(client, Message(Command.CommandError, job.status()))
                 else:
-                    send(socket, Message(Command.CommandError, {'message': 'No valid algorithm specified'}))
+                    send(client, Message(Command.CommandProgress, job.status()))
+            else:
+                send(client, Message(Command.CommandAnswer, {'jobs': [job.status() for job in queue.jobs.list(client.identity)]}))
+        
+        case Command.RequestStop:
+            # Cancels the job with 'job' ID or all jobs of the client, running jobs stop at the next tile or frame
+            count = queue.jobs.cancel(message.data.get('job'), client.identity)
+            send(client, Message(Command.CommandOkay, {'cancelled': count}))
+        
+        
+        ## Render Algorithmns
+        case Command.GetRenderAlgorithms:
+            answer = {'algorithms': [(name, values[0]) for name, values in algorithms.items() if 'bsdf' in values[2]]}
+            send(client, Message(Command.CommandAnswer, answer))
+        
+        case Command.GetRenderSettings: # TODO: What settings should be exposed anyway?
+            algo_key = message.data['algorithm']
+            try:
+                name, algo_class, algo_settings = algorithms[algo_key]
+                answer = algo_class.getDefaultSettings()
+                send(client, Message(Command.CommandAnswer, answer))
+            except:
+                send(client, Message(Command.CommandError, {'message': 'No valid algorithm specified'}))
+        
+        case Command.SetRenderer:
+            algo_key = message.data['algorithm']
+            if algo_key in algorithms:
+                job = Job(message.command.name, client.identity)
+                # Generate algorithm data if needed
+                if algorithms[algo_key][1] is not None: # Processing class for algorithm exists
+                    job.putCommand(Commands.If, 'empty', {'data': algo_key})
+                    job.putCommand(Commands.Process, 'fitting', {'fitter': algo_key, 'target': 'sequence', 'destination': 'data'})
+                    job.putCommand(Commands.Save, 'data')
+                    job.putCommand(Commands.EndIf, 'empty')
+                # Also generate normal map
+                job.putCommand(Commands.If, 'empty', {'data': 'normal'})
+                job.putCommand(Commands.Process, 'generate', {'generator': 'normal', 'target': 'sequence', 'destination': 'data'})
+                job.putCommand(Commands.Save, 'data')
+                job.putCommand(Commands.EndIf, 'empty')
+                # Configure renderer
+                job.putCommand(Commands.Render, 'config', message.data)
+                job.putCommand(Commands.Render, 'init')
+                send(client, Message(Command.CommandOkay, {'job': queue.putJob(job)}))
+            else:
+                send(client, Message(Command.CommandError, {'message': 'No valid algorithm specified'}))
 
-                
-            ## Live Viewer
-            case Command.ViewerLaunch:    
-                
-                send(socket, Message(Command.CommandAnswer, answer))
-            
-            ## Camera settings
-            #case Command.CameraSettings:
-            #case Command.CameraPosition:
             
-            case _:
-                send(socket, Message(Command.CommandError, {"message": "Unknown command"}))
+        ## Live Viewer
+        case Command.ViewerLaunch:    
             
+            send(client, Message(Command.CommandAnswer, answer))
+        
+        ## Camera settings
+        #case Command.CameraSettings:
+        #case Command.CameraPosition:
+        
+        case _:
+            send(client, Message(Command.CommandError, {"message": "Unknown command"}))
+    
+    return launched
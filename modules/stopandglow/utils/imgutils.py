@@ -17,6 +17,25 @@ def StackChannels(channels: list[ImgBuffer], path=None) -> ImgBuffer:
     channels_get = [channel.get() for channel in channels]
     return ImgBuffer(path=path, img=np.dstack(channels_get), domain=channels[0].domain())
 
+### Level of detail ###
+# Coarsest mip level, each level halves the resolution
+MAX_LOD = 4
+
+def LodLevel(resolution, target) -> int:
+    """Coarsest mip level of the resolution that still covers the target resolution, 0 without target"""
+    level = 0
+    if target:
+        while level < MAX_LOD and resolution[0] >> (level+1) >= target[0] and resolution[1] >> (level+1) >= target[1]:
+            level += 1
+    return level
+
+def HalfSize(img: ArrayLike) -> ArrayLike:
+    """Next mip level, averages 2x2 pixels"""
+    height, width = img.shape[0:2]
+    half = cv.resize(img, (max(width//2, 1), max(height//2, 1)), interpolation=cv.INTER_AREA)
+    # Single channels keep their axis
+    return half.reshape(half.shape[0:2] + img.shape[2:])
+
 ### Numpy Image quick save functions ###
 def SaveBase(img: ArrayLike, name, img_format=ImgFormat.PNG):
     path = os.path.abspath(os.path.join(DATA_BASE_PATH, name))
@@ -0,0 +1,130 @@
+from enum import Enum
+import threading
+import itertools
+import time
+
+# Number of finished jobs kept for status requests
+JOB_HISTORY = 64
+
+
+class JobState(Enum):
+    Queued = 0
+    Running = 1
+    Done = 2
+    Cancelled = 3
+    Failed = 4
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Group of worker commands with a shared state, progress and cancellation flag
+    A new job with the same key and client supersedes unfinished older ones"""
+    def __init__(self, name: str, client=None, key=None):
+        self.id = None
+        self.name = name
+        self.client = client
+        self.key = key
+        self.state = JobState.Queued
+        self.progress = 0.0
+        self.message = ""
+        self.data = {}
+        self.commands = []
+        self._done = 0
+        self._cancel = threading.Event()
+        self._finished = None
+
+    def putCommand(self, command, arg, settings={}):
+        self.commands.append((command, arg, settings))
+
+    def cancel(self):
+        self._cancel.set()
+        if self.state == JobState.Queued:
+            self.finish(JobState.Cancelled)
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def finished(self) -> bool:
+        return self.state in [JobState.Done, JobState.Cancelled, JobState.Failed]
+
+    def finish(self, state: JobState, message=""):
+        self.state = state
+        self.message = message
+        self._finished = time.monotonic()
+        if state == JobState.Done:
+            self.progress = 1.0
+
+    def step(self, fraction: float):
+        """Progress of the running command, 0 to 1"""
+        self.progress = (self._done + min(max(fraction, 0.0), 1.0)) / max(len(self.commands), 1)
+
+    def commandDone(self):
+        self._done += 1
+        if not self.cancelled():
+            self.step(0.0)
+        if self._done >= len(self.commands) and not self.finished():
+            self.finish(JobState.Cancelled if self.cancelled() else JobState.Done)
+
+    def status(self) -> dict:
+        return {'job': self.id, 'name': self.name, 'state': self.state.name, 'progress': self.progress, 'message': self.message, **self.data}
+
+
+class JobTable:
+    """Thread-safe list of jobs shared by the server and the worker"""
+    def __init__(self):
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, job: Job) -> int:
+        with self._lock:
+            job.id = next(self._ids)
+            # Outdated requests are dropped before they run or stop at the next checkpoint
+            if job.key is not None:
+                for other in self._jobs.values():
+                    if other.key == job.key and other.client == job.client and not other.finished():
+                        other.cancel()
+                        other.message = f"Superseded by job {job.id}"
+            self._jobs[job.id] = job
+            # Forget the oldest finished jobs
+            finished = sorted([j for j in self._jobs.values() if j.finished()], key=lambda j: j._finished)
+            for old in finished[0:max(0, len(finished) - JOB_HISTORY)]:
+                del self._jobs[old.id]
+        return job.id
+
+    def get(self, id) -> Job | None:
+        with self._lock:
+            return self._jobs.get(id)
+
+    def list(self, client=None) -> list:
+        with self._lock:
+            return [job for job in self._jobs.values() if client is None or job.client == client]
+
+    def cancel(self, id=None, client=None) -> int:
+        """Cancels the job with the ID or all unfinished jobs of the client, returns the number of cancelled jobs"""
+        jobs = [self.get(id)] if id is not None else self.list(client)
+        jobs = [job for job in jobs if job is not None and not job.finished()]
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+
+# Job of the command running on this thread
+_current = threading.local()
+
+def SetCurrentJob(job: Job | None):
+    _current.job = job
+
+def CurrentJob() -> Job | None:
+    return getattr(_current, 'job', None)
+
+def JobStep(index: int, count: int):
+    """Progress checkpoint for loops over tiles or frames, raises JobCancelled when the running job got cancelled"""
+    job = CurrentJob()
+    if job is not None:
+        if job.cancelled():
+            raise JobCancelled(f"Job {job.id} '{job.name}' cancelled")
+        job.step(index / max(count, 1))
@@ -38,3 +38,49 @@ def factorial2(n: int) -> int:
             val *= i
     return val
 
+
+@ti.func
+def ShBasisTi(lat: ti.f32, long: ti.f32, degree: ti.template()):
+    """Real spherical harmonics up to degree in the order (0,0), (1,-1), (1,0), (1,1), (2,-2), ...
+    lat is the angle from the zenith, the associated Legendre polynomials are evaluated with a branch-free recurrence"""
+    basis = ti.Vector.zero(ti.f32, (degree+1)**2)
+    z, r = ti.cos(lat), ti.sin(lat)
+    cos_long, sin_long = ti.cos(long), ti.sin(long)
+    # P(m, m), sine and cosine of m*long
+    p_mm, cos_m, sin_m = 1.0, 1.0, 0.0
+    p, p_prev, p_next, tmp = 0.0, 0.0, 0.0, 0.0
+    for m in ti.static(range(degree+1)):
+        if ti.static(m > 0):
+            p_mm *= (2*m - 1) * r
+            tmp = cos_m * cos_long - sin_m * sin_long
+            sin_m = sin_m * cos_long + cos_m * sin_long
+            cos_m = tmp
+        p, p_prev = p_mm, 0.0
+        for l in ti.static(range(m, degree+1)):
+            if ti.static(l > m):
+                # P(l, m) from P(l-1, m) and P(l-2, m)
+                p_next = ((2*l - 1) * z * p - (l + m - 1) * p_prev) / (l - m)
+                p_prev = p
+                p = p_next
+            norm = ti.static(math.sqrt((2*l + 1) / (4*math.pi) * math.factorial(l-m) / math.factorial(l+m)))
+            if ti.static(m == 0):
+                basis[l*(l+1)] = norm * p
+            else:
+                basis[l*(l+1) + m] = root_two * norm * p * cos_m
+                basis[l*(l+1) - m] = root_two * norm * p * sin_m
+    return basis
+
+@ti.kernel
+def ShBasisKernel(lat: ti.types.ndarray(dtype=ti.f32, ndim=1), long: ti.types.ndarray(dtype=ti.f32, ndim=1), basis: ti.types.ndarray(dtype=ti.f32, ndim=2), degree: ti.template()):
+    for i in lat:
+        values = ShBasisTi(lat[i], long[i], degree)
+        for k in range((degree+1)**2):
+            basis[k, i] = values[k]
+
+def ShBasis(lat, long, count) -> np.ndarray:
+    """Host version of ShBasisTi for count coefficients, lat and long can be arrays"""
+    lat, long = np.broadcast_arrays(np.asarray(lat, dtype=np.float32), np.asarray(long, dtype=np.float32))
+    degree = math.ceil(math.sqrt(count)) - 1
+    basis = np.zeros(((degree+1)**2, lat.size), dtype=np.float32)
+    ShBasisKernel(np.ascontiguousarray(lat.reshape(-1)), np.ascontiguousarray(long.reshape(-1)), basis, degree)
+    return basis[0:count].reshape((count,) + lat.shape)
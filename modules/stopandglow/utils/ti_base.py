@@ -1,6 +1,13 @@
+from collections import OrderedDict
+import logging as log
+import numpy as np
+
 import taichi as ti
 import taichi.math as tm
 import taichi.types as tt
+from taichi.lang import impl
+from taichi.lang.struct import StructType, StructField
+from taichi.lang.matrix import MatrixType, MatrixField
 
 # Types
 pixvec = tt.vector(3, ti.f32)
@@ -22,6 +29,113 @@ class TIBase:
             ti.init(arch=ti.gpu if TIBase.gpu else ti.cpu, debug=TIBase.debug)
             TIBase._initialized = True
 
+
+class FieldPool:
+    """Fields placed in their own SNode trees so they can be freed. Released fields are kept for reuse with the same type and shape
+    until the budget of unused memory or the number of unused trees is exceeded, then the least recently released trees are destroyed.
+    Each tree counts against the limit of SNode trees per program (512 for the LLVM backends)."""
+    budget = 2**30
+    max_trees = 128
+    _free = OrderedDict() # (type key, shape) -> list of (field, tree, bytes)
+    _used = dict() # id(field) -> (key, tree, bytes)
+    _free_bytes = 0
+    _free_trees = 0
+    
+    def alloc(dtype, shape, zero=True):
+        shape = tuple(shape)
+        key = (TypeKey(dtype), shape)
+        if key in FieldPool._free:
+            field, tree, size = FieldPool._free[key].pop()
+            if len(FieldPool._free[key]) == 0:
+                del FieldPool._free[key]
+            FieldPool._free_bytes -= size
+            FieldPool._free_trees -= 1
+            if zero:
+                field.fill(0)
+        else:
+            builder = ti.FieldsBuilder()
+            field = dtype.field() if isinstance(dtype, StructType) else ti.field(dtype)
+            builder.dense(ti.axes(*range(len(shape))), shape).place(field)
+            tree = builder.finalize()
+            size = FieldBytes(dtype, shape)
+        FieldPool._used[id(field)] = (key, tree, size)
+        return field
+    
+    def release(field):
+        """Returns a field to the pool, it must not be used afterwards"""
+        if field is None or not id(field) in FieldPool._used:
+            return
+        key, tree, size = FieldPool._used.pop(id(field))
+        FieldPool._free.setdefault(key, []).append((field, tree, size))
+        FieldPool._free.move_to_end(key)
+        FieldPool._free_bytes += size
+        FieldPool._free_trees += 1
+        # Destroying trees recompiles all kernels, only free memory when over budget
+        while FieldPool._free_bytes > FieldPool.budget or FieldPool._free_trees > FieldPool.max_trees:
+            FieldPool.destroy(next(iter(FieldPool._free)))
+    
+    def free(field):
+        """Destroys the tree of a field immediately, kernels are recompiled on their next launch. Needed when a field
+        attribute of a data oriented object is replaced, compiled kernels would still access the previous field otherwise."""
+        if field is None or not id(field) in FieldPool._used:
+            return
+        _, tree, _ = FieldPool._used.pop(id(field))
+        DestroyTree(field, tree)
+    
+    def clear():
+        """Frees the memory of all unused fields"""
+        while len(FieldPool._free) > 0:
+            FieldPool.destroy(next(iter(FieldPool._free)))
+    
+    def clearResolution(resolution):
+        """Frees unused fields of a resolution that is not rendered anymore, i.e. shapes ending with (height, width)"""
+        resolution = tuple(resolution)
+        for key in [key for key in FieldPool._free if key[1][-2:] == resolution]:
+            FieldPool.destroy(key)
+    
+    def destroy(key):
+        for field, tree, size in FieldPool._free.pop(key):
+            DestroyTree(field, tree)
+            FieldPool._free_bytes -= size
+            FieldPool._free_trees -= 1
+        log.debug(f"Freed fields with shape {key[1]}")
+    
+    def usedBytes() -> int:
+        return sum(size for _, _, size in FieldPool._used.values())
+    
+    def freeBytes() -> int:
+        return FieldPool._free_bytes
+
+def DestroyTree(field, tree):
+    """Destroys the tree of a field. Taichi checks the shapes of matrix fields created since the last kernel compilation,
+    destroyed ones have to be taken out of that list first."""
+    destroyed = set(id(member) for member in MatrixFields(field))
+    runtime = impl.get_runtime()
+    runtime.matrix_fields = [member for member in runtime.matrix_fields if not id(member) in destroyed]
+    tree.destroy()
+
+def MatrixFields(field) -> list:
+    if isinstance(field, MatrixField):
+        return [field]
+    if isinstance(field, StructField):
+        return [member for value in field.field_dict.values() for member in MatrixFields(value)]
+    return []
+
+def TypeKey(dtype):
+    """Hashable key for field types, vector and matrix types are created anew with each call"""
+    if isinstance(dtype, MatrixType):
+        return (dtype.n, dtype.m, dtype.dtype)
+    return dtype
+
+def FieldBytes(dtype, shape) -> int:
+    if isinstance(dtype, StructType):
+        size = sum(FieldBytes(member, ()) for member in dtype.members.values())
+    elif isinstance(dtype, MatrixType):
+        size = dtype.n * dtype.m * FieldBytes(dtype.dtype, ())
+    else:
+        size = np.dtype(ti.lang.util.to_numpy_type(dtype)).itemsize
+    return size * int(np.prod(shape))
+
 @ti.kernel
 def copyToPixarr(pix: pixarr, field_in: ti.template()):
     for y,x in pix:
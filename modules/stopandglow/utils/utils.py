@@ -1,3 +1,4 @@
+import importlib
 from datetime import datetime
 from contextlib import contextmanager
 import logging
@@ -28,4 +29,15 @@ def logging_disabled(highest_level=logging.CRITICAL):
 
 def GetDatetimeNow():
     return datetime.now().strftime("%Y%m%d_%H%M")
-  
\ No newline at end of file
+
+
+class LazyImport:
+    """Module stand-in that imports the module on first attribute access, for dependencies with slow imports"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, key):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, key)
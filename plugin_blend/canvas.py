@@ -201,7 +201,7 @@ def getTexture(canvas_obj, frame):
         image_name = canvas.canvas_texture
         if image_name in bpy.data.images and client.connected:
             id = client.serviceAddReq(image_name)
-            message = ipc.Message(ipc.Command.RequestCamera, {'id': id, 'mode': canvas.display_mode})
+            message = ipc.Message(ipc.Command.RequestCamera, {'id': id, 'mode': canvas.display_mode, 'resolution': client.getViewportResolution()})
             client.sendMessage(message)    
             return bpy.data.images[image_name]
         return None
@@ -253,7 +253,7 @@ def getTextureForIdx(canvas_obj, index, display_mode=None):
     # If command is set, generate ID for requested image and send request
     if cmd_mode is not None:
         id = client.serviceAddReq(image_name)
-        message = ipc.Message(ipc.Command.RequestSequence, {'mode': cmd_mode, 'id': id, 'path': canvas_frame.seq_path})
+        message = ipc.Message(ipc.Command.RequestSequence, {'mode': cmd_mode, 'id': id, 'path': canvas_frame.seq_path, 'resolution': client.getViewportResolution()})
         client.sendMessage(message)    
     
     # Return texture
@@ -22,15 +22,23 @@ server = None
 receiver = None
 receiver_lock = Lock()
 receiver_queue = queue.Queue()
+# Shared memory frames of a local server
+ring = None
 
 # Request data
 image_requests = {}
 request_count = 0
+# Newest received frame version per image ID, older frames are dropped
+frame_versions = {}
 
 # Constants
 SERVER_CWD = os.path.abspath("../../")
 SERVER_COMMAND = [".venv/bin/python", "server.py"]
 PING_INTERVAL = 10
+# Requested frame encoding, the server picks the first codec it supports
+# Raw float frames are fastest on the same host, half floats with compression save bandwidth for remote servers
+TRANSPORT_LOCAL = {'shm': True}
+TRANSPORT_REMOTE = {'dtype': 'float16', 'codecs': ['lz4', 'zstd'], 'delta': False}
 
 # -------------------------------------------------------------------
 # Launch, Connect, Send
@@ -52,6 +60,7 @@ def smvpConnect(address, port) -> bool:
     global connected
     global server
     global receiver
+    global ring
     
     # First close any remaining connections
     smvpDisconnect()
@@ -64,11 +73,16 @@ def smvpConnect(address, port) -> bool:
     send_sock.setsockopt(zmq.RCVTIMEO, 1000)
     send_sock.setsockopt(zmq.LINGER, 0)
     # Send an init message and wait for answer
-    message = Message(Command.Init, {'address': getHostname()})
+    transport = TRANSPORT_LOCAL if address in ['localhost', '127.0.0.1'] else TRANSPORT_REMOTE
+    message = Message(Command.Init, {'address': getHostname(), 'transport': transport, 'resolution': getViewportResolution()})
     try:
-        connected = sendMessage(message, reconnect=False, force=True) is not None
+        answer = sendMessage(message, reconnect=False, force=True)
+        connected = answer is not None
         
         if connected:
+            # Attach to the frame slots when the server offers them
+            transport = answer.data.get('transport', {}) if isinstance(answer.data, dict) else {}
+            ring = FrameRing.Attach(transport['shm']) if 'shm' in transport else None
             # Launch service, receiving port is server port +1
             receiver = Thread(target=serviceRun, args=(port+1, ))
             receiver.start()
@@ -84,6 +98,7 @@ def smvpDisconnect():
     global send_sock
     global connected
     global receiver
+    global ring
     
     # Unregister ping function
     if bpy.app.timers.is_registered(ping):
@@ -96,6 +111,11 @@ def smvpDisconnect():
         # Wait for receiver to finish
         if receiver is not None:
             receiver.join()
+        if ring is not None:
+            ring.close()
+            ring = None
+        # Versions are counted per server run
+        frame_versions.clear()
 
 def sendMessage(message, reconnect=True, force=False) -> Message|None:
     global send_sock
@@ -149,6 +169,7 @@ def serviceRemoveReq(image_name):
     old_ids = [id for id, data in image_requests.items() if data[0] == image_name]
     for id in old_ids:
         del image_requests[id]
+        frame_versions.pop(id, None)
 
 def serviceGetReq(image_name):
     global image_requests
@@ -182,6 +203,8 @@ def serviceRun(port):
         # Set timeout and disconnect after timeout option
         recv_sock.setsockopt(zmq.LINGER, 0)
 
+        # Keeps reference frames for delta encoded images
+        decoder = FrameDecoder()
         # Poller
         poller = zmq.Poller()
         poller.register(recv_sock, zmq.POLLIN)
@@ -191,7 +214,9 @@ def serviceRun(port):
             if poller.poll(500):
                 # Data received
                 try:
-                    id, img_data = receive_array(recv_sock)
+                    meta = {}
+                    id, img_data = receive_array(recv_sock, decoder=decoder, ring=ring, meta=meta)
+                    version = meta.get('version') or 0
                     
                     if not id in image_requests:
                         # ID got removed, send stop
@@ -200,10 +225,16 @@ def serviceRun(port):
                         # Image missing
                         ipc.send(recv_sock, Message(Command.RecvStop))
                         print(f"SMVP receiver warning: Image {image_requests[id][0]} not found")
+                    elif version < frame_versions.get(id, 0):
+                        # Superseded frame, a newer one is already shown
+                        ipc.send(recv_sock, Message(Command.RecvOkay))
                     else:
+                        frame_versions[id] = version
                         ipc.send(recv_sock, Message(Command.RecvOkay))
                         # Add data to queue and launch timer to apply on main thread
-                        receiver_queue.put((id, np.flipud(img_data).flatten()))
+                        # Frames can come at a lower level of detail than the image size
+                        size = (img_data.shape[1], img_data.shape[0])
+                        receiver_queue.put((id, size, np.flipud(img_data).flatten().astype(np.float32, copy=False)))
                         if not bpy.app.timers.is_registered(serviceApply):
                             bpy.app.timers.register(serviceApply)
                 except Exception as e:
@@ -218,14 +249,21 @@ def serviceRun(port):
 def serviceApply():
     global image_requests
     
+    # Only the newest frame of each image is applied
+    frames = {}
     while not receiver_queue.empty():
-        id, pix_data = receiver_queue.get()
+        id, size, pix_data = receiver_queue.get()
+        frames[id] = (size, pix_data)
+    for id, (size, pix_data) in frames.items():
         # In case ID got removed before timer can access it
         if id in image_requests:
-            # Update image
-            bpy.data.images[image_requests[id][0]].pixels.foreach_set(pix_data)
+            # Update image, resized to the level of the frame
+            image = bpy.data.images[image_requests[id][0]]
+            if tuple(image.size) != size:
+                image.scale(*size)
+            image.pixels.foreach_set(pix_data)
             # Set update flag and mark as received
-            bpy.data.images[image_requests[id][0]].update_tag()
+            image.update_tag()
             image_requests[id] = (image_requests[id][0], True)
         
     return None
@@ -255,6 +293,11 @@ def ping():
 # -------------------------------------------------------------------
 # Helpers
 # -------------------------------------------------------------------        
+def getViewportResolution():
+    """Size of the largest 3D viewport, frames don't need more pixels than that"""
+    sizes = [(area.width, area.height) for window in bpy.context.window_manager.windows for area in window.screen.areas if area.type == 'VIEW_3D']
+    return max(sizes, key=lambda size: size[0]*size[1]) if len(sizes) > 0 else None
+
 def getHostname():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(('8.8.8.8', 1))  # connect() for UDP doesn't send packets
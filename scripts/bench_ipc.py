@@ -0,0 +1,87 @@
+# Transport benchmark: Round trip time of a 4K RGBA float frame over zmq, pickled messages against the framed encodings
+# Usage: python scripts/bench_ipc.py [width] [height]
+import os
+import sys
+import time
+import pickle
+import threading
+import numpy as np
+import zmq
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "modules"))
+from sng_ipc import *
+
+RESOLUTION = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (3840, 2160)
+REPEATS = 10
+ADDRESS = "tcp://127.0.0.1:9381"
+
+
+def createFrames(count):
+    # Smooth shading with noise like a progressive render, every frame changes a tenth of the image
+    width, height = RESOLUTION
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width, y / height, np.full_like(x, 0.5), np.ones_like(x)], axis=-1)
+    rng = np.random.default_rng(0)
+    frames = []
+    frame = base + rng.normal(0, 0.01, base.shape).astype(np.float32)
+    for i in range(count):
+        frame = frame.copy()
+        rows = slice((i % 10) * height // 10, (i % 10 + 1) * height // 10)
+        frame[rows, :, 0:3] += rng.normal(0, 0.01, frame[rows, :, 0:3].shape).astype(np.float32)
+        frames.append(frame)
+    return frames
+
+def receiver(context, mode, stop):
+    socket = context.socket(zmq.REP)
+    socket.bind(ADDRESS)
+    decoder = FrameDecoder()
+    while not stop.is_set():
+        if socket.poll(100):
+            if mode == 'pickle':
+                frame = pickle.loads(socket.recv()).data['img']
+            else:
+                _, frame = receive_array(socket, decoder=decoder)
+            # Plugin converts to float32 pixels
+            frame.astype(np.float32, copy=False)
+            send(socket, Message(Command.RecvOkay))
+    socket.close()
+
+def benchmark(context, frames, mode, encoder=None):
+    stop = threading.Event()
+    thread = threading.Thread(target=receiver, args=(context, mode, stop))
+    thread.start()
+    socket = context.socket(zmq.REQ)
+    socket.connect(ADDRESS)
+
+    times, sizes = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        if mode == 'pickle':
+            payload = pickle.dumps(Message(Command.RequestRender, {'id': 0, 'img': frame}), pickle.HIGHEST_PROTOCOL)
+            socket.send(payload)
+            sizes.append(len(payload))
+        else:
+            sizes.append(send_array(socket, 0, frame, encoder=encoder))
+        receive(socket)
+        times.append(time.perf_counter() - start)
+
+    stop.set()
+    thread.join()
+    socket.close()
+    # First frame warms up connections and has no delta reference
+    return np.mean(times[1:]) * 1000, np.mean(sizes[1:]) / 2**20
+
+
+if __name__ == '__main__':
+    context = zmq.Context()
+    frames = createFrames(REPEATS + 1)
+    print(f"Round trip at {RESOLUTION[0]}x{RESOLUTION[1]} RGBA, codecs available: {', '.join(codecs())}")
+
+    variants = [('pickle float32', 'pickle', None), ('raw float32', 'raw', None), ('float16', 'raw', lambda: FrameEncoder('float16'))]
+    for codec in codecs():
+        variants.append((f"float16 {codec}", 'raw', lambda codec=codec: FrameEncoder('float16', codec)))
+        variants.append((f"float16 delta {codec}", 'raw', lambda codec=codec: FrameEncoder('float16', codec, delta=True)))
+    for name, mode, create in variants:
+        ms, mib = benchmark(context, frames, mode, create() if create is not None else None)
+        print(f"  {name:24s} {ms:8.1f} ms {mib:8.1f} MiB")
+    context.destroy()
@@ -0,0 +1,72 @@
+# Render benchmark: Measures the render time of a PTM with random coefficients against the light count
+# Usage: python scripts/bench_render.py [width] [height] [--cpu]
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "modules"))
+import taichi as ti
+from stopandglow.utils import ti_base as tib
+from stopandglow.data import *
+from stopandglow.render import *
+
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+RESOLUTION = (int(ARGS[0]), int(ARGS[1])) if len(ARGS) > 1 else (1920, 1080)
+LIGHT_COUNTS = [1, 5, 10, 20, 40, 80]
+COEFFICIENTS = 10
+REPEATS = 10
+
+
+def createRenderer() -> Renderer:
+    # Sequence with random PTM coefficients
+    rng = np.random.default_rng(0)
+    coeff_seq = Sequence()
+    for i in range(COEFFICIENTS):
+        coeff_seq.append(ImgBuffer(img=rng.random((RESOLUTION[1], RESOLUTION[0], 3), dtype=np.float32)), i)
+    sequence = Sequence()
+    sequence.setDataSequence('ptm', coeff_seq)
+
+    bsdf_class, bsdf_settings = bsdfs['ptm']
+    bsdf = bsdf_class()
+    bsdf.configure(None, 'ptm', bsdf_settings)
+    renderer = Renderer(bsdf, RESOLUTION)
+    renderer.loadSequence(sequence)
+    return renderer
+
+def setupScene(scene: Scene, count: int, types=3):
+    # Mix of light types spread around the canvas, only suns for types=1
+    scene.clear()
+    rng = np.random.default_rng(count)
+    for i in range(count):
+        pos = [rng.uniform(-0.5, 0.5), rng.uniform(0.2, 1.0), rng.uniform(-0.5, 0.5)]
+        match i % types:
+            case 0:
+                scene.addSun(LightData(direction=list(rng.uniform(0, 1, 2)), power=0.1))
+            case 1:
+                scene.addPoint(LightData(position=pos, power=0.1))
+            case 2:
+                scene.addSpot(LightData(position=pos, direction=[0, 1, 0], angle=1.5, blend=0.2, power=0.1))
+
+
+if __name__ == '__main__':
+    tib.TIBase.debug = False
+    tib.TIBase.gpu = not '--cpu' in sys.argv
+    tib.TIBase.init()
+    renderer = createRenderer()
+
+    print(f"Render times at {RESOLUTION[0]}x{RESOLUTION[1]} ({ti.lang.impl.current_cfg().arch.name}), mixed lights / suns only")
+    for count in LIGHT_COUNTS:
+        times = []
+        for types in [3, 1]:
+            setupScene(renderer.getScene(), count, types)
+            # Warm up, compiles kernels
+            renderer.sample()
+            ti.sync()
+
+            start = time.perf_counter()
+            for _ in range(REPEATS):
+                renderer.sample()
+            ti.sync()
+            times.append((time.perf_counter() - start) / REPEATS)
+        print(f"  {count:3d} lights {times[0]*1000:8.2f} ms {times[1]*1000:8.2f} ms")
@@ -0,0 +1,44 @@
+# Startup benchmark: Measures how long fresh interpreters need until commands can be executed
+# Usage: python scripts/bench_startup.py [runs]
+import os
+import sys
+import time
+import subprocess
+import statistics
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+PREFIX = "import sys; sys.path.append('./modules'); "
+CASES = {
+    # Baseline interpreter start
+    'python': "pass",
+    # Help output, no processing modules needed
+    'help': "import StopAndGlow; StopAndGlow.ArgParser().printHelp()",
+    # Light command: parse and import everything the processing queue needs, without touching the hardware
+    'lights': "import StopAndGlow; p = StopAndGlow.ArgParser(); p.parse(['--lights', 'off']); import stopandglow.processing_queue",
+    # Heavy backends that are only loaded on demand
+    'depth backend': "import stopandglow.processing_queue as q; q.DepthEstimator.resolve()",
+    'neural backend': "import stopandglow.processing_queue as q; q.NeuralRti.resolve()",
+}
+
+
+def measure(code) -> list:
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", PREFIX + code], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode().strip().splitlines()[-1])
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == '__main__':
+    print(f"Startup times over {RUNS} runs (median / min)")
+    for name, code in CASES.items():
+        try:
+            times = measure(code)
+            print(f"  {name:16s} {statistics.median(times)*1000:8.1f} ms {min(times)*1000:8.1f} ms")
+        except RuntimeError as e:
+            print(f"  {name:16s} failed: {e}")